@@ -33,10 +33,23 @@ import pyodbc
 import re
 import json
 import os
+import bisect
+import getpass
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List, Tuple
+from typing import Optional, Dict, Any, List, NamedTuple, Tuple
 import logging
 
+import gesden_codec
+
+try:
+    import numpy as np
+except ImportError:  # NumPy solo hace falta para la cartera de deuda (GestorDeuda.cartera)
+    np = None
+
 # =====================================================
 # CONFIGURACIÓN
 # =====================================================
@@ -49,6 +62,22 @@ class ConfigGesden:
     DRIVER = "SQL Server"
     ID_CENTRO = 2  # Tu centro
     
+    # Segundos entre refrescos del índice de nombres (cambios hechos desde Gesden)
+    REFRESCO_NOMBRES = int(os.getenv("GESDEN_REFRESCO_NOMBRES", "300"))
+    # Segundos que vale la foto de la cartera de deuda (GestorDeuda.cartera)
+    CARTERA_TTL = int(os.getenv("GESDEN_CARTERA_TTL", "600"))
+    
+    # Memoria de conversación del motor IA (por usuario)
+    MEMORIA_TURNOS = int(os.getenv("GESDEN_MEMORIA_TURNOS", "3"))          # turnos literales
+    MEMORIA_TOKENS = int(os.getenv("GESDEN_MEMORIA_TOKENS", "1200"))       # presupuesto por llamada
+    MEMORIA_CADUCIDAD = int(os.getenv("GESDEN_MEMORIA_CADUCIDAD", "28800"))  # segundos sin uso
+    # Operador de la consola (cada uno con su memoria); vacío = usuario del sistema
+    OPERADOR = os.getenv("GESDEN_OPERADOR", "")
+    # Motor IA con tools nativas (tool_use); "0" vuelve al JSON en texto
+    IA_HERRAMIENTAS = os.getenv("GESDEN_IA_HERRAMIENTAS", "1") == "1"
+    # Segundos entre comprobaciones de versión del catálogo de tratamientos (0 = no vigilar)
+    REFRESCO_CATALOGO = int(os.getenv("GESDEN_REFRESCO_CATALOGO", "300"))
+    
     # API de Claude (obtener de variable de entorno)
     ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "")
     
@@ -60,6 +89,11 @@ class ConfigGesden:
             f'DATABASE={cls.BASE_DATOS};'
             f'Trusted_Connection=yes;'
         )
+    
+    @classmethod
+    def admite_fast_executemany(cls):
+        """fast_executemany solo es fiable con los drivers ODBC 1x de Microsoft"""
+        return re.fullmatch(r'ODBC Driver 1\d for SQL Server', cls.DRIVER) is not None
 
 # Configurar logging
 logging.basicConfig(
@@ -76,37 +110,27 @@ logging.basicConfig(
 # =====================================================
 
 class ConversorFechas:
-    """Convierte entre formatos de fecha de Gesden y Python"""
+    """Convierte entre formatos de fecha de Gesden y Python (ver gesden_codec)"""
     
     @staticmethod
     def fecha_gesden_a_datetime(fecha_int: int) -> datetime:
         """Convierte fecha de Gesden (int) a datetime"""
-        base_date = datetime(1899, 12, 30)
-        return base_date + timedelta(days=fecha_int)
+        return gesden_codec.fecha_a_datetime(fecha_int)
     
     @staticmethod
     def datetime_a_fecha_gesden(fecha: datetime) -> int:
         """Convierte datetime a formato Gesden (int)"""
-        base_date = datetime(1899, 12, 30)
-        delta = fecha - base_date
-        return delta.days
+        return gesden_codec.datetime_a_fecha(fecha)
     
     @staticmethod
     def hora_gesden_a_str(hora_int: int) -> str:
         """Convierte hora de Gesden a string legible"""
-        if hora_int is None:
-            return "00:00"
-        horas = hora_int // 10000
-        minutos = (hora_int % 10000) // 100
-        return f"{horas:02d}:{minutos:02d}"
+        return gesden_codec.hora_a_str(hora_int)
     
     @staticmethod
     def str_a_hora_gesden(hora_str: str) -> int:
         """Convierte string de hora a formato Gesden"""
-        partes = hora_str.split(':')
-        horas = int(partes[0])
-        minutos = int(partes[1]) if len(partes) > 1 else 0
-        return (horas * 10000) + (minutos * 100)
+        return gesden_codec.str_a_hora(hora_str)
 
 # =====================================================
 # CLASE DE CONEXIÓN A BASE DE DATOS
@@ -156,21 +180,424 @@ class ConexionGesden:
             logging.error(f"❌ Error en query: {str(e)}")
             raise
     
+    def iterar_query(self, sql: str, params: tuple = None, lote: int = 1000):
+        """Generador de filas leídas en bloques con fetchmany (para resultados grandes)"""
+        cursor = self.conn.cursor()
+        try:
+            if params:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+            
+            total = 0
+            while True:
+                filas = cursor.fetchmany(lote)
+                if not filas:
+                    break
+                total += len(filas)
+                yield from filas
+            logging.info(f"✅ Query ejecutada. Resultados: {total} filas (por bloques)")
+        finally:
+            cursor.close()
+    
+    @contextmanager
+    def transaccion(self):
+        """Cursor dentro de una transacción: commit al salir, rollback si hay error"""
+        cursor = self.conn.cursor()
+        try:
+            yield cursor
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            logging.error(f"❌ Error en transacción (rollback): {str(e)}")
+            raise
+        finally:
+            cursor.close()
+    
     def cerrar(self):
         """Cierra la conexión"""
         if self.conn:
             self.conn.close()
             logging.info("🔒 Conexión cerrada")
 
+# =====================================================
+# ÍNDICE DE NOMBRES (BÚSQUEDA FONÉTICA EN MEMORIA)
+# =====================================================
+
+# Partículas que no identifican a nadie ("María DE LA Cruz", "Ruiz Y Gómez")
+PARTICULAS_NOMBRE = {'DE', 'DEL', 'LA', 'LAS', 'LOS', 'Y', 'E', 'I'}
+
+# Reglas de pronunciación del español, en orden (sobre texto ya plegado)
+_REGLAS_FONETICAS = [
+    (re.compile(r'CH'), '#'),             # marcador temporal para CH
+    (re.compile(r'LL'), 'Y'),             # yeísmo: Llorente = Yorente
+    (re.compile(r'QU(?=[EI])'), 'K'),
+    (re.compile(r'Q'), 'K'),
+    (re.compile(r'G(?=[EI])'), 'J'),      # Gema = Jema
+    (re.compile(r'GU(?=[EI])'), 'G'),     # Guerra = Gerra
+    (re.compile(r'C(?=[EI])'), 'S'),      # seseo: Cecilia = Sesilia
+    (re.compile(r'C'), 'K'),
+    (re.compile(r'Z'), 'S'),
+    (re.compile(r'^X(?=[AEIOU])'), 'J'),  # grafía antigua: Ximénez = Jiménez, Xavier
+    (re.compile(r'X'), 'KS'),
+    (re.compile(r'[VW]'), 'B'),           # Valdés = Baldés
+    (re.compile(r'H'), ''),               # h muda: Hernández = Ernández
+    (re.compile(r'Y(?=[^AEIOU]|$)'), 'I'),  # Reyes / Reies, Ruy / Rui
+    (re.compile(r'#'), 'X'),
+    (re.compile(r'(.)\1+'), r'\1'),       # Carrasco = Carasco, Mussons = Musons
+]
+
+
+def plegar_texto(texto: Optional[str]) -> str:
+    """'José Ñúñez' -> 'JOSE NUNEZ' (mayúsculas, sin tildes ni diéresis)"""
+    texto = unicodedata.normalize('NFKD', str(texto or ''))
+    return ''.join(c for c in texto if not unicodedata.combining(c)).upper()
+
+
+def palabras_nombre(texto: Optional[str]) -> List[str]:
+    """Palabras plegadas de un nombre, sin partículas ('Gómez-Ruiz' -> GOMEZ, RUIZ)"""
+    return [p for p in re.findall(r'[A-Z0-9]+', plegar_texto(texto)) if p not in PARTICULAS_NOMBRE]
+
+
+def clave_fonetica(palabra: str) -> str:
+    """Clave fonética española de una palabra ya plegada (XIMENEZ -> JIMENES, LLORENTE -> YORENTE)"""
+    for patron, sustituto in _REGLAS_FONETICAS:
+        palabra = patron.sub(sustituto, palabra)
+    return palabra
+
+
+class IndiceNombres:
+    """
+    Índice residente de Nombre + Apellidos de los pacientes.
+    
+    Cada palabra se guarda plegada (sin tildes) y con su clave fonética, así
+    'jose garcia', 'García José' y 'Garzía Jose' llegan al mismo paciente sin
+    ir a SQL Server. La búsqueda no depende del orden de las palabras y
+    devuelve los candidatos ordenados por puntuación.
+    
+    Se carga entero al arrancar y se refresca por _fechaModif como mucho cada
+    `intervalo` segundos (los pacientes también se dan de alta desde Gesden).
+    """
+    
+    COLUMNAS = "IdPac, NumPac, Nombre, Apellidos, TelMovil, Email, FecNacim, Sexo, _fechaModif"
+    
+    # Puntuación de una palabra buscada frente a una palabra del paciente
+    PUNTOS_EXACTA = 1.0
+    PUNTOS_FONETICA = 0.9
+    PUNTOS_PREFIJO = 0.8
+    PUNTOS_PREFIJO_FONETICO = 0.7
+    MIN_PREFIJO = 3
+    
+    def __init__(self, db: 'ConexionGesden', intervalo: int = 300):
+        self.db = db
+        self.intervalo = intervalo
+        self.listo = False
+        self.marca = None                                # mayor _fechaModif visto
+        self.max_id = 0                                  # mayor IdPac visto (altas sin _fechaModif)
+        self._ultimo_refresco = 0.0
+        
+        self._pacientes: Dict[int, Dict] = {}            # IdPac -> datos del paciente
+        self._palabras_de: Dict[int, List[Tuple[str, str]]] = {}   # IdPac -> [(palabra, clave)]
+        self._por_palabra: Dict[str, set] = {}
+        self._por_clave: Dict[str, set] = {}
+        self._palabras_ordenadas: List[str] = []         # para prefijos con bisect
+        self._claves_ordenadas: List[str] = []
+        self._ordenar = False
+    
+    # Mantenimiento
+    
+    def cargar(self):
+        """Carga completa de Pacientes"""
+        filas = self.db.ejecutar_query(f"SELECT {self.COLUMNAS} FROM Pacientes")
+        for id_pac in list(self._pacientes):
+            self._quitar(id_pac)
+        for fila in filas:
+            self.actualizar(self._fila_dict(fila), fila._fechaModif)
+        self.listo = True
+        self._ultimo_refresco = time.monotonic()
+        logging.info(f"✅ Índice de nombres cargado: {len(self._pacientes)} pacientes, "
+                     f"{len(self._por_clave)} claves fonéticas")
+    
+    def refrescar(self, forzar: bool = False):
+        """Trae los pacientes modificados desde la última marca y las altas sin _fechaModif"""
+        if not self.listo:
+            return
+        if not forzar and time.monotonic() - self._ultimo_refresco < self.intervalo:
+            return
+        self._ultimo_refresco = time.monotonic()
+        if self.marca is None:
+            where, params = "_fechaModif IS NOT NULL OR IdPac > ?", (self.max_id,)
+        else:
+            # >= para no perder filas con la misma marca (reindexarlas es idempotente)
+            where = "_fechaModif >= ? OR (_fechaModif IS NULL AND IdPac > ?)"
+            params = (self.marca, self.max_id)
+        filas = self.db.ejecutar_query(f"SELECT {self.COLUMNAS} FROM Pacientes WHERE {where}", params)
+        for fila in filas:
+            self.actualizar(self._fila_dict(fila), fila._fechaModif)
+    
+    @staticmethod
+    def _fila_dict(fila) -> Dict:
+        return {
+            'IdPac': fila.IdPac,
+            'NumPac': fila.NumPac,
+            'Nombre': fila.Nombre,
+            'Apellidos': fila.Apellidos,
+            'TelMovil': fila.TelMovil,
+            'Email': fila.Email,
+            'FecNacim': fila.FecNacim,
+            'Sexo': fila.Sexo
+        }
+    
+    def _quitar(self, id_pac: int):
+        self._pacientes.pop(id_pac, None)
+        for palabra, clave in self._palabras_de.pop(id_pac, ()):
+            for indice, valor in ((self._por_palabra, palabra), (self._por_clave, clave)):
+                ids = indice.get(valor)
+                if ids is not None:
+                    ids.discard(id_pac)
+                    if not ids:
+                        del indice[valor]
+                        self._ordenar = True
+    
+    def actualizar(self, paciente: Dict, fecha_modif: datetime = None):
+        """Alta o cambio de un paciente (dict con las claves de _fila_dict)"""
+        id_pac = paciente['IdPac']
+        self._quitar(id_pac)
+        
+        palabras = []
+        for palabra in palabras_nombre(f"{paciente.get('Nombre') or ''} {paciente.get('Apellidos') or ''}"):
+            clave = clave_fonetica(palabra)
+            palabras.append((palabra, clave))
+            if palabra not in self._por_palabra or clave not in self._por_clave:
+                self._ordenar = True
+            self._por_palabra.setdefault(palabra, set()).add(id_pac)
+            self._por_clave.setdefault(clave, set()).add(id_pac)
+        
+        self._pacientes[id_pac] = paciente
+        self._palabras_de[id_pac] = palabras
+        
+        if fecha_modif is not None and (self.marca is None or fecha_modif > self.marca):
+            self.marca = fecha_modif
+        if id_pac > self.max_id:
+            self.max_id = id_pac
+    
+    # Búsqueda
+    
+    @staticmethod
+    def _con_prefijo(ordenadas: List[str], indice: Dict[str, set], prefijo: str) -> set:
+        ids = set()
+        i = bisect.bisect_left(ordenadas, prefijo)
+        while i < len(ordenadas) and ordenadas[i].startswith(prefijo):
+            ids |= indice[ordenadas[i]]
+            i += 1
+        return ids
+    
+    def _candidatos(self, palabra: str, clave: str) -> set:
+        ids = set(self._por_palabra.get(palabra, ())) | self._por_clave.get(clave, set())
+        if len(palabra) >= self.MIN_PREFIJO:
+            ids |= self._con_prefijo(self._palabras_ordenadas, self._por_palabra, palabra)
+        if len(clave) >= self.MIN_PREFIJO:
+            ids |= self._con_prefijo(self._claves_ordenadas, self._por_clave, clave)
+        return ids
+    
+    def _puntuar(self, buscadas: List[Tuple[str, str]], id_pac: int) -> float:
+        propias = self._palabras_de[id_pac]
+        total = 0.0
+        usadas = set()
+        for palabra, clave in buscadas:
+            mejor, mejor_i = 0.0, None
+            for i, (propia, clave_propia) in enumerate(propias):
+                if propia == palabra:
+                    puntos = self.PUNTOS_EXACTA
+                elif clave_propia == clave:
+                    puntos = self.PUNTOS_FONETICA
+                elif len(palabra) >= self.MIN_PREFIJO and propia.startswith(palabra):
+                    puntos = self.PUNTOS_PREFIJO
+                elif len(clave) >= self.MIN_PREFIJO and clave_propia.startswith(clave):
+                    puntos = self.PUNTOS_PREFIJO_FONETICO
+                else:
+                    continue
+                if puntos > mejor:
+                    mejor, mejor_i = puntos, i
+            if not mejor:
+                return 0.0
+            total += mejor
+            usadas.add(mejor_i)
+        # Desempate: a igualdad, gana quien tiene menos palabras sin nombrar
+        return total / len(buscadas) + 0.05 * len(usadas) / len(propias)
+    
+    def buscar(self, texto: str, limite: int = 10) -> List[Tuple[float, Dict]]:
+        """Candidatos (puntuación, paciente) para un nombre dicho de cualquier forma"""
+        buscadas = [(p, clave_fonetica(p)) for p in palabras_nombre(texto)]
+        if not buscadas:
+            return []
+        
+        if self._ordenar:
+            self._palabras_ordenadas = sorted(self._por_palabra)
+            self._claves_ordenadas = sorted(self._por_clave)
+            self._ordenar = False
+        
+        # Todas las palabras buscadas deben aparecer: intersección empezando por la más rara
+        conjuntos = sorted((self._candidatos(p, c) for p, c in buscadas), key=len)
+        ids = conjuntos[0]
+        for conjunto in conjuntos[1:]:
+            ids = ids & conjunto
+            if not ids:
+                return []
+        
+        puntuados = []
+        for id_pac in ids:
+            puntos = self._puntuar(buscadas, id_pac)
+            if puntos:
+                puntuados.append((puntos, self._pacientes[id_pac]))
+        puntuados.sort(key=lambda par: (-par[0], par[1]['Apellidos'] or '', par[1]['Nombre'] or ''))
+        return puntuados[:limite]
+
+
 # =====================================================
 # GESTOR DE PACIENTES
 # =====================================================
 
+def normalizar_telefono(telefono: Optional[str]) -> str:
+    """'+34 600-12 34 56' -> '600123456' (solo dígitos, sin prefijo de España)"""
+    digitos = re.sub(r'\D', '', telefono or '')
+    if digitos.startswith('0034'):
+        digitos = digitos[4:]
+    elif len(digitos) == 11 and digitos.startswith('34'):
+        digitos = digitos[2:]
+    return digitos
+
+
+class IndiceTelefonos:
+    """
+    Índice en memoria TelMovil normalizado -> IdPac.
+    
+    Se carga al arrancar (una sola lectura de Pacientes) y se mantiene con
+    las altas del propio agente y con los cambios por _fechaModif que trae
+    la consulta de duplicados. Evita el REPLACE(...) = ? que recorre la tabla.
+    """
+    
+    def __init__(self, db: 'ConexionGesden'):
+        self.db = db
+        self.listo = False
+        self.marca = None                                # mayor _fechaModif visto
+        self.max_id = 0                                  # mayor IdPac visto (altas sin _fechaModif)
+        self._por_telefono: Dict[str, set] = {}
+        self._telefono_de: Dict[int, str] = {}
+    
+    def cargar(self):
+        """Carga completa de los teléfonos móviles"""
+        filas = self.db.ejecutar_query(
+            "SELECT IdPac, TelMovil, _fechaModif FROM Pacientes WHERE TelMovil IS NOT NULL AND TelMovil <> ''"
+        )
+        self._por_telefono.clear()
+        self._telefono_de.clear()
+        for fila in filas:
+            self.actualizar(fila.IdPac, fila.TelMovil, fila._fechaModif)
+        self.listo = True
+        logging.info(f"✅ Índice de teléfonos cargado: {len(self._telefono_de)} pacientes")
+    
+    def actualizar(self, id_pac: int, telefono: Optional[str], fecha_modif: datetime = None):
+        """Alta o cambio del teléfono de un paciente"""
+        anterior = self._telefono_de.pop(id_pac, None)
+        if anterior:
+            ids = self._por_telefono.get(anterior)
+            if ids:
+                ids.discard(id_pac)
+                if not ids:
+                    del self._por_telefono[anterior]
+        
+        normalizado = normalizar_telefono(telefono)
+        if normalizado:
+            self._telefono_de[id_pac] = normalizado
+            self._por_telefono.setdefault(normalizado, set()).add(id_pac)
+        
+        if fecha_modif is not None and (self.marca is None or fecha_modif > self.marca):
+            self.marca = fecha_modif
+        if id_pac > self.max_id:
+            self.max_id = id_pac
+    
+    def buscar(self, telefono: Optional[str]) -> List[int]:
+        """IdPac con ese teléfono (normalizado)"""
+        return sorted(self._por_telefono.get(normalizar_telefono(telefono), ()))
+
+
 class GestorPacientes:
     """Gestiona operaciones con pacientes"""
     
+    COLUMNAS_DUPLICADOS = "IdPac, NumPac, Nombre, Apellidos, FecNacim, TelMovil, _fechaModif"
+    
     def __init__(self, db: ConexionGesden):
         self.db = db
+        self.indice_telefonos = IndiceTelefonos(db)
+        try:
+            self.indice_telefonos.cargar()
+        except Exception as e:
+            # Sin índice, la comprobación de teléfono vuelve a hacerse en SQL
+            logging.error(f"⚠️ Índice de teléfonos no disponible: {e}")
+        
+        self.indice_nombres = IndiceNombres(db, ConfigGesden.REFRESCO_NOMBRES)
+        try:
+            self.indice_nombres.cargar()
+        except Exception as e:
+            # Sin índice, las búsquedas por nombre vuelven a los LIKE
+            logging.error(f"⚠️ Índice de nombres no disponible: {e}")
+    
+    def _buscar_duplicados(self, nombre: str, apellidos: str, telefono: str) -> Dict[str, List]:
+        """
+        Candidatos a duplicado en una sola consulta (UNION ALL con columna Tipo):
+        - 'nombre': mismo nombre y apellidos
+        - 'similar': mismos apellidos y nombre que empieza igual (máx. 3)
+        - 'telefono': IdPac que el índice de teléfonos da para ese móvil
+        - 'cambio': pacientes modificados desde la última marca del índice, y
+          altas con _fechaModif NULL posteriores al último IdPac indexado
+        """
+        cols = self.COLUMNAS_DUPLICADOS
+        partes = [
+            f"SELECT 'nombre' AS Tipo, {cols} FROM Pacientes WHERE Nombre = ? AND Apellidos = ?",
+            f"SELECT * FROM (SELECT TOP 3 'similar' AS Tipo, {cols} FROM Pacientes "
+            f"WHERE Apellidos = ? AND Nombre LIKE ?) s",
+        ]
+        primer_nombre = (nombre.split() or [''])[0]
+        params = [nombre, apellidos, apellidos, f"{primer_nombre}%"]
+        
+        indice = self.indice_telefonos
+        if telefono and indice.listo:
+            ids = indice.buscar(telefono)
+            if ids:
+                partes.append(f"SELECT 'telefono' AS Tipo, {cols} FROM Pacientes "
+                              f"WHERE IdPac IN ({', '.join('?' * len(ids))})")
+                params.extend(ids)
+        elif telefono:
+            partes.append(f"SELECT 'telefono' AS Tipo, {cols} FROM Pacientes "
+                          f"WHERE REPLACE(REPLACE(TelMovil, ' ', ''), '-', '') = ?")
+            params.append(telefono.replace(" ", "").replace("-", ""))
+        
+        if indice.listo:
+            if indice.marca is None:
+                partes.append(f"SELECT 'cambio' AS Tipo, {cols} FROM Pacientes "
+                              f"WHERE _fechaModif IS NOT NULL OR IdPac > ?")
+                params.append(indice.max_id)
+            else:
+                partes.append(f"SELECT 'cambio' AS Tipo, {cols} FROM Pacientes "
+                              f"WHERE _fechaModif >= ? OR (_fechaModif IS NULL AND IdPac > ?)")
+                params.extend([indice.marca, indice.max_id])
+        
+        filas = self.db.ejecutar_query("\nUNION ALL\n".join(partes), tuple(params))
+        
+        candidatos = {'nombre': [], 'similar': [], 'telefono': []}
+        por_id = {}
+        for fila in filas:
+            if fila.Tipo == 'cambio':
+                indice.actualizar(fila.IdPac, fila.TelMovil, fila._fechaModif)
+            else:
+                candidatos[fila.Tipo].append(fila)
+            por_id[fila.IdPac] = fila
+        
+        # El índice ya incluye los cambios recién traídos: el teléfono se comprueba sobre él
+        if telefono and indice.listo:
+            candidatos['telefono'] = [por_id[i] for i in indice.buscar(telefono) if i in por_id]
+        return candidatos
     
     def crear_paciente(self, nombre: str, apellidos: str, 
                       fecha_nacimiento: datetime, telefono_movil: str,
@@ -186,15 +613,11 @@ class GestorPacientes:
         # VALIDACIÓN DE DUPLICADOS
         # ========================================
         
+        # Una sola consulta para las tres comprobaciones
+        candidatos = self._buscar_duplicados(nombre, apellidos, telefono_movil)
+        
         # 1. Validar por nombre y apellidos exactos
-        duplicados_nombre = self.db.ejecutar_query(
-            """
-            SELECT IdPac, NumPac, Nombre, Apellidos, FecNacim, TelMovil
-            FROM Pacientes
-            WHERE Nombre = ? AND Apellidos = ?
-            """,
-            (nombre, apellidos)
-        )
+        duplicados_nombre = candidatos['nombre']
         
         if duplicados_nombre:
             pac_dup = duplicados_nombre[0]
@@ -207,49 +630,29 @@ class GestorPacientes:
             )
         
         # 2. Validar por teléfono
-        if telefono_movil:
-            tel_limpio = telefono_movil.replace(" ", "").replace("-", "")
-            duplicados_tel = self.db.ejecutar_query(
-                """
-                SELECT IdPac, NumPac, Nombre, Apellidos, TelMovil
-                FROM Pacientes
-                WHERE REPLACE(REPLACE(TelMovil, ' ', ''), '-', '') = ?
-                """,
-                (tel_limpio,)
+        duplicados_tel = candidatos['telefono']
+        
+        if duplicados_tel:
+            pac_dup = duplicados_tel[0]
+            raise ValueError(
+                f"❌ TELÉFONO YA REGISTRADO\n"
+                f"El teléfono {telefono_movil} pertenece a:\n"
+                f"{pac_dup.Nombre} {pac_dup.Apellidos}\n"
+                f"NumPac: {pac_dup.NumPac} | ID: {pac_dup.IdPac}"
             )
-            
-            if duplicados_tel:
-                pac_dup = duplicados_tel[0]
-                raise ValueError(
-                    f"❌ TELÉFONO YA REGISTRADO\n"
-                    f"El teléfono {telefono_movil} pertenece a:\n"
-                    f"{pac_dup.Nombre} {pac_dup.Apellidos}\n"
-                    f"NumPac: {pac_dup.NumPac} | ID: {pac_dup.IdPac}"
-                )
         
         # 3. Validar por similitud
-        partes_nombre = nombre.split()
-        if partes_nombre:
-            primer_nombre = partes_nombre[0]
-            similares = self.db.ejecutar_query(
-                """
-                SELECT TOP 3 IdPac, NumPac, Nombre, Apellidos, FecNacim, TelMovil
-                FROM Pacientes
-                WHERE Apellidos = ? AND Nombre LIKE ?
-                """,
-                (apellidos, f"{primer_nombre}%")
-            )
+        similares = candidatos['similar'] if nombre.split() else []
+        if similares:
+            print("\n⚠️ ADVERTENCIA: Encontré paciente(s) con nombre similar:")
+            for pac in similares:
+                print(f"   • {pac.Nombre} {pac.Apellidos} - "
+                      f"NumPac: {pac.NumPac} - "
+                      f"Tel: {pac.TelMovil or 'N/A'}")
             
-            if similares:
-                print("\n⚠️ ADVERTENCIA: Encontré paciente(s) con nombre similar:")
-                for pac in similares:
-                    print(f"   • {pac.Nombre} {pac.Apellidos} - "
-                          f"NumPac: {pac.NumPac} - "
-                          f"Tel: {pac.TelMovil or 'N/A'}")
-                
-                confirmacion = input("\n¿Estás SEGURO de crear este nuevo paciente? (escribe SI): ")
-                if confirmacion.upper() != 'SI':
-                    raise ValueError("❌ Creación cancelada. El paciente probablemente ya existe.")
+            confirmacion = input("\n¿Estás SEGURO de crear este nuevo paciente? (escribe SI): ")
+            if confirmacion.upper() != 'SI':
+                raise ValueError("❌ Creación cancelada. El paciente probablemente ya existe.")
         
         # ========================================
         # CREAR PACIENTE
@@ -285,9 +688,23 @@ class GestorPacientes:
         
         # Obtener el paciente creado
         paciente_creado = self.db.ejecutar_query(
-            "SELECT TOP 1 IdPac, NumPac, Nombre, Apellidos FROM Pacientes ORDER BY IdPac DESC"
+            "SELECT TOP 1 IdPac, NumPac, Nombre, Apellidos, _fechaModif FROM Pacientes ORDER BY IdPac DESC"
         )[0]
         
+        if self.indice_telefonos.listo:
+            self.indice_telefonos.actualizar(paciente_creado.IdPac, telefono_movil, paciente_creado._fechaModif)
+        if self.indice_nombres.listo:
+            self.indice_nombres.actualizar({
+                'IdPac': paciente_creado.IdPac,
+                'NumPac': paciente_creado.NumPac,
+                'Nombre': paciente_creado.Nombre,
+                'Apellidos': paciente_creado.Apellidos,
+                'TelMovil': telefono_movil,
+                'Email': email,
+                'FecNacim': fecha_nacimiento,
+                'Sexo': sexo
+            }, paciente_creado._fechaModif)
+        
         resultado = {
             'IdPac': paciente_creado.IdPac,
             'NumPac': paciente_creado.NumPac,
@@ -355,6 +772,34 @@ class GestorPacientes:
         
         return pacientes
     
+    def buscar_por_nombre(self, texto: str, margen: float = 0.05) -> List[Dict]:
+        """
+        Resuelve un nombre dicho de cualquier forma ('garcia jose', 'Jose García')
+        a pacientes, del más probable al menos. Solo devuelve los que puntúan
+        a menos de `margen` del mejor: si uno coincide exacto, los parecidos
+        no generan ambigüedad.
+        """
+        if self.indice_nombres.listo:
+            try:
+                self.indice_nombres.refrescar()
+            except Exception as e:
+                logging.error(f"⚠️ No se pudo refrescar el índice de nombres: {e}")
+            
+            candidatos = self.indice_nombres.buscar(texto)
+            if not candidatos:
+                return []
+            mejor = candidatos[0][0]
+            return [dict(paciente) for puntos, paciente in candidatos if puntos >= mejor - margen]
+        
+        # Sin índice: búsqueda en SQL por apellidos y, si no, por nombre
+        partes = texto.split()
+        if len(partes) == 1:
+            pacientes = self.buscar_paciente(apellidos=partes[0])
+            if not pacientes:
+                pacientes = self.buscar_paciente(nombre=partes[0])
+            return pacientes
+        return self.buscar_paciente(nombre=partes[0], apellidos=" ".join(partes[1:]))
+    
     def obtener_paciente_por_id(self, id_pac: int) -> Optional[Dict]:
         """Obtiene un paciente por su ID interno"""
         sql = """
@@ -453,15 +898,16 @@ class GestorCitas:
         
         resultados = self.db.ejecutar_query(sql, tuple(params))
         
+        # Conversión de fechas y horas por columnas (tablas precalculadas)
+        fechas = gesden_codec.fechas_a_iso([row.Fecha for row in resultados])
+        horas = gesden_codec.horas_a_str([row.Hora for row in resultados])
+        
         citas = []
-        for row in resultados:
-            fecha_dt = ConversorFechas.fecha_gesden_a_datetime(row.Fecha)
-            hora_str = ConversorFechas.hora_gesden_a_str(row.Hora)
-            
+        for row, fecha_iso, hora_str in zip(resultados, fechas, horas):
             citas.append({
                 'IdCita': row.IdCita,
                 'IdPac': row.IdPac,
-                'Fecha': fecha_dt.strftime('%Y-%m-%d'),
+                'Fecha': fecha_iso,
                 'Hora': hora_str,
                 'Duracion': row.Duracion,
                 'Texto': row.Texto,
@@ -617,14 +1063,186 @@ class GestorColaboradores:
 # GESTOR DE TRATAMIENTOS (CATÁLOGO)
 # =====================================================
 
+class FotoCatalogo(NamedTuple):
+    """Estado del catálogo en un momento dado: se sustituye entero al recargar"""
+    por_id: Dict[int, Dict]
+    por_codigo: Dict[str, int]
+    codigos_ordenados: List[str]
+    palabras: Dict[str, set]
+    palabras_ordenadas: List[str]
+
+
+FOTO_CATALOGO_VACIA = FotoCatalogo({}, {}, [], {}, [])
+
+
+class CatalogoTratamientos:
+    """
+    Catálogo de Tratamientos residente en memoria.
+    
+    - Índice por IdTratamiento y por Codigo
+    - Índice de prefijos por palabra de Descrip (sin tildes ni mayúsculas)
+    - Versión = nº de filas + mayor _fechaModif; un hilo la comprueba cada
+      `intervalo` segundos con su propia conexión y recarga si cambia
+    
+    Buscar y consultar precios no va a SQL Server.
+    """
+    
+    SQL_CATALOGO = "SELECT IdTratamiento, Codigo, Descrip, Precio FROM Tratamientos"
+    SQL_VERSION = "SELECT COUNT(*) AS Filas, MAX(_fechaModif) AS Marca FROM Tratamientos"
+    
+    def __init__(self, db: ConexionGesden, intervalo: int = 300):
+        self.db = db
+        self.intervalo = intervalo
+        self.listo = False
+        self.version = None
+        
+        # Una sola asignación al recargar: cada consulta lee self._foto una vez
+        # y nunca mezcla índices de dos cargas (lecturas sin lock)
+        self._foto = FOTO_CATALOGO_VACIA
+        
+        self._parar = threading.Event()
+        self._hilo = None
+    
+    # Carga y versión
+    
+    def cargar(self, db: ConexionGesden = None):
+        """Carga completa del catálogo"""
+        db = db or self.db
+        version = self._leer_version(db)
+        filas = db.ejecutar_query(self.SQL_CATALOGO)
+        
+        por_id, por_codigo, palabras = {}, {}, {}
+        for row in filas:
+            tto = {
+                'IdTto': row.IdTratamiento,
+                'Codigo': row.Codigo,
+                'Descripcion': row.Descrip,
+                'Importe': float(row.Precio) if row.Precio else 0.0
+            }
+            por_id[row.IdTratamiento] = tto
+            if row.Codigo:
+                por_codigo.setdefault(plegar_texto(row.Codigo).strip(), row.IdTratamiento)
+            for palabra in set(re.findall(r'[A-Z0-9]+', plegar_texto(row.Descrip))):
+                palabras.setdefault(palabra, set()).add(row.IdTratamiento)
+        
+        self._foto = FotoCatalogo(por_id, por_codigo, sorted(por_codigo), palabras, sorted(palabras))
+        self.version = version
+        self.listo = True
+        logging.info(f"✅ Catálogo de tratamientos cargado: {len(por_id)} tratamientos")
+    
+    def _leer_version(self, db: ConexionGesden) -> Tuple:
+        row = db.ejecutar_query(self.SQL_VERSION)[0]
+        return (row.Filas, row.Marca)
+    
+    def comprobar(self, db: ConexionGesden = None) -> bool:
+        """Recarga si la versión del catálogo ha cambiado. True si recargó"""
+        db = db or self.db
+        if self._leer_version(db) == self.version:
+            return False
+        self.cargar(db)
+        return True
+    
+    def iniciar(self):
+        """Arranca el hilo que vigila la versión del catálogo"""
+        if self._hilo is not None or self.intervalo <= 0:
+            return
+        self._hilo = threading.Thread(target=self._vigilar, name='catalogo-tratamientos', daemon=True)
+        self._hilo.start()
+    
+    def detener(self):
+        self._parar.set()
+    
+    def _vigilar(self):
+        # pyodbc no comparte conexiones entre hilos: el vigilante abre la suya
+        conexion = None
+        while not self._parar.wait(self.intervalo):
+            try:
+                if conexion is None:
+                    conexion = ConexionGesden()
+                self.comprobar(conexion)
+            except Exception as e:
+                logging.error(f"⚠️ No se pudo comprobar el catálogo de tratamientos: {e}")
+                if conexion is not None:
+                    try:
+                        conexion.cerrar()
+                    except Exception:
+                        pass
+                conexion = None
+        if conexion is not None:
+            conexion.cerrar()
+    
+    # Consultas (solo memoria)
+    
+    def obtener(self, id_tto: int) -> Optional[Dict]:
+        tto = self._foto.por_id.get(id_tto)
+        return dict(tto) if tto else None
+    
+    def contiene(self, id_tto: int) -> bool:
+        return id_tto in self._foto.por_id
+    
+    def precio(self, id_tto: int) -> float:
+        tto = self._foto.por_id.get(id_tto)
+        return tto['Importe'] if tto else 0.0
+    
+    @staticmethod
+    def _con_prefijo(ordenadas: List[str], prefijo: str) -> List[str]:
+        """Claves de `ordenadas` que empiezan por `prefijo` (bisect)"""
+        i = bisect.bisect_left(ordenadas, prefijo)
+        j = i
+        while j < len(ordenadas) and ordenadas[j].startswith(prefijo):
+            j += 1
+        return ordenadas[i:j]
+    
+    def buscar(self, texto: str, limite: int = 20) -> List[Dict]:
+        """
+        Código exacto primero; después tratamientos cuyo código empieza por el
+        texto o cuya descripción tiene todas las palabras buscadas (por prefijo).
+        """
+        plegado = plegar_texto(texto).strip()
+        if not plegado:
+            return []
+        
+        foto = self._foto
+        exacto = foto.por_codigo.get(plegado)
+        
+        ids = {foto.por_codigo[c] for c in self._con_prefijo(foto.codigos_ordenados, plegado)}
+        palabras = re.findall(r'[A-Z0-9]+', plegado)
+        if palabras:
+            por_descripcion = None
+            for palabra in sorted(palabras, key=len, reverse=True):
+                encontrados = set()
+                for clave in self._con_prefijo(foto.palabras_ordenadas, palabra):
+                    encontrados |= foto.palabras[clave]
+                por_descripcion = encontrados if por_descripcion is None else por_descripcion & encontrados
+                if not por_descripcion:
+                    break
+            ids |= por_descripcion
+        ids.discard(exacto)
+        
+        resultado = sorted((foto.por_id[i] for i in ids), key=lambda t: t['Descripcion'] or '')
+        if exacto is not None:
+            resultado.insert(0, foto.por_id[exacto])
+        return [dict(tto) for tto in resultado[:limite]]
+
+
 class GestorTratamientos:
     """Gestiona el catálogo de tratamientos"""
     
     def __init__(self, db: ConexionGesden):
         self.db = db
+        self.catalogo = CatalogoTratamientos(db, ConfigGesden.REFRESCO_CATALOGO)
+        try:
+            self.catalogo.cargar()
+            self.catalogo.iniciar()
+        except Exception as e:
+            # Sin catálogo en memoria, las búsquedas vuelven a SQL
+            logging.error(f"⚠️ Catálogo de tratamientos no disponible: {e}")
     
     def buscar(self, texto: str, limit: int = 20) -> List[Dict]:
         """Busca tratamientos en el catálogo"""
+        if self.catalogo.listo:
+            return self.catalogo.buscar(texto, limit)
+        
         # Buscar en tabla Tratamientos
         sql = """
             SELECT TOP ?
@@ -655,6 +1273,9 @@ class GestorTratamientos:
     
     def obtener_por_id(self, id_tto: int) -> Optional[Dict]:
         """Obtiene un tratamiento por ID"""
+        if self.catalogo.listo and self.catalogo.contiene(id_tto):
+            return self.catalogo.obtener(id_tto)
+        
         sql = """
             SELECT 
                 IdTratamiento AS IdTto,
@@ -780,8 +1401,31 @@ class GestorActosMedicos:
 class GestorPresupuestos:
     """Gestiona presupuestos"""
     
-    def __init__(self, db: ConexionGesden):
+    SQL_CABECERA = """
+        INSERT INTO Presu (
+            IdPac, NumSerie, NumPre, Titulo, FecPresup,
+            IdCol, IdCentro, _fechareg, _version
+        ) VALUES (
+            ?, ?, ?, ?, GETDATE(),
+            ?, ?, GETDATE(), 1
+        )
+    """
+    
+    SQL_LINEA = """
+        INSERT INTO PresuTto (
+            IdPac, NumSerie, NumPre, LinPre, IdTto,
+            Unidades, ImportePre, ImporteUni, Notas,
+            PiezasNum, IdCol, _version
+        ) VALUES (
+            ?, ?, ?, ?, ?,
+            ?, ?, ?, ?,
+            ?, ?, 1
+        )
+    """
+    
+    def __init__(self, db: ConexionGesden, catalogo: CatalogoTratamientos = None):
         self.db = db
+        self.catalogo = catalogo
     
     def crear_presupuesto(self, id_pac: int, id_col: int, 
                           titulo: str = "", tratamientos: List[Dict] = None) -> Dict:
@@ -798,48 +1442,51 @@ class GestorPresupuestos:
             Dict con IdPac, NumSerie, NumPre
         """
         
-        # Obtener siguiente NumPre para este paciente
-        result = self.db.ejecutar_query(
-            """
-            SELECT ISNULL(MAX(NumPre), 0) + 1 AS NextNum 
-            FROM Presu 
-            WHERE IdPac = ? AND NumSerie = 0
-            """,
-            (id_pac,)
-        )
-        num_pre = result[0].NextNum
+        tratamientos = tratamientos or []
         num_serie = 0
         
-        # Insertar cabecera del presupuesto
-        sql_presu = """
-            INSERT INTO Presu (
-                IdPac, NumSerie, NumPre, Titulo, FecPresup,
-                IdCol, IdCentro, _fechareg, _version
-            ) VALUES (
-                ?, ?, ?, ?, GETDATE(),
-                ?, ?, GETDATE(), 1
+        # Precios de todas las líneas en una sola consulta, antes de abrir la transacción
+        precios = self._precios_tratamientos([tto.get('id_tto') for tto in tratamientos])
+        lineas = [
+            self._fila_linea(
+                id_pac, num_serie, None, idx,
+                tto.get('id_tto'),
+                precios.get(tto.get('id_tto'), 0.0),
+                tto.get('piezas'),
+                tto.get('unidades', 1),
+                tto.get('notas', ''),
+                id_col
             )
-        """
-        
-        self.db.ejecutar_query(
-            sql_presu,
-            (id_pac, num_serie, num_pre, titulo, id_col, ConfigGesden.ID_CENTRO),
-            commit=True
-        )
+            for idx, tto in enumerate(tratamientos, 1)
+        ]
         
-        # Si hay tratamientos, añadirlos
-        if tratamientos:
-            for idx, tto in enumerate(tratamientos, 1):
-                self._añadir_linea_presupuesto(
-                    id_pac, num_serie, num_pre, idx,
-                    tto.get('id_tto'),
-                    tto.get('piezas'),
-                    tto.get('unidades', 1),
-                    tto.get('notas', ''),
-                    id_col
-                )
+        # Cabecera y líneas en una única transacción: o se graba todo o nada
+        with self.db.transaccion() as cursor:
+            # Siguiente NumPre para este paciente (bloqueado hasta el commit)
+            cursor.execute(
+                """
+                SELECT ISNULL(MAX(NumPre), 0) + 1 AS NextNum 
+                FROM Presu WITH (UPDLOCK, HOLDLOCK)
+                WHERE IdPac = ? AND NumSerie = 0
+                """,
+                (id_pac,)
+            )
+            num_pre = cursor.fetchone().NextNum
+            
+            cursor.execute(
+                self.SQL_CABECERA,
+                (id_pac, num_serie, num_pre, titulo, id_col, ConfigGesden.ID_CENTRO)
+            )
+            
+            if lineas:
+                for linea in lineas:
+                    linea[2] = num_pre
+                # Con el driver antiguo "SQL Server" fast_executemany falla o
+                # trunca textos: executemany normal, en la misma transacción
+                cursor.fast_executemany = ConfigGesden.admite_fast_executemany()
+                cursor.executemany(self.SQL_LINEA, lineas)
         
-        logging.info(f"✅ Presupuesto creado: Paciente={id_pac}, NumPre={num_pre}")
+        logging.info(f"✅ Presupuesto creado: Paciente={id_pac}, NumPre={num_pre}, {len(lineas)} líneas")
         
         return {
             'IdPac': id_pac,
@@ -847,18 +1494,28 @@ class GestorPresupuestos:
             'NumPre': num_pre
         }
     
-    def _añadir_linea_presupuesto(self, id_pac: int, num_serie: int, num_pre: int,
-                                   lin_pre: int, id_tto: int, piezas: str = None,
-                                   unidades: int = 1, notas: str = "", id_col: int = None):
-        """Añade una línea de tratamiento al presupuesto"""
+    def _precios_tratamientos(self, ids_tto: List[int]) -> Dict[int, float]:
+        """Precio de varios tratamientos: del catálogo en memoria o con un solo IN (...)"""
+        ids = sorted({id_tto for id_tto in ids_tto if id_tto is not None})
+        if not ids:
+            return {}
         
-        # Obtener precio del tratamiento
-        tratamiento = self.db.ejecutar_query(
-            "SELECT Precio FROM Tratamientos WHERE IdTratamiento = ?",
-            (id_tto,)
-        )
+        if self.catalogo is not None and self.catalogo.listo \
+                and all(self.catalogo.contiene(id_tto) for id_tto in ids):
+            return {id_tto: self.catalogo.precio(id_tto) for id_tto in ids}
         
-        importe = float(tratamiento[0].Precio) if tratamiento and tratamiento[0].Precio else 0.0
+        resultados = self.db.ejecutar_query(
+            f"SELECT IdTratamiento, Precio FROM Tratamientos "
+            f"WHERE IdTratamiento IN ({', '.join('?' * len(ids))})",
+            tuple(ids)
+        )
+        return {row.IdTratamiento: float(row.Precio) if row.Precio else 0.0 for row in resultados}
+    
+    @staticmethod
+    def _fila_linea(id_pac: int, num_serie: int, num_pre: int, lin_pre: int,
+                    id_tto: int, importe: float, piezas: str = None,
+                    unidades: int = 1, notas: str = "", id_col: int = None) -> List:
+        """Parámetros de SQL_LINEA para una línea de presupuesto"""
         importe_total = importe * unidades
         
         # Convertir piezas
@@ -866,24 +1523,20 @@ class GestorPresupuestos:
         if piezas:
             piezas_num = piezas.replace(".", "")
         
-        # Insertar línea
-        sql = """
-            INSERT INTO PresuTto (
-                IdPac, NumSerie, NumPre, LinPre, IdTto,
-                Unidades, ImportePre, ImporteUni, Notas,
-                PiezasNum, IdCol, _version
-            ) VALUES (
-                ?, ?, ?, ?, ?,
-                ?, ?, ?, ?,
-                ?, ?, 1
-            )
-        """
+        return [id_pac, num_serie, num_pre, lin_pre, id_tto,
+                unidades, importe_total, importe, notas,
+                piezas_num, id_col]
+    
+    def _añadir_linea_presupuesto(self, id_pac: int, num_serie: int, num_pre: int,
+                                   lin_pre: int, id_tto: int, piezas: str = None,
+                                   unidades: int = 1, notas: str = "", id_col: int = None):
+        """Añade una línea de tratamiento a un presupuesto ya creado"""
+        importe = self._precios_tratamientos([id_tto]).get(id_tto, 0.0)
         
         self.db.ejecutar_query(
-            sql,
-            (id_pac, num_serie, num_pre, lin_pre, id_tto,
-             unidades, importe_total, importe, notas,
-             piezas_num, id_col),
+            self.SQL_LINEA,
+            tuple(self._fila_linea(id_pac, num_serie, num_pre, lin_pre, id_tto,
+                                   importe, piezas, unidades, notas, id_col)),
             commit=True
         )
     
@@ -918,11 +1571,185 @@ class GestorPresupuestos:
 # GESTOR DE DEUDA
 # =====================================================
 
+class CarteraDeuda:
+    """
+    Foto de toda la deuda pendiente (DeudaCli no liquidada) por cliente.
+    
+    La deuda es del cliente (DeudaCli.IdCli), no del paciente: cada recibo
+    cuenta una sola vez y los pacientes que comparten cliente (familias) van
+    como lista en su fila. Se calcula de una vez con NumPy: días vencidos de
+    cada recibo, tramo de antigüedad y totales por cliente y tramo. De la
+    misma foto salen la lista de cobros ordenada y la consulta de un paciente.
+    """
+    
+    TRAMOS = ('0-30', '31-60', '61-90', '90+')
+    LIMITES_TRAMOS = (31, 61, 91)           # días vencidos donde empieza cada tramo siguiente
+    
+    def __init__(self, filas: Dict[str, List], hoy: datetime):
+        self.generada = datetime.now()
+        self.hoy = hoy
+        
+        id_cli = np.asarray(filas['IdCli'], dtype=np.int64)
+        pendiente = np.asarray(filas['Pendiente'], dtype=np.float64)
+        plazo = np.asarray(filas['FecPlazo'], dtype=np.int64)
+        
+        # Días vencidos (los recibos sin plazo o aún no vencidos cuentan como 0)
+        dias = np.where(plazo > 0, ConversorFechas.datetime_a_fecha_gesden(hoy) - plazo, 0)
+        dias = np.maximum(dias, 0)
+        tramo = np.digitize(dias, self.LIMITES_TRAMOS)
+        
+        # Totales por cliente y tramo con un solo bincount
+        self.ids, grupo = np.unique(id_cli, return_inverse=True)
+        n = len(self.ids)
+        self.por_tramo = np.bincount(
+            grupo * len(self.TRAMOS) + tramo, weights=pendiente, minlength=n * len(self.TRAMOS)
+        ).reshape(n, len(self.TRAMOS))
+        self.totales = self.por_tramo.sum(axis=1)
+        self.dias_max = np.zeros(n, dtype=np.int64)
+        np.maximum.at(self.dias_max, grupo, dias)
+        self.recibos = np.bincount(grupo, minlength=n)
+        
+        # Recibos agrupados por cliente (para el detalle) y ranking por importe
+        orden = np.argsort(grupo, kind='stable')
+        self._inicio = np.searchsorted(grupo[orden], np.arange(n + 1))
+        self._detalle = {
+            'IdDeudaCli': np.asarray(filas['IdDeudaCli'], dtype=object)[orden],
+            'NFactura': np.asarray(filas['NFactura'], dtype=object)[orden],
+            'FecPlazo': plazo[orden],
+            'Pendiente': pendiente[orden],
+            'Dias': dias[orden],
+            'Tramo': tramo[orden],
+        }
+        self._ranking = np.lexsort((-self.dias_max, -self.totales))
+        self._posicion = {int(id_cli): i for i, id_cli in enumerate(self.ids)}
+        self._pacientes = filas['Pacientes']            # IdCli -> [datos de cada paciente]
+        self._cliente_de = {
+            pac['IdPac']: cli for cli, pacientes in self._pacientes.items() for pac in pacientes
+        }
+    
+    def _fila(self, i: int) -> Dict:
+        id_cli = int(self.ids[i])
+        return {
+            'IdCli': id_cli,
+            'pacientes': [dict(pac) for pac in self._pacientes.get(id_cli, ())],
+            'total_deuda': round(float(self.totales[i]), 2),
+            'tramos': {t: round(float(v), 2) for t, v in zip(self.TRAMOS, self.por_tramo[i])},
+            'dias_max': int(self.dias_max[i]),
+            'recibos': int(self.recibos[i])
+        }
+    
+    def ranking(self, limite: int = 50, dias_minimos: int = 0) -> List[Dict]:
+        """Clientes ordenados por deuda total (desempate: la más antigua primero)"""
+        resultado = []
+        for i in self._ranking:
+            if self.dias_max[i] < dias_minimos:
+                continue
+            resultado.append(self._fila(i))
+            if len(resultado) >= limite:
+                break
+        return resultado
+    
+    def paciente(self, id_pac: int) -> Dict:
+        """Deuda del cliente de un paciente con detalle por recibo (total 0 si no debe nada)"""
+        id_cli = self._cliente_de.get(id_pac)
+        i = self._posicion.get(id_cli)
+        if i is None:
+            return {'IdPac': id_pac, 'IdCli': id_cli, 'pacientes': [], 'total_deuda': 0.0,
+                    'tramos': dict.fromkeys(self.TRAMOS, 0.0), 'dias_max': 0, 'recibos': 0, 'deudas': []}
+        
+        fila = self._fila(i)
+        fila['IdPac'] = id_pac
+        desde, hasta = self._inicio[i], self._inicio[i + 1]
+        fila['deudas'] = [
+            {
+                'IdDeudaCli': self._detalle['IdDeudaCli'][j],
+                'FecPlazo': ConversorFechas.fecha_gesden_a_datetime(self._detalle['FecPlazo'][j])
+                            if self._detalle['FecPlazo'][j] > 0 else None,
+                'Pendiente': float(self._detalle['Pendiente'][j]),
+                'NFactura': self._detalle['NFactura'][j],
+                'Dias': int(self._detalle['Dias'][j]),
+                'Tramo': self.TRAMOS[self._detalle['Tramo'][j]]
+            }
+            for j in range(desde, hasta)
+        ]
+        return fila
+    
+    def resumen(self) -> Dict:
+        """Totales de la cartera por tramo (cada recibo una vez)"""
+        return {
+            'clientes': len(self.ids),
+            'pacientes': sum(len(self._pacientes.get(int(id_cli), ())) for id_cli in self.ids),
+            'recibos': int(self.recibos.sum()),
+            'total_deuda': round(float(self.totales.sum()), 2),
+            'tramos': {t: round(float(v), 2) for t, v in zip(self.TRAMOS, self.por_tramo.sum(axis=0))},
+            'generada': self.generada.isoformat(timespec='seconds')
+        }
+
+
 class GestorDeuda:
     """Gestiona consultas de deuda de pacientes"""
     
+    # Deuda no liquidada por recibo: el cliente es quien debe (una fila por recibo)
+    SQL_CARTERA = """
+        SELECT d.IdCli, d.IdDeudaCli, d.FecPlazo, d.Pendiente, d.NFactura
+        FROM DeudaCli d
+        WHERE d.Liquidado = 0 AND d.Pendiente > 0
+          AND EXISTS (SELECT 1 FROM Pacientes p WHERE p.IdCli = d.IdCli)
+    """
+    
+    # Pacientes de los clientes con deuda (varios por cliente en familias)
+    SQL_PACIENTES_CARTERA = """
+        SELECT p.IdCli, p.IdPac, p.NumPac, p.Nombre, p.Apellidos, p.TelMovil
+        FROM Pacientes p
+        WHERE p.IdCli IN (SELECT d.IdCli FROM DeudaCli d WHERE d.Liquidado = 0 AND d.Pendiente > 0)
+        ORDER BY p.IdCli, p.IdPac
+    """
+    
     def __init__(self, db: ConexionGesden):
         self.db = db
+        self._cartera: Optional[CarteraDeuda] = None
+        self._lock_cartera = threading.Lock()
+    
+    def cartera(self, forzar: bool = False) -> CarteraDeuda:
+        """
+        Foto de la deuda de todos los clientes (recibos leídos por bloques y
+        sus pacientes aparte). Se reutiliza durante ConfigGesden.CARTERA_TTL segundos.
+        """
+        if np is None:
+            raise RuntimeError("La cartera de deuda necesita NumPy (pip install numpy)")
+        
+        with self._lock_cartera:
+            actual = self._cartera
+            if not forzar and actual is not None and \
+                    (datetime.now() - actual.generada).total_seconds() < ConfigGesden.CARTERA_TTL:
+                return actual
+            
+            columnas = {'IdCli': [], 'IdDeudaCli': [], 'FecPlazo': [], 'Pendiente': [], 'NFactura': []}
+            for row in self.db.iterar_query(self.SQL_CARTERA):
+                plazo = row.FecPlazo
+                if hasattr(plazo, 'toordinal'):  # datetime/date según el driver
+                    plazo = ConversorFechas.datetime_a_fecha_gesden(plazo)
+                columnas['IdCli'].append(row.IdCli)
+                columnas['IdDeudaCli'].append(row.IdDeudaCli)
+                columnas['FecPlazo'].append(int(plazo) if plazo else 0)
+                columnas['Pendiente'].append(float(row.Pendiente) if row.Pendiente else 0.0)
+                columnas['NFactura'].append(row.NFactura)
+            
+            pacientes = {}
+            for row in self.db.iterar_query(self.SQL_PACIENTES_CARTERA):
+                pacientes.setdefault(row.IdCli, []).append({
+                    'IdPac': row.IdPac,
+                    'NumPac': row.NumPac,
+                    'Nombre': row.Nombre,
+                    'Apellidos': row.Apellidos,
+                    'TelMovil': row.TelMovil
+                })
+            columnas['Pacientes'] = pacientes
+            
+            self._cartera = CarteraDeuda(columnas, datetime.now())
+            logging.info(f"✅ Cartera de deuda calculada: {len(self._cartera.ids)} clientes, "
+                         f"{len(columnas['IdCli'])} recibos pendientes")
+            return self._cartera
     
     def consultar_deuda_paciente(self, id_pac: int) -> Dict:
         """Consulta la deuda pendiente de un paciente"""
@@ -977,45 +1804,138 @@ class GestorDeuda:
 # MOTOR DE INTELIGENCIA ARTIFICIAL
 # =====================================================
 
+class MemoriaConversacion:
+    """
+    Memoria de la conversación de un usuario con presupuesto de tokens.
+    
+    - Los últimos turnos se reenvían literales
+    - Los anteriores se pliegan en un resumen de entidades (pacientes
+      resueltos, fechas elegidas, última acción) que va en el prompt
+    
+    Así los tokens de entrada por llamada no crecen con la sesión.
+    """
+    
+    CARACTERES_POR_TOKEN = 4      # estimación para español (sin llamar a la API)
+    MAX_PACIENTES = 5
+    MAX_FECHAS = 3
+    
+    def __init__(self, turnos: int = 3, presupuesto: int = 1200):
+        self.max_turnos = turnos
+        self.presupuesto = presupuesto
+        self.turnos: List[Dict] = []                     # {'usuario', 'asistente', 'resultado'}
+        self.pacientes: List[str] = []
+        self.fechas: List[str] = []
+        self.ultima_accion: Optional[str] = None
+        self.plegados = 0
+        self.ultimo_uso = time.monotonic()
+    
+    @classmethod
+    def estimar_tokens(cls, texto: str) -> int:
+        return len(texto) // cls.CARACTERES_POR_TOKEN + 1
+    
+    @staticmethod
+    def _recordar(lista: List[str], valor: str, maximo: int):
+        """Añade al final sin repetir y conserva solo los `maximo` más recientes"""
+        if valor in lista:
+            lista.remove(valor)
+        lista.append(valor)
+        del lista[:-maximo]
+    
+    def mensajes(self, texto_usuario: str) -> List[Dict]:
+        """Turnos literales + la petición nueva, listos para messages"""
+        self.ultimo_uso = time.monotonic()
+        mensajes = []
+        for turno in self.turnos:
+            mensajes.append({"role": "user", "content": turno['usuario']})
+            mensajes.append({"role": "assistant", "content": turno['asistente']})
+        mensajes.append({"role": "user", "content": texto_usuario})
+        return mensajes
+    
+    def resumen(self) -> str:
+        """Resumen de lo plegado ('' si aún no hay nada)"""
+        lineas = []
+        if self.pacientes:
+            lineas.append(f"- Pacientes mencionados: {'; '.join(self.pacientes)}")
+        if self.fechas:
+            lineas.append(f"- Fechas elegidas: {'; '.join(self.fechas)}")
+        if self.ultima_accion:
+            lineas.append(f"- Última acción: {self.ultima_accion}")
+        if not lineas:
+            return ""
+        return "MEMORIA DE LA CONVERSACIÓN (turnos anteriores resumidos):\n" + "\n".join(lineas) + "\n"
+    
+    def anotar_paciente(self, paciente: Dict):
+        """Paciente ya resuelto contra la base de datos ('él', 'a ese paciente'...)"""
+        self._recordar(
+            self.pacientes,
+            f"{paciente.get('Apellidos')} {paciente.get('Nombre')} (NumPac {paciente.get('NumPac')})",
+            self.MAX_PACIENTES
+        )
+    
+    def _paciente_recordado(self, nombre: str) -> bool:
+        """Mismo nombre completo ya en memoria, con o sin '(NumPac n)' detrás"""
+        nombre = nombre.upper()
+        return any(
+            p.upper() == nombre or p.upper().startswith(nombre + " (NUMPAC ")
+            for p in self.pacientes
+        )
+    
+    def registrar(self, texto_usuario: str, respuesta: str, resultado: Dict):
+        """Guarda el turno y pliega los antiguos si se pasa de turnos o de presupuesto"""
+        self.turnos.append({'usuario': texto_usuario, 'asistente': respuesta, 'resultado': resultado})
+        
+        while len(self.turnos) > self.max_turnos or \
+                (len(self.turnos) > 1 and self.tokens() > self.presupuesto):
+            self._extraer(self.turnos.pop(0)['resultado'])
+            self.plegados += 1
+    
+    def _extraer(self, resultado: Dict):
+        """Entidades de un turno plegado que pasan al resumen"""
+        for accion in resultado.get('acciones') or []:
+            self._extraer(accion)
+        params = resultado.get('parametros') or {}
+        nombre = params.get('nombre_paciente') or (
+            params.get('busqueda') if resultado.get('accion') == 'buscar_paciente' else None
+        )
+        if nombre and not self._paciente_recordado(str(nombre)):
+            self._recordar(self.pacientes, str(nombre), self.MAX_PACIENTES)
+        if params.get('fecha'):
+            fecha = str(params['fecha']) + (f" {params['hora']}" if params.get('hora') else "")
+            self._recordar(self.fechas, fecha, self.MAX_FECHAS)
+        if resultado.get('accion') not in (None, 'desconocida', 'necesita_aclaracion'):
+            self.ultima_accion = resultado['accion']
+    
+    def tokens(self) -> int:
+        """Tokens estimados que esta memoria añade a cada llamada"""
+        texto = self.resumen() + "".join(t['usuario'] + t['asistente'] for t in self.turnos)
+        return self.estimar_tokens(texto)
+
+
 class MotorIA:
     """Motor de IA usando Claude API para procesar lenguaje natural"""
     
-    def __init__(self):
-        self.api_key = ConfigGesden.ANTHROPIC_API_KEY
-        self.historial = []
-        
-        if self.api_key:
-            try:
-                import anthropic
-                self.client = anthropic.Anthropic(api_key=self.api_key)
-                self.disponible = True
-                logging.info("✅ Motor IA activado con Claude API")
-                print("🤖 Motor IA activado - Modo inteligente")
-            except ImportError:
-                logging.warning("⚠️ Instala anthropic: pip install anthropic")
-                self.disponible = False
-                print("⚠️ Motor IA desactivado - Instala: pip install anthropic")
-            except Exception as e:
-                logging.error(f"❌ Error al iniciar Motor IA: {e}")
-                self.disponible = False
-                print(f"⚠️ Motor IA desactivado - Error: {e}")
-        else:
-            self.disponible = False
-            logging.info("💡 Motor IA desactivado - Configura ANTHROPIC_API_KEY para activar")
-            print("💡 Motor IA desactivado - Modo básico (sin API)")
+    MODELO = "claude-sonnet-4-20250514"
     
-    def get_system_prompt(self) -> str:
-        """Genera el prompt de sistema con contexto actualizado"""
-        
-        fecha_hoy = datetime.now()
-        dias_semana_es = ['lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo']
-        dia_actual = dias_semana_es[fecha_hoy.weekday()]
-        
-        return f"""Eres un asistente inteligente para una clínica dental que usa el software Gesden.
+    # Prefijo mínimo que Sonnet 4 guarda en la caché de prompts: por debajo,
+    # cache_control no hace nada. En modo herramientas la API añade además su
+    # propio prompt de sistema de tools (346 tokens con tool_choice auto)
+    MIN_TOKENS_CACHE = 1024
+    TOKENS_SISTEMA_HERRAMIENTAS = 346
+    
+    REGLAS_FECHAS_HORAS = """IMPORTANTE - MANEJO DE FECHAS:
+- "hoy", "mañana" y la próxima fecha de cada día de la semana vienen en CONTEXTO TEMPORAL (al final)
+- "próximo lunes", "martes que viene", etc. = usa esa próxima ocurrencia del día
+- Si mencionan una fecha como "15/12/2025" o "15 de diciembre", úsala directamente
 
-CONTEXTO TEMPORAL:
-- Fecha de hoy: {fecha_hoy.strftime('%d/%m/%Y')}
-- Día de la semana: {dia_actual}
+IMPORTANTE - MANEJO DE HORAS:
+- Formatos válidos: "10:30", "10h", "10.30h", "las 10", "10 de la mañana"
+- Normaliza siempre a formato "HH:MM" (ej: "10:30")
+
+"""
+    
+    # Parte fija del prompt: idéntica byte a byte en todas las llamadas para
+    # que Anthropic la sirva de la caché de prompts (cache_control)
+    PROMPT_ESTATICO = """Eres un asistente inteligente para una clínica dental que usa el software Gesden.
 
 Tu función es interpretar peticiones en lenguaje natural y convertirlas en acciones estructuradas.
 
@@ -1049,73 +1969,77 @@ ACCIONES DISPONIBLES:
    - Ver deuda pendiente de un paciente
    - Parámetros: nombre_paciente
 
-IMPORTANTE - MANEJO DE FECHAS:
-- "hoy" = {fecha_hoy.strftime('%d/%m/%Y')}
-- "mañana" = {(fecha_hoy + timedelta(days=1)).strftime('%d/%m/%Y')}
-- "próximo lunes", "martes que viene", etc. = calcula la próxima ocurrencia de ese día
-- Si mencionan una fecha como "15/12/2025" o "15 de diciembre", úsala directamente
-
-IMPORTANTE - MANEJO DE HORAS:
-- Formatos válidos: "10:30", "10h", "10.30h", "las 10", "10 de la mañana"
-- Normaliza siempre a formato "HH:MM" (ej: "10:30")
+8. cartera_deuda
+   - Deuda pendiente por antigüedad (0-30, 31-60, 61-90, 90+ días): totales y clientes que más deben
+   - Con nombre_paciente: antigüedad de la deuda de ese paciente, recibo a recibo
+   - Parámetros: limite (opcional, 10), dias_minimos (opcional, 0), nombre_paciente (opcional)
 
-FORMATO DE RESPUESTA:
+""" + REGLAS_FECHAS_HORAS + """FORMATO DE RESPUESTA:
 Responde SIEMPRE en formato JSON válido:
 
-{{
+{
     "accion": "nombre_de_accion",
-    "parametros": {{
+    "parametros": {
         "param1": "valor1"
-    }},
+    },
     "mensaje": "Mensaje amigable para el usuario"
-}}
+}
 
 EJEMPLOS:
 
 Usuario: "busca a Juan García"
-{{
+{
     "accion": "buscar_paciente",
-    "parametros": {{
+    "parametros": {
         "busqueda": "Juan García"
-    }},
+    },
     "mensaje": "Buscando paciente Juan García..."
-}}
+}
 
-Usuario: "crea cita para María López el próximo lunes a las 11.30h"
-{{
+Usuario: "crea cita para María López el próximo lunes a las 11.30h" (si el próximo lunes es 15/12/2025)
+{
     "accion": "crear_cita",
-    "parametros": {{
+    "parametros": {
         "nombre_paciente": "María López",
-        "fecha": "{self._calcular_proximo_dia('lunes').strftime('%d/%m/%Y')}",
+        "fecha": "15/12/2025",
         "hora": "11:30"
-    }},
-    "mensaje": "Creando cita para María López el lunes {self._calcular_proximo_dia('lunes').strftime('%d/%m/%Y')} a las 11:30"
-}}
+    },
+    "mensaje": "Creando cita para María López el lunes 15/12/2025 a las 11:30"
+}
 
 Usuario: "qué citas tengo hoy"
-{{
+{
     "accion": "listar_citas",
-    "parametros": {{
+    "parametros": {
         "fecha": "hoy"
-    }},
+    },
     "mensaje": "Consultando citas de hoy..."
-}}
+}
 
 Usuario: "lista de doctores"
-{{
+{
     "accion": "listar_colaboradores",
-    "parametros": {{}},
+    "parametros": {},
     "mensaje": "Mostrando lista de colaboradores activos..."
-}}
+}
 
 Usuario: "cuánto debe Juan Pérez"
-{{
+{
     "accion": "consultar_deuda",
-    "parametros": {{
+    "parametros": {
         "nombre_paciente": "Juan Pérez"
-    }},
+    },
     "mensaje": "Consultando deuda de Juan Pérez..."
-}}
+}
+
+Usuario: "quién nos debe desde hace más de 90 días"
+{
+    "accion": "cartera_deuda",
+    "parametros": {
+        "dias_minimos": 91
+    },
+    "mensaje": "Consultando la deuda con más de 90 días..."
+}
 
 IMPORTANTE:
 - Si no entiendes la petición, usa accion: "desconocida"
@@ -1124,6 +2048,239 @@ IMPORTANTE:
 - NO inventes datos, si falta información usa accion: "necesita_aclaracion"
 """
     
+    # Modo herramientas: cada acción es una tool con su esquema y el modelo
+    # responde con bloques tool_use (sin JSON en texto que parsear)
+    PROMPT_HERRAMIENTAS = """Eres un asistente inteligente para una clínica dental que usa el software Gesden.
+
+Tu función es interpretar peticiones en lenguaje natural y ejecutarlas con las herramientas disponibles.
+
+""" + REGLAS_FECHAS_HORAS + """USO DE HERRAMIENTAS:
+- Cada petición se resuelve llamando a la herramienta que corresponde
+- Si el usuario pide varias cosas a la vez ("busca a Juan y dime cuánto debe"), llama a varias herramientas en la misma respuesta
+- Acompaña las llamadas de una frase breve y amigable para el usuario
+- NO inventes datos: si falta información imprescindible, pregunta en texto sin llamar a ninguna herramienta
+"""
+    
+    HERRAMIENTAS = [
+        {
+            "name": "buscar_paciente",
+            "description": "Buscar pacientes por nombre, apellidos o número de paciente (NumPac).",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "busqueda": {"type": "string", "description": "Nombre y/o apellidos, o NumPac"}
+                },
+                "required": ["busqueda"]
+            }
+        },
+        {
+            "name": "crear_paciente",
+            "description": "Dar de alta un paciente nuevo. Los datos se piden después por consola.",
+            "input_schema": {"type": "object", "properties": {}}
+        },
+        {
+            "name": "crear_cita",
+            "description": "Crear una cita para un paciente.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "nombre_paciente": {"type": "string", "description": "Nombre y apellidos del paciente"},
+                    "fecha": {"type": "string", "description": "DD/MM/AAAA, 'hoy' o 'mañana'"},
+                    "hora": {"type": "string", "description": "HH:MM"}
+                },
+                "required": ["nombre_paciente", "fecha", "hora"]
+            }
+        },
+        {
+            "name": "listar_citas",
+            "description": "Ver las citas de una fecha.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "fecha": {"type": "string", "description": "DD/MM/AAAA, 'hoy' o 'mañana'"}
+                },
+                "required": ["fecha"]
+            }
+        },
+        {
+            "name": "listar_colaboradores",
+            "description": "Mostrar los doctores/colaboradores activos.",
+            "input_schema": {"type": "object", "properties": {}}
+        },
+        {
+            "name": "buscar_tratamiento",
+            "description": "Buscar en el catálogo de tratamientos odontológicos (por descripción o código).",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "busqueda": {"type": "string", "description": "Texto o código del tratamiento"}
+                },
+                "required": ["busqueda"]
+            }
+        },
+        {
+            "name": "consultar_deuda",
+            "description": "Ver la deuda pendiente de un paciente.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "nombre_paciente": {"type": "string", "description": "Nombre y apellidos del paciente"}
+                },
+                "required": ["nombre_paciente"]
+            }
+        },
+        {
+            "name": "cartera_deuda",
+            "description": "Deuda pendiente por antigüedad (tramos 0-30, 31-60, 61-90 y 90+ días): "
+                           "totales y clientes que más deben, o el detalle de un paciente.",
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "limite": {"type": "integer", "description": "Nº de clientes de la lista (10 por defecto)"},
+                    "dias_minimos": {"type": "integer", "description": "Solo deudas con al menos estos días vencidos"},
+                    "nombre_paciente": {"type": "string", "description": "Antigüedad de la deuda de este paciente"}
+                }
+            }
+        },
+        {
+            "name": "ayuda",
+            "description": "Mostrar la ayuda con los comandos disponibles.",
+            "input_schema": {"type": "object", "properties": {}}
+        }
+    ]
+    
+    # Modo JSON: el esquema de parámetros de cada acción también va en la parte
+    # fija. Da al modelo tipos y obligatorios y deja el prefijo cacheado por
+    # encima de MIN_TOKENS_CACHE (el prompt solo no llegaba)
+    PROMPT_JSON = PROMPT_ESTATICO + "\nPARÁMETROS DE CADA ACCIÓN (JSON Schema):\n" + json.dumps(
+        {h['name']: h['input_schema'] for h in HERRAMIENTAS}, ensure_ascii=False, indent=1
+    ) + "\n"
+    
+    DIAS_SEMANA = ['lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo']
+    
+    def __init__(self):
+        self.api_key = ConfigGesden.ANTHROPIC_API_KEY
+        self.sesiones: Dict[str, MemoriaConversacion] = {}   # usuario -> memoria
+        self._fechas_cache = None                        # (día, bloque de fechas)
+        self.uso = {'llamadas': 0, 'entrada': 0, 'cache_leida': 0, 'cache_escrita': 0, 'salida': 0}
+        
+        if self.api_key:
+            try:
+                import anthropic
+                self.client = anthropic.Anthropic(api_key=self.api_key)
+                self.disponible = True
+                logging.info("✅ Motor IA activado con Claude API")
+                print("🤖 Motor IA activado - Modo inteligente")
+            except ImportError:
+                logging.warning("⚠️ Instala anthropic: pip install anthropic")
+                self.disponible = False
+                print("⚠️ Motor IA desactivado - Instala: pip install anthropic")
+            except Exception as e:
+                logging.error(f"❌ Error al iniciar Motor IA: {e}")
+                self.disponible = False
+                print(f"⚠️ Motor IA desactivado - Error: {e}")
+        else:
+            self.disponible = False
+            logging.info("💡 Motor IA desactivado - Configura ANTHROPIC_API_KEY para activar")
+            print("💡 Motor IA desactivado - Modo básico (sin API)")
+        
+        self._comprobar_prefijo_cache()
+    
+    def _comprobar_prefijo_cache(self):
+        """Avisa si la parte fija del prompt quedó por debajo del mínimo cacheable"""
+        if ConfigGesden.IA_HERRAMIENTAS:
+            tokens = (MemoriaConversacion.estimar_tokens(json.dumps(self.HERRAMIENTAS, ensure_ascii=False))
+                      + MemoriaConversacion.estimar_tokens(self.PROMPT_HERRAMIENTAS)
+                      + self.TOKENS_SISTEMA_HERRAMIENTAS)
+        else:
+            tokens = MemoriaConversacion.estimar_tokens(self.PROMPT_JSON)
+        if tokens < self.MIN_TOKENS_CACHE:
+            logging.warning(f"⚠️ Prefijo fijo del prompt ~{tokens} tokens (< {self.MIN_TOKENS_CACHE}): "
+                            f"la caché de prompts no se aplicará")
+    
+    def get_system_prompt(self, memoria: MemoriaConversacion = None, herramientas: bool = False) -> List[Dict]:
+        """
+        Prompt de sistema: el bloque estático (cacheado), el de fechas, que
+        cambia una vez al día, y el resumen de la memoria del usuario. Los
+        variables van detrás para no romper la caché.
+        
+        La API ordena el prefijo tools -> system -> messages: en modo
+        herramientas el único breakpoint, al final del bloque estático, cachea
+        las tools y el prompt juntos.
+        """
+        estatico = self.PROMPT_HERRAMIENTAS if herramientas else self.PROMPT_JSON
+        bloques = [
+            {"type": "text", "text": estatico, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": self._bloque_fechas()}
+        ]
+        resumen = memoria.resumen() if memoria else ""
+        if resumen:
+            bloques.append({"type": "text", "text": resumen})
+        return bloques
+    
+    def memoria(self, usuario: str = None) -> MemoriaConversacion:
+        """Memoria de conversación de un usuario (se crea al primer uso)"""
+        usuario = usuario or 'local'
+        ahora = time.monotonic()
+        
+        # Olvidar sesiones abandonadas
+        for clave in [u for u, m in self.sesiones.items()
+                      if ahora - m.ultimo_uso > ConfigGesden.MEMORIA_CADUCIDAD]:
+            del self.sesiones[clave]
+        
+        if usuario not in self.sesiones:
+            self.sesiones[usuario] = MemoriaConversacion(
+                ConfigGesden.MEMORIA_TURNOS, ConfigGesden.MEMORIA_TOKENS
+            )
+        return self.sesiones[usuario]
+    
+    def anotar_paciente(self, usuario: str, paciente: Dict):
+        """El agente avisa de que ha resuelto un paciente concreto"""
+        self.memoria(usuario).anotar_paciente(paciente)
+    
+    def _bloque_fechas(self) -> str:
+        """Contexto temporal del día (se calcula una vez por día)"""
+        hoy = datetime.now()
+        if self._fechas_cache and self._fechas_cache[0] == hoy.date():
+            return self._fechas_cache[1]
+        
+        proximos = ", ".join(
+            f"{dia} {self._calcular_proximo_dia(dia).strftime('%d/%m/%Y')}" for dia in self.DIAS_SEMANA
+        )
+        texto = (
+            "CONTEXTO TEMPORAL:\n"
+            f"- Fecha de hoy: {hoy.strftime('%d/%m/%Y')} ({self.DIAS_SEMANA[hoy.weekday()]})\n"
+            f"- \"hoy\" = {hoy.strftime('%d/%m/%Y')}\n"
+            f"- \"mañana\" = {(hoy + timedelta(days=1)).strftime('%d/%m/%Y')}\n"
+            f"- Próximos días: {proximos}\n"
+        )
+        self._fechas_cache = (hoy.date(), texto)
+        return texto
+    
+    def _registrar_uso(self, usage) -> None:
+        """Anota tokens y aciertos de caché de una llamada (y el acumulado de la sesión)"""
+        if usage is None:
+            return
+        llamada = {
+            'entrada': getattr(usage, 'input_tokens', 0) or 0,
+            'cache_leida': getattr(usage, 'cache_read_input_tokens', 0) or 0,
+            'cache_escrita': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+            'salida': getattr(usage, 'output_tokens', 0) or 0
+        }
+        self.uso['llamadas'] += 1
+        for clave, valor in llamada.items():
+            self.uso[clave] += valor
+        
+        def ratio(d):
+            total = d['entrada'] + d['cache_leida'] + d['cache_escrita']
+            return d['cache_leida'] / total if total else 0.0
+        
+        logging.info(
+            f"🧮 Tokens: entrada={llamada['entrada']} caché_leída={llamada['cache_leida']} "
+            f"caché_escrita={llamada['cache_escrita']} salida={llamada['salida']} | "
+            f"acierto caché {ratio(llamada):.0%} (sesión {ratio(self.uso):.0%} en {self.uso['llamadas']} llamadas)"
+        )
+    
     def _calcular_proximo_dia(self, dia_nombre: str) -> datetime:
         """Calcula la fecha del próximo día de la semana especificado"""
         dias_map = {
@@ -1140,32 +2297,81 @@ IMPORTANTE:
         
         return hoy + timedelta(days=dias_hasta)
     
-    def procesar(self, texto_usuario: str) -> Dict:
+    def procesar(self, texto_usuario: str, usuario: str = None) -> Dict:
         """Procesa una petición usando IA o fallback"""
         
         if self.disponible:
-            return self._procesar_con_ia(texto_usuario)
+            return self._procesar_con_ia(texto_usuario, usuario)
         else:
             return self._procesar_fallback(texto_usuario)
     
-    def _procesar_con_ia(self, texto_usuario: str) -> Dict:
+    def _procesar_con_herramientas(self, texto_usuario: str, usuario: str = None) -> Dict:
+        """
+        Procesa con Claude API en modo tool use. Devuelve 'acciones' (una por
+        bloque tool_use, puede haber varias) y el texto del modelo en 'mensaje'.
+        """
+        memoria = self.memoria(usuario)
+        
+        try:
+            response = self.client.messages.create(
+                model=self.MODELO,
+                max_tokens=1024,
+                system=self.get_system_prompt(memoria, herramientas=True),
+                tools=self.HERRAMIENTAS,
+                messages=memoria.mensajes(texto_usuario)
+            )
+        except Exception as e:
+            logging.error(f"❌ Error en Motor IA: {e}")
+            return self._procesar_fallback(texto_usuario)
+        
+        self._registrar_uso(getattr(response, 'usage', None))
+        
+        acciones = []
+        textos = []
+        for bloque in response.content:
+            if bloque.type == 'tool_use':
+                acciones.append({'accion': bloque.name, 'parametros': dict(bloque.input or {})})
+            elif bloque.type == 'text' and bloque.text.strip():
+                textos.append(bloque.text.strip())
+        
+        resultado = {'acciones': acciones, 'mensaje': "\n".join(textos)}
+        
+        # En la memoria el turno del asistente queda como texto: un tool_use sin
+        # su tool_result no se puede reenviar, y así ocupa menos
+        resumen_turno = "; ".join(
+            f"{a['accion']}({json.dumps(a['parametros'], ensure_ascii=False)})" for a in acciones
+        )
+        memoria.registrar(
+            texto_usuario,
+            " ".join(filter(None, [f"[acciones: {resumen_turno}]" if acciones else "", resultado['mensaje']])) or "-",
+            resultado
+        )
+        
+        logging.info(f"✅ IA procesó: {', '.join(a['accion'] for a in acciones) or 'sin acciones'}")
+        return resultado
+    
+    def _procesar_con_ia(self, texto_usuario: str, usuario: str = None) -> Dict:
         """Procesa con Claude API"""
         
+        if ConfigGesden.IA_HERRAMIENTAS:
+            return self._procesar_con_herramientas(texto_usuario, usuario)
+        
+        memoria = self.memoria(usuario)
+        
         try:
-            # Preparar mensajes
-            mensajes = self.historial + [{
-                "role": "user",
-                "content": texto_usuario
-            }]
+            # Preparar mensajes (turnos recientes; lo anterior va resumido en el prompt)
+            mensajes = memoria.mensajes(texto_usuario)
             
             # Llamar a Claude
             response = self.client.messages.create(
-                model="claude-sonnet-4-20250514",
+                model=self.MODELO,
                 max_tokens=2000,
-                system=self.get_system_prompt(),
+                system=self.get_system_prompt(memoria),
                 messages=mensajes
             )
             
+            self._registrar_uso(getattr(response, 'usage', None))
+            
             # Extraer respuesta
             respuesta_texto = response.content[0].text.strip()
             
@@ -1175,13 +2381,8 @@ IMPORTANTE:
             # Parsear JSON
             resultado = json.loads(respuesta_texto)
             
-            # Actualizar historial
-            self.historial.append({"role": "user", "content": texto_usuario})
-            self.historial.append({"role": "assistant", "content": respuesta_texto})
-            
-            # Mantener historial limitado (últimas 10 interacciones)
-            if len(self.historial) > 20:
-                self.historial = self.historial[-20:]
+            # Actualizar memoria (pliega los turnos antiguos en el resumen)
+            memoria.registrar(texto_usuario, respuesta_texto, resultado)
             
             logging.info(f"✅ IA procesó: {resultado.get('accion', 'desconocida')}")
             
@@ -1241,6 +2442,14 @@ IMPORTANTE:
                 "mensaje": "Para crear una cita necesito: nombre del paciente, fecha y hora.\nEjemplo: 'crear cita para Juan García el próximo lunes a las 10:30'"
             }
         
+        # Cartera de deuda por antigüedad
+        if any(word in texto_lower for word in ['cartera', 'moroso', 'morosos', 'antigüedad']):
+            return {
+                "accion": "cartera_deuda",
+                "parametros": {},
+                "mensaje": "Consultando la cartera de deuda..."
+            }
+        
         # Colaboradores
         if any(word in texto_lower for word in ['colaborador', 'doctor', 'doctores', 'médico']):
             return {
@@ -1272,28 +2481,46 @@ class AgenteGesdenIA:
         self.colaboradores = GestorColaboradores(self.db)
         self.tratamientos = GestorTratamientos(self.db)
         self.actos = GestorActosMedicos(self.db)
-        self.presupuestos = GestorPresupuestos(self.db)
+        self.presupuestos = GestorPresupuestos(self.db, self.tratamientos.catalogo)
         self.deuda = GestorDeuda(self.db)
         self.ia = MotorIA()  # Motor de IA en lugar de regex
+        self.usuario = None  # usuario del comando en curso (memoria de la IA)
         
         print("✅ Agente iniciado correctamente\n")
     
-    def procesar_comando(self, comando: str) -> str:
-        """Procesa un comando usando IA"""
+    def procesar_comando(self, comando: str, usuario: str = None) -> str:
+        """Procesa un comando usando IA (cada usuario con su propia memoria de conversación)"""
         
         print(f"\n💬 '{comando}'")
+        self.usuario = usuario
         
         # Usar el motor de IA para interpretar
-        resultado_ia = self.ia.procesar(comando)
+        resultado_ia = self.ia.procesar(comando, usuario)
         
-        accion = resultado_ia.get('accion', 'desconocida')
-        params = resultado_ia.get('parametros', {})
         mensaje_ia = resultado_ia.get('mensaje', '')
         
+        # Modo herramientas: una acción por bloque tool_use (puede haber varias)
+        if 'acciones' in resultado_ia:
+            acciones = resultado_ia['acciones']
+            if not acciones:
+                # El modelo pide aclaración en texto en lugar de actuar
+                return mensaje_ia or self._mostrar_ayuda()
+        else:
+            acciones = [{
+                'accion': resultado_ia.get('accion', 'desconocida'),
+                'parametros': resultado_ia.get('parametros', {})
+            }]
+        
         # Mostrar mensaje de la IA si existe
         if mensaje_ia:
             print(f"🤖 {mensaje_ia}")
         
+        return "\n".join(
+            self._ejecutar_accion(a['accion'], a['parametros'] or {}) for a in acciones
+        )
+    
+    def _ejecutar_accion(self, accion: str, params: Dict) -> str:
+        """Ejecuta una acción de la IA (un error no impide las demás del mismo turno)"""
         try:
             if accion == 'crear_paciente':
                 return self._cmd_crear_paciente(params)
@@ -1316,6 +2543,9 @@ class AgenteGesdenIA:
             elif accion == 'consultar_deuda':
                 return self._cmd_consultar_deuda_ia(params)
             
+            elif accion == 'cartera_deuda':
+                return self._cmd_cartera_deuda(params)
+            
             elif accion == 'ayuda':
                 return self._mostrar_ayuda()
             
@@ -1396,6 +2626,7 @@ class AgenteGesdenIA:
             return resultado + "\n⚠️ Especifica mejor el nombre"
         
         paciente = pacientes[0]
+        self.ia.anotar_paciente(self.usuario, paciente)
         
         # Extraer fecha
         fecha = self.nlp.extraer_fecha(fecha_texto)
@@ -1455,26 +2686,15 @@ class AgenteGesdenIA:
             else:
                 return f"❌ No encontré paciente con NumPac '{nombre_completo}'"
         
-        # Dividir en palabras
-        partes = nombre_completo.split()
-        
-        # Si solo hay UNA palabra, buscar en NOMBRE O APELLIDOS
-        if len(partes) == 1:
-            palabra = partes[0]
-            # Buscar primero por apellidos
-            pacientes = self.pacientes.buscar_paciente(apellidos=palabra)
-            # Si no encuentra, buscar por nombre
-            if not pacientes:
-                pacientes = self.pacientes.buscar_paciente(nombre=palabra)
-        else:
-            # Si hay varias palabras, dividir en nombre y apellidos
-            nombre = partes[0]
-            apellidos = " ".join(partes[1:])
-            pacientes = self.pacientes.buscar_paciente(nombre=nombre, apellidos=apellidos)
+        # Nombre y apellidos en cualquier orden, con o sin tildes
+        pacientes = self.pacientes.buscar_por_nombre(nombre_completo)
         
         if not pacientes:
             return f"❌ No encontré pacientes con '{nombre_completo}'"
         
+        if len(pacientes) == 1:
+            self.ia.anotar_paciente(self.usuario, pacientes[0])
+        
         resultado = f"🔍 Encontré {len(pacientes)} paciente(s):\n\n"
         
         for pac in pacientes:
@@ -1513,15 +2733,7 @@ class AgenteGesdenIA:
             return f"❌ No pude entender la fecha '{fecha_str}'"
         
         # Buscar paciente
-        partes = nombre_paciente.split()
-        if len(partes) == 1:
-            pacientes = self.pacientes.buscar_paciente(apellidos=partes[0])
-            if not pacientes:
-                pacientes = self.pacientes.buscar_paciente(nombre=partes[0])
-        else:
-            nombre = partes[0]
-            apellidos = " ".join(partes[1:])
-            pacientes = self.pacientes.buscar_paciente(nombre=nombre, apellidos=apellidos)
+        pacientes = self.pacientes.buscar_por_nombre(nombre_paciente)
         
         if not pacientes:
             return f"❌ No encontré paciente '{nombre_paciente}'"
@@ -1533,6 +2745,7 @@ class AgenteGesdenIA:
             return resultado + "\n⚠️ Por favor especifica mejor el nombre"
         
         paciente = pacientes[0]
+        self.ia.anotar_paciente(self.usuario, paciente)
         
         # Crear cita
         id_cita = self.citas.crear_cita(
@@ -1576,15 +2789,7 @@ class AgenteGesdenIA:
         nombre_paciente = params.get('nombre_paciente', '')
         
         # Buscar paciente
-        partes = nombre_paciente.split()
-        if len(partes) == 1:
-            pacientes = self.pacientes.buscar_paciente(apellidos=partes[0])
-            if not pacientes:
-                pacientes = self.pacientes.buscar_paciente(nombre=partes[0])
-        else:
-            nombre = partes[0]
-            apellidos = " ".join(partes[1:])
-            pacientes = self.pacientes.buscar_paciente(nombre=nombre, apellidos=apellidos)
+        pacientes = self.pacientes.buscar_por_nombre(nombre_paciente)
         
         if not pacientes:
             return f"❌ No encontré paciente '{nombre_paciente}'"
@@ -1596,6 +2801,7 @@ class AgenteGesdenIA:
             return resultado + "\n⚠️ Especifica mejor el nombre"
         
         paciente = pacientes[0]
+        self.ia.anotar_paciente(self.usuario, paciente)
         
         # Consultar deuda
         info_deuda = self.deuda.consultar_deuda_paciente(paciente['IdPac'])
@@ -1615,6 +2821,73 @@ class AgenteGesdenIA:
         
         return resultado
     
+    def _cmd_cartera_deuda(self, params: Dict) -> str:
+        """Comando: Deuda por antigüedad (cartera completa o un paciente)"""
+        
+        nombre_paciente = params.get('nombre_paciente', '')
+        limite = int(params.get('limite') or 10)
+        dias_minimos = int(params.get('dias_minimos') or 0)
+        
+        cartera = self.deuda.cartera()
+        
+        if nombre_paciente:
+            pacientes = self.pacientes.buscar_por_nombre(nombre_paciente)
+            
+            if not pacientes:
+                return f"❌ No encontré paciente '{nombre_paciente}'"
+            
+            if len(pacientes) > 1:
+                resultado = "🔍 Encontré varios pacientes:\n"
+                for i, pac in enumerate(pacientes, 1):
+                    resultado += f"  {i}. {pac['Apellidos']} {pac['Nombre']} - NumPac: {pac['NumPac']}\n"
+                return resultado + "\n⚠️ Especifica mejor el nombre"
+            
+            paciente = pacientes[0]
+            self.ia.anotar_paciente(self.usuario, paciente)
+            
+            info = cartera.paciente(paciente['IdPac'])
+            if info['total_deuda'] == 0:
+                return f"✅ {paciente['Apellidos']} {paciente['Nombre']} no tiene deuda pendiente"
+            
+            resultado = f"💰 Antigüedad de la deuda de {paciente['Apellidos']} {paciente['Nombre']}:\n\n"
+            resultado += f"📊 TOTAL PENDIENTE: {info['total_deuda']:.2f}€ ({info['dias_max']} días el más antiguo)\n"
+            resultado += "  " + " | ".join(f"{t}: {v:.2f}€" for t, v in info['tramos'].items()) + "\n"
+            
+            otros = [p for p in info['pacientes'] if p['IdPac'] != paciente['IdPac']]
+            if otros:
+                resultado += "👪 Cliente compartido con: " + ", ".join(
+                    f"{p['Apellidos']} {p['Nombre']}" for p in otros
+                ) + "\n"
+            
+            resultado += "\nDetalle:\n"
+            for deuda in info['deudas']:
+                resultado += f"  • {deuda['Pendiente']:.2f}€ - {deuda['Dias']} días ({deuda['Tramo']})\n"
+                if deuda['NFactura']:
+                    resultado += f"    Factura: {deuda['NFactura']}\n"
+            return resultado
+        
+        resumen = cartera.resumen()
+        if not resumen['recibos']:
+            return "✅ No hay deuda pendiente"
+        
+        resultado = (f"💰 Cartera de deuda: {resumen['total_deuda']:.2f}€ en {resumen['recibos']} recibos "
+                     f"de {resumen['clientes']} clientes\n")
+        resultado += "  " + " | ".join(f"{t}: {v:.2f}€" for t, v in resumen['tramos'].items()) + "\n\n"
+        
+        ranking = cartera.ranking(limite, dias_minimos)
+        if not ranking:
+            return resultado + f"✅ Ningún cliente con deuda de {dias_minimos} días o más"
+        
+        resultado += "📋 Clientes que más deben" + (f" (desde {dias_minimos} días)" if dias_minimos else "") + ":\n"
+        for i, fila in enumerate(ranking, 1):
+            nombres = ", ".join(f"{p['Apellidos']} {p['Nombre']}" for p in fila['pacientes'])
+            resultado += f"  {i}. {nombres} - {fila['total_deuda']:.2f}€ ({fila['dias_max']} días)\n"
+            telefonos = [p['TelMovil'] for p in fila['pacientes'] if p['TelMovil']]
+            if telefonos:
+                resultado += f"     📱 {telefonos[0]}\n"
+        
+        return resultado
+    
     def _parsear_fecha_ia(self, fecha_str: str) -> Optional[datetime]:
         """Parsea una fecha en diferentes formatos"""
         
@@ -1661,7 +2934,7 @@ class AgenteGesdenIA:
     def _cmd_buscar_tratamiento(self, params: Dict) -> str:
         """Comando: Buscar tratamiento"""
         
-        texto = params.get('texto', '')
+        texto = params.get('busqueda') or params.get('texto', '')
         
         tratamientos = self.tratamientos.buscar(texto)
         
@@ -1699,6 +2972,7 @@ class AgenteGesdenIA:
             return resultado + "\n⚠️ Especifica mejor el nombre"
         
         paciente = pacientes[0]
+        self.ia.anotar_paciente(self.usuario, paciente)
         
         # Consultar deuda
         info_deuda = self.deuda.consultar_deuda_paciente(paciente['IdPac'])
@@ -1741,6 +3015,8 @@ class AgenteGesdenIA:
 
 💰 DEUDA:
   • deuda de [nombre paciente]
+  • cartera de deuda / morosos de más de 90 días
+  • antigüedad de la deuda de [nombre paciente]
 
 💡 Ejemplos:
   • crear paciente
@@ -1752,10 +3028,12 @@ class AgenteGesdenIA:
   • listar colaboradores
   • buscar tratamiento empaste
   • deuda de Juan García
+  • cartera de deuda
 """
     
     def cerrar(self):
         """Cierra la conexión"""
+        self.tratamientos.catalogo.detener()
         self.db.cerrar()
 
 # =====================================================
@@ -1773,7 +3051,12 @@ def main():
     try:
         agente = AgenteGesdenIA()
         
+        # Cada operador tiene su propia memoria de conversación en el motor IA
+        operador = ConfigGesden.OPERADOR or getpass.getuser()
+        
+        print(f"👤 Operador: {operador}")
         print("📝 Escribe 'ayuda' para ver comandos")
+        print("📝 Escribe 'operador [nombre]' para cambiar de operador")
         print("📝 Escribe 'salir' para terminar")
         print()
         
@@ -1792,7 +3075,12 @@ def main():
                     print(agente._mostrar_ayuda())
                     continue
                 
-                respuesta = agente.procesar_comando(comando)
+                if comando.lower().startswith('operador '):
+                    operador = comando[len('operador '):].strip() or operador
+                    print(f"\n👤 Operador: {operador}\n")
+                    continue
+                
+                respuesta = agente.procesar_comando(comando, usuario=operador)
                 print(f"\n🤖 Agente:\n{respuesta}\n")
             
             except KeyboardInterrupt:
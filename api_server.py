@@ -36,13 +36,30 @@ if ENV_PATH.exists():
         print(f"📄 Contenido .env:\n{f.read()}")
 
 import logging
-from flask import Flask, request, jsonify, session
+import re
+import json
+import csv
+import io
+import inspect
+import bisect
+import heapq
+import itertools
+import math
+import threading
+import unicodedata
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, session, stream_with_context
 from flask_cors import CORS
 import pyodbc
 from datetime import datetime, timedelta
 import secrets
 import google.generativeai as genai
 
+import gesden_codec
+from replica_local import ReplicaGesden
+
 # =====================================================
 # CONFIGURACIÓN
 # =====================================================
@@ -56,9 +73,60 @@ class Config:
     SQL_DRIVER = "SQL Server"
     ID_CENTRO = 2
     
+    # Pool de conexiones SQL Server
+    POOL_MIN = int(os.getenv("GESDEN_POOL_MIN", "2"))
+    POOL_MAX = int(os.getenv("GESDEN_POOL_MAX", "10"))
+    POOL_TIMEOUT = float(os.getenv("GESDEN_POOL_TIMEOUT", "5"))        # espera máx. por conexión libre (s)
+    POOL_MAX_IDLE = int(os.getenv("GESDEN_POOL_MAX_IDLE", "300"))      # reciclar tras inactividad (s)
+    POOL_MAX_EDAD = int(os.getenv("GESDEN_POOL_MAX_EDAD", "1800"))     # reciclar por antigüedad (s)
+    POOL_VALIDAR_TRAS = int(os.getenv("GESDEN_POOL_VALIDAR_TRAS", "30"))  # validar si lleva X s sin uso (0 = siempre)
+    
+    # Índice de pacientes en memoria
+    INDICE_REFRESCO_SEG = int(os.getenv("GESDEN_INDICE_REFRESCO", "5"))  # refresco incremental (s)
+    INDICE_RECONCILIAR_SEG = int(os.getenv("GESDEN_INDICE_RECONCILIAR", "300"))  # repaso de IdPac borrados (s)
+    
+    # Caché de agenda por día
+    AGENDA_CACHE_TTL = int(os.getenv("GESDEN_AGENDA_TTL", "60"))              # caducidad de cada día (s)
+    AGENDA_CACHE_MAX = int(os.getenv("GESDEN_AGENDA_MAX", "64"))              # días en memoria (LRU)
+    AGENDA_VIGILANCIA_SEG = int(os.getenv("GESDEN_AGENDA_VIGILANCIA", "10"))  # sondeo de cambios en DCitas (s)
+    LOTE_CITAS_MAX = int(os.getenv("GESDEN_LOTE_CITAS_MAX", "500"))          # citas por /api/citas/crear-lote
+    RANGO_MAX_DIAS = int(os.getenv("GESDEN_RANGO_MAX_DIAS", "62"))           # días por /api/citas/rango
+    RANGO_LOTE = int(os.getenv("GESDEN_RANGO_LOTE", "500"))                  # filas por fetchmany
+    EXPORT_LOTE = int(os.getenv("GESDEN_EXPORT_LOTE", "1000"))               # /api/pacientes/export: filas por fetchmany
+    EXPORT_PAGINA = int(os.getenv("GESDEN_EXPORT_PAGINA", "20000"))          # filas por consulta (paginación por IdPac)
+    PACIENTE360_TTL = int(os.getenv("GESDEN_PACIENTE360_TTL", "30"))          # caché de la ficha completa (s)
+    PACIENTE360_MAX = int(os.getenv("GESDEN_PACIENTE360_MAX", "256"))         # fichas en memoria (LRU)
+    PACIENTE360_CITAS = int(os.getenv("GESDEN_PACIENTE360_CITAS", "10"))      # próximas citas en la ficha
+    
+    # Búsqueda de huecos libres
+    HUECOS_JORNADA = os.getenv("GESDEN_JORNADA", "09:00-14:00,16:00-20:00")
+    HUECOS_DIAS_LABORABLES = {int(d) for d in os.getenv("GESDEN_DIAS_LABORABLES", "0,1,2,3,4").split(',')}  # 0 = lunes
+    HUECOS_DIAS = int(os.getenv("GESDEN_HUECOS_DIAS", "14"))  # días a explorar si no se indica 'hasta'
+    
+    # Réplica local de lectura (SQLite) de Pacientes, DCitas y TColabos
+    REPLICA_ACTIVA = os.getenv("GESDEN_REPLICA", "1") != "0"
+    REPLICA_RUTA = os.getenv("GESDEN_REPLICA_RUTA", str(BASE_DIR / "replica_gesden.sqlite3"))
+    REPLICA_INTERVALO = int(os.getenv("GESDEN_REPLICA_INTERVALO", "5"))          # sincronización incremental (s)
+    REPLICA_MAX_RETRASO = int(os.getenv("GESDEN_REPLICA_MAX_RETRASO", "30"))     # con más retraso se lee de SQL Server (s)
+    REPLICA_DIAS_ATRAS = int(os.getenv("GESDEN_REPLICA_DIAS_ATRAS", "7"))        # ventana de DCitas vigilada por firma
+    REPLICA_DIAS_ADELANTE = int(os.getenv("GESDEN_REPLICA_DIAS_ADELANTE", "90"))
+    REPLICA_RECONCILIAR = int(os.getenv("GESDEN_REPLICA_RECONCILIAR", "300"))    # repaso de Pacientes borrados (s)
+    
     # Google Gemini API (GRATIS)
     GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY") or os.getenv("GOOGLE_API_KEY", "")
     
+    GEMINI_MODELO = os.getenv("GEMINI_MODELO", "gemini-2.0-flash-thinking-exp")
+    GEMINI_MAX_SESIONES = int(os.getenv("GEMINI_MAX_SESIONES", "50"))  # chats por usuario en memoria
+    GEMINI_SESION_IDLE = int(os.getenv("GEMINI_SESION_IDLE", "900"))   # descartar chat tras inactividad (s)
+    GEMINI_MAX_TURNOS = int(os.getenv("GEMINI_MAX_TURNOS", "20"))      # reiniciar chat tras N mensajes
+    GEMINI_MAX_RONDAS = int(os.getenv("GEMINI_MAX_RONDAS", "5"))       # rondas de herramientas por comando
+    GEMINI_MAX_EN_VUELO = int(os.getenv("GEMINI_MAX_EN_VUELO", "4"))   # comandos hablando con Gemini a la vez
+    GEMINI_MAX_COLA = int(os.getenv("GEMINI_MAX_COLA", "20"))          # en espera de turno (más -> 503)
+    GEMINI_PLAZO = float(os.getenv("GEMINI_PLAZO", "60"))              # plazo máx. por comando, cola incluida (s)
+    ENRUTADOR_RAPIDO = os.getenv("GESDEN_ENRUTADOR_RAPIDO", "1") != "0"  # resolver comandos simples sin Gemini
+    COMANDO_CACHE_TTL = int(os.getenv("GESDEN_COMANDO_CACHE_TTL", "60"))     # respuestas de solo lectura (s, <= GESDEN_AGENDA_TTL)
+    COMANDO_CACHE_MAX = int(os.getenv("GESDEN_COMANDO_CACHE_MAX", "200"))    # respuestas en memoria (LRU)
+    
     # Debug
     print(f"🔑 GOOGLE_API_KEY leída: {GOOGLE_API_KEY[:20]}..." if GOOGLE_API_KEY else "❌ GOOGLE_API_KEY vacía")
     
@@ -68,6 +136,12 @@ class Config:
     # Seguridad
     SECRET_KEY = secrets.token_hex(16)
     
+    # Servidor HTTP (ver INICIAR SERVIDOR y gunicorn.conf.py)
+    API_HOST = os.getenv("API_HOST", "127.0.0.1")
+    API_PORT = int(os.getenv("API_PORT", "5000"))
+    API_SERVIDOR = os.getenv("API_SERVIDOR", "flask")   # flask (desarrollo) | waitress (producción)
+    API_HILOS = int(os.getenv("API_HILOS", "8"))        # hilos por proceso en producción
+    
     @classmethod
     def get_connection_string(cls):
         return (
@@ -76,6 +150,11 @@ class Config:
             f'DATABASE={cls.SQL_DATABASE};'
             f'Trusted_Connection=yes;'
         )
+    
+    @classmethod
+    def admite_fast_executemany(cls):
+        """fast_executemany solo es fiable con los drivers ODBC 1x de Microsoft"""
+        return re.fullmatch(r'ODBC Driver 1\d for SQL Server', cls.SQL_DRIVER) is not None
 
 # Configurar logging
 logging.basicConfig(
@@ -105,51 +184,483 @@ ALLOWED_ORIGINS = [
 ]
 CORS(app, origins=ALLOWED_ORIGINS, supports_credentials=True)
 
-# Cliente Gemini
+# Cliente Gemini (el modelo con herramientas se crea en MOTOR IA)
 api_key = Config.GOOGLE_API_KEY
+gemini_configurado = False
 if api_key:
     try:
         genai.configure(api_key=api_key)
-        gemini_model = genai.GenerativeModel(
-            'gemini-2.0-flash-thinking-exp',
-            tools='code_execution'
-        )
+        gemini_configurado = True
         logging.info("✅ Google Gemini 2.0 Flash Thinking configurado correctamente")
     except Exception as e:
-        gemini_model = None
         logging.error(f"❌ Error configurando Gemini: {e}")
 else:
-    gemini_model = None
     logging.error("❌ GOOGLE_API_KEY no está configurada")
 
 # =====================================================
-# UTILIDADES BASE DE DATOS
+# POOL DE CONEXIONES
 # =====================================================
 
-class GesdenDB:
-    """Manejador de base de datos Gesden"""
+class PoolAgotadoError(Exception):
+    """No se liberó ninguna conexión dentro del tiempo de espera"""
+
+
+class _ConexionPool:
+    """Conexión pyodbc con sus marcas de tiempo"""
+    
+    __slots__ = ('conn', 'creada', 'ultimo_uso')
+    
+    def __init__(self, conn):
+        self.conn = conn
+        self.creada = time.monotonic()
+        self.ultimo_uso = self.creada
+
+
+class PoolConexiones:
+    """
+    Pool thread-safe de conexiones pyodbc a GELITE.
+    
+    - Mantiene entre `min_size` y `max_size` conexiones abiertas
+    - Valida con SELECT 1 las conexiones que llevan tiempo sin usarse
+    - Recicla conexiones por inactividad (`max_idle`) o antigüedad (`max_edad`)
+    - Si todas están ocupadas espera como máximo `timeout` segundos
+    """
+    
+    def __init__(self, conn_string, min_size=2, max_size=10, timeout=5.0,
+                 max_idle=300, max_edad=1800, validar_tras=30):
+        self.conn_string = conn_string
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_edad = max_edad
+        self.validar_tras = validar_tras
+        
+        self._libres = deque()
+        self._en_uso = {}
+        self._total = 0
+        self._cond = threading.Condition()
+        self._cerrado = False
+        
+        self.stats = {
+            'checkouts': 0,
+            'esperas': 0,
+            'timeouts': 0,
+            'creadas': 0,
+            'reconexiones': 0,
+            'descartadas': 0,
+        }
+    
+    def _abrir(self):
+        conn = pyodbc.connect(self.conn_string, timeout=int(self.timeout) or 0)
+        return _ConexionPool(conn)
     
     @staticmethod
-    def ejecutar_query(sql, params=None):
-        """Ejecuta query SELECT y retorna resultados"""
+    def _cerrar_silencioso(entrada):
         try:
-            conn = pyodbc.connect(Config.get_connection_string())
-            cursor = conn.cursor()
+            entrada.conn.close()
+        except Exception:
+            pass
+    
+    def _caducada(self, entrada, ahora):
+        return (ahora - entrada.creada > self.max_edad or
+                ahora - entrada.ultimo_uso > self.max_idle)
+    
+    def _valida(self, entrada, ahora):
+        if ahora - entrada.ultimo_uso < self.validar_tras:
+            return True
+        try:
+            cursor = entrada.conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+    
+    def calentar(self):
+        """Abre conexiones hasta alcanzar min_size"""
+        while True:
+            with self._cond:
+                if self._cerrado or self._total >= self.min_size:
+                    return
+                self._total += 1
+            try:
+                entrada = self._abrir()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self.stats['creadas'] += 1
+                self._libres.append(entrada)
+                self._cond.notify()
+    
+    def obtener(self, timeout=None):
+        """Saca una conexión del pool (esperando si hace falta)"""
+        timeout = self.timeout if timeout is None else timeout
+        limite = time.monotonic() + timeout
+        
+        with self._cond:
+            if self._cerrado:
+                raise PoolAgotadoError("Pool de conexiones cerrado")
+            self.stats['checkouts'] += 1
+            ha_esperado = False
             
-            if params:
-                cursor.execute(sql, params)
+            while True:
+                if self._libres:
+                    entrada = self._libres.pop()
+                    break
+                if self._total < self.max_size:
+                    self._total += 1
+                    entrada = None
+                    break
+                
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolAgotadoError(
+                        f"Sin conexiones libres tras {timeout:.1f}s "
+                        f"({self._total}/{self.max_size} en uso)"
+                    )
+                if not ha_esperado:
+                    self.stats['esperas'] += 1
+                    ha_esperado = True
+                self._cond.wait(restante)
+        
+        # Validación/apertura fuera del lock para no bloquear a otros hilos
+        ahora = time.monotonic()
+        if entrada is not None and (self._caducada(entrada, ahora) or not self._valida(entrada, ahora)):
+            self._cerrar_silencioso(entrada)
+            entrada = None
+            with self._cond:
+                self.stats['reconexiones'] += 1
+        
+        if entrada is None:
+            try:
+                entrada = self._abrir()
+            except Exception:
+                with self._cond:
+                    self._total -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self.stats['creadas'] += 1
+        
+        with self._cond:
+            self._en_uso[id(entrada.conn)] = entrada
+        return entrada.conn
+    
+    def devolver(self, conn, descartar=False):
+        """Devuelve una conexión al pool (o la cierra si está rota)"""
+        with self._cond:
+            entrada = self._en_uso.pop(id(conn), None)
+        if entrada is None:
+            return
+        
+        if not descartar:
+            try:
+                conn.rollback()  # No dejar transacciones abiertas en el pool
+            except Exception:
+                descartar = True
+        
+        with self._cond:
+            if descartar or self._cerrado:
+                self._cerrar_silencioso(entrada)
+                self._total -= 1
+                self.stats['descartadas'] += 1
             else:
-                cursor.execute(sql)
+                entrada.ultimo_uso = time.monotonic()
+                self._libres.append(entrada)
+            self._cond.notify()
+    
+    @contextmanager
+    def conexion(self, timeout=None):
+        """Context manager: obtiene y devuelve una conexión"""
+        conn = self.obtener(timeout)
+        descartar = False
+        try:
+            yield conn
+        except pyodbc.Error:
+            # Si ni siquiera acepta rollback, la conexión está rota
+            try:
+                conn.rollback()
+            except Exception:
+                descartar = True
+            raise
+        finally:
+            self.devolver(conn, descartar=descartar)
+    
+    def cerrar(self):
+        """Cierra todas las conexiones libres y rechaza nuevos checkouts"""
+        with self._cond:
+            self._cerrado = True
+            while self._libres:
+                self._cerrar_silencioso(self._libres.pop())
+                self._total -= 1
+            self._cond.notify_all()
+    
+    def estadisticas(self):
+        """Estadísticas de uso del pool"""
+        with self._cond:
+            return dict(
+                self.stats,
+                abiertas=self._total,
+                libres=len(self._libres),
+                en_uso=len(self._en_uso),
+                min=self.min_size,
+                max=self.max_size,
+            )
+
+
+pool_gesden = PoolConexiones(
+    Config.get_connection_string(),
+    min_size=Config.POOL_MIN,
+    max_size=Config.POOL_MAX,
+    timeout=Config.POOL_TIMEOUT,
+    max_idle=Config.POOL_MAX_IDLE,
+    max_edad=Config.POOL_MAX_EDAD,
+    validar_tras=Config.POOL_VALIDAR_TRAS,
+)
+
+# =====================================================
+# MÉTRICAS (LATENCIA POR RUTA)
+# =====================================================
+
+# Límites de los histogramas en ms (acumulados al exportar, +Inf implícito)
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+COMPONENTES = ('total', 'db', 'llm', 'otro')
+
+# Medición de la petición en curso (cada petición la atiende un hilo)
+_medicion_actual = threading.local()
+
+
+class _Medicion:
+    """Tiempos acumulados de una petición"""
+    __slots__ = ('inicio', 'db_ms', 'llm_ms', 'db_llamadas', 'llm_llamadas', 'filas')
+    
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.db_ms = 0.0
+        self.llm_ms = 0.0
+        self.db_llamadas = 0
+        self.llm_llamadas = 0
+        self.filas = 0
+
+
+@contextmanager
+def medir(componente, contar=True):
+    """Suma a la petición en curso el tiempo del bloque ('db' o 'llm')"""
+    medicion = getattr(_medicion_actual, 'valor', None)
+    if medicion is None:
+        # Hilos de fondo (índice, vigilante): no pertenecen a ninguna ruta
+        yield
+        return
+    
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        if componente == 'db':
+            medicion.db_ms += ms
+            medicion.db_llamadas += contar
+        else:
+            medicion.llm_ms += ms
+            medicion.llm_llamadas += contar
+
+
+def contar_filas(n):
+    """Suma filas leídas de la BD a la petición en curso"""
+    medicion = getattr(_medicion_actual, 'valor', None)
+    if medicion is not None:
+        medicion.filas += n
+
+
+def _etiquetas(**valores):
+    """Etiquetas Prometheus escapadas: {a="x",b="y"}"""
+    partes = []
+    for clave, valor in valores.items():
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        partes.append(f'{clave}="{valor}"')
+    return '{' + ','.join(partes) + '}'
+
+
+class MetricasRutas:
+    """
+    Histogramas de latencia por ruta, separando el tiempo en
+    total / db (GesdenDB) / llm (Gemini) / otro (resto: Python, red, cliente).
+    """
+    
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self._rutas = {}  # (ruta, metodo) -> datos
+    
+    def _nueva_ruta(self):
+        return {
+            'peticiones': 0,
+            'estados': {},
+            'filas': 0,
+            'db_llamadas': 0,
+            'llm_llamadas': 0,
+            'cuentas': {c: [0] * (len(self.buckets) + 1) for c in COMPONENTES},
+            'suma_ms': dict.fromkeys(COMPONENTES, 0.0),
+            'max_ms': dict.fromkeys(COMPONENTES, 0.0),   # para percentiles en el bucket +Inf
+        }
+    
+    def registrar(self, ruta, metodo, estado, medicion):
+        """Añade una petición terminada"""
+        total = (time.perf_counter() - medicion.inicio) * 1000
+        valores = {
+            'total': total,
+            'db': medicion.db_ms,
+            'llm': medicion.llm_ms,
+            'otro': max(0.0, total - medicion.db_ms - medicion.llm_ms),
+        }
+        
+        with self.lock:
+            datos = self._rutas.get((ruta, metodo))
+            if datos is None:
+                datos = self._rutas[(ruta, metodo)] = self._nueva_ruta()
+            datos['peticiones'] += 1
+            datos['estados'][estado] = datos['estados'].get(estado, 0) + 1
+            datos['filas'] += medicion.filas
+            datos['db_llamadas'] += medicion.db_llamadas
+            datos['llm_llamadas'] += medicion.llm_llamadas
+            for componente, ms in valores.items():
+                datos['cuentas'][componente][bisect.bisect_left(self.buckets, ms)] += 1
+                datos['suma_ms'][componente] += ms
+                if ms > datos['max_ms'][componente]:
+                    datos['max_ms'][componente] = ms
+    
+    def _percentil(self, cuentas, p, maximo):
+        """
+        Límite superior del bucket que contiene el percentil p (aprox.). En el
+        bucket +Inf (más allá del último límite) devuelve el máximo observado.
+        """
+        objetivo = p / 100 * sum(cuentas)
+        acumulado = 0
+        for i, n in enumerate(cuentas):
+            acumulado += n
+            if n and acumulado >= objetivo:
+                return self.buckets[i] if i < len(self.buckets) else round(maximo, 1)
+        return 0
+    
+    def resumen(self):
+        """Resumen por ruta para /api/estado (medias, p50/p95/p99 y máximo en ms)"""
+        with self.lock:
+            resumen = {}
+            for (ruta, metodo), datos in sorted(self._rutas.items()):
+                n = datos['peticiones']
+                resumen[f"{metodo} {ruta}"] = {
+                    'peticiones': n,
+                    'errores': sum(v for k, v in datos['estados'].items() if k >= 500),
+                    'filas': datos['filas'],
+                    'media_ms': {c: round(datos['suma_ms'][c] / n, 1) for c in COMPONENTES},
+                    'p50_ms': self._percentil(datos['cuentas']['total'], 50, datos['max_ms']['total']),
+                    'p95_ms': self._percentil(datos['cuentas']['total'], 95, datos['max_ms']['total']),
+                    'p99_ms': self._percentil(datos['cuentas']['total'], 99, datos['max_ms']['total']),
+                    'max_ms': round(datos['max_ms']['total'], 1),
+                }
+            return resumen
+    
+    def prometheus(self):
+        """Líneas en formato de exposición de Prometheus"""
+        lineas = [
+            '# HELP gesden_peticion_segundos Latencia por ruta (componente: total, db, llm, otro)',
+            '# TYPE gesden_peticion_segundos histogram',
+        ]
+        with self.lock:
+            rutas = sorted(self._rutas.items())
+            for (ruta, metodo), datos in rutas:
+                for componente in COMPONENTES:
+                    acumulado = 0
+                    for i, n in enumerate(datos['cuentas'][componente]):
+                        acumulado += n
+                        le = f"{self.buckets[i] / 1000:g}" if i < len(self.buckets) else '+Inf'
+                        lineas.append('gesden_peticion_segundos_bucket' + _etiquetas(
+                            ruta=ruta, metodo=metodo, componente=componente, le=le) + f' {acumulado}')
+                    etiquetas = _etiquetas(ruta=ruta, metodo=metodo, componente=componente)
+                    lineas.append(f"gesden_peticion_segundos_sum{etiquetas} {datos['suma_ms'][componente] / 1000:.6f}")
+                    lineas.append(f"gesden_peticion_segundos_count{etiquetas} {acumulado}")
             
-            columns = [column[0] for column in cursor.description]
-            results = []
+            lineas += ['# HELP gesden_peticiones_total Peticiones por ruta y código HTTP',
+                       '# TYPE gesden_peticiones_total counter']
+            for (ruta, metodo), datos in rutas:
+                for estado, n in sorted(datos['estados'].items()):
+                    lineas.append('gesden_peticiones_total' + _etiquetas(
+                        ruta=ruta, metodo=metodo, estado=estado) + f' {n}')
             
-            for row in cursor.fetchall():
-                results.append(dict(zip(columns, row)))
+            lineas += ['# HELP gesden_filas_total Filas leídas de Gesden por ruta',
+                       '# TYPE gesden_filas_total counter']
+            for (ruta, metodo), datos in rutas:
+                lineas.append('gesden_filas_total' + _etiquetas(ruta=ruta, metodo=metodo) + f" {datos['filas']}")
             
-            cursor.close()
-            conn.close()
+            lineas += ['# HELP gesden_llamadas_total Llamadas a la BD y a Gemini por ruta',
+                       '# TYPE gesden_llamadas_total counter']
+            for (ruta, metodo), datos in rutas:
+                for destino in ('db', 'llm'):
+                    lineas.append('gesden_llamadas_total' + _etiquetas(
+                        ruta=ruta, metodo=metodo, destino=destino) + f" {datos[destino + '_llamadas']}")
+        return lineas
+
+
+metricas_rutas = MetricasRutas()
+
+
+@app.before_request
+def _iniciar_medicion():
+    _medicion_actual.valor = _Medicion()
+
+
+@app.after_request
+def _registrar_medicion(response):
+    medicion = getattr(_medicion_actual, 'valor', None)
+    if medicion is None:
+        return response
+    
+    # Plantilla de la ruta (no la URL) para no disparar la cardinalidad
+    ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+    metodo, estado = request.method, response.status_code
+    
+    def registrar():
+        # Al cerrar la respuesta: en streaming incluye el envío completo
+        _medicion_actual.valor = None
+        metricas_rutas.registrar(ruta, metodo, estado, medicion)
+    
+    response.call_on_close(registrar)
+    return response
+
+# =====================================================
+# UTILIDADES BASE DE DATOS
+# =====================================================
+
+class GesdenDB:
+    """Manejador de base de datos Gesden"""
+    
+    @staticmethod
+    def ejecutar_query(sql, params=None):
+        """Ejecuta query SELECT y retorna resultados"""
+        try:
+            with medir('db'), pool_gesden.conexion() as conn:
+                cursor = conn.cursor()
+                
+                if params:
+                    cursor.execute(sql, params)
+                else:
+                    cursor.execute(sql)
+                
+                columns = [column[0] for column in cursor.description]
+                results = []
+                
+                for row in cursor.fetchall():
+                    results.append(dict(zip(columns, row)))
+                
+                cursor.close()
             
+            contar_filas(len(results))
             return results
         
         except Exception as e:
@@ -160,17 +671,16 @@ class GesdenDB:
     def ejecutar_insert(sql, params):
         """Ejecuta INSERT y retorna ID generado"""
         try:
-            conn = pyodbc.connect(Config.get_connection_string())
-            cursor = conn.cursor()
-            
-            cursor.execute(sql, params)
-            conn.commit()
-            
-            cursor.execute("SELECT @@IDENTITY")
-            id_generado = cursor.fetchone()[0]
-            
-            cursor.close()
-            conn.close()
+            with medir('db'), pool_gesden.conexion() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute(sql, params)
+                conn.commit()
+                
+                cursor.execute("SELECT @@IDENTITY")
+                id_generado = cursor.fetchone()[0]
+                
+                cursor.close()
             
             return int(id_generado)
         
@@ -178,89 +688,1327 @@ class GesdenDB:
             logging.error(f"Error en insert: {e}")
             raise
     
+    @staticmethod
+    def ejecutar_lote(sql, params=None):
+        """Ejecuta un lote con varios SELECT y retorna una lista de resultados (lista de dicts cada uno)"""
+        try:
+            with medir('db'), pool_gesden.conexion() as conn:
+                cursor = conn.cursor()
+                
+                if params:
+                    cursor.execute(sql, params)
+                else:
+                    cursor.execute(sql)
+                
+                resultados = []
+                while True:
+                    # Las sentencias sin filas (SET, DECLARE) no tienen description
+                    if cursor.description is not None:
+                        columns = [column[0] for column in cursor.description]
+                        resultados.append([dict(zip(columns, row)) for row in cursor.fetchall()])
+                    if not cursor.nextset():
+                        break
+                
+                cursor.close()
+            
+            contar_filas(sum(len(filas) for filas in resultados))
+            return resultados
+        
+        except Exception as e:
+            logging.error(f"Error en lote: {e}")
+            raise
+    
+    @staticmethod
+    def iterar_query(sql, params=None, lote=500):
+        """Generador de filas (dict) leídas en bloques con fetchmany"""
+        with pool_gesden.conexion() as conn:
+            cursor = conn.cursor()
+            try:
+                with medir('db'):
+                    if params:
+                        cursor.execute(sql, params)
+                    else:
+                        cursor.execute(sql)
+                
+                columns = [column[0] for column in cursor.description]
+                
+                while True:
+                    # Solo cuenta la lectura de cada bloque, no el tiempo del consumidor
+                    with medir('db', contar=False):
+                        filas = cursor.fetchmany(lote)
+                    if not filas:
+                        break
+                    contar_filas(len(filas))
+                    for row in filas:
+                        yield dict(zip(columns, row))
+            finally:
+                cursor.close()
+    
+    @staticmethod
+    def _usar_replica(fechas, id_centro):
+        """True si la lectura puede ir a la réplica: al día y, si lee DCitas, dentro de su ventana"""
+        if replica_gesden is None or not replica_gesden.al_dia():
+            return False
+        return fechas is None or replica_gesden.cubre(*fechas, id_centro=id_centro)
+    
+    @staticmethod
+    def ejecutar_lectura(sql, params=None, fechas=None, id_centro=None):
+        """
+        SELECT válido en SQL Server y SQLite: de la réplica local si está al día, si no de GELITE.
+        
+        `fechas` = (desde, hasta) Gesden de las DCitas que lee la consulta; fuera
+        de la ventana vigilada por la réplica se lee de SQL Server.
+        """
+        if GesdenDB._usar_replica(fechas, id_centro):
+            try:
+                with medir('db'):
+                    filas = replica_gesden.consultar(sql, params)
+                contar_filas(len(filas))
+                return filas
+            except Exception as e:
+                logging.warning(f"Réplica local no disponible, se lee de SQL Server: {e}")
+        return GesdenDB.ejecutar_query(sql, params)
+    
+    @staticmethod
+    def iterar_lectura(sql, params=None, lote=500, fechas=None, id_centro=None):
+        """Como iterar_query, pero desde la réplica local si está al día y cubre `fechas`"""
+        if GesdenDB._usar_replica(fechas, id_centro):
+            return replica_gesden.iterar(sql, params, lote)
+        return GesdenDB.iterar_query(sql, params, lote)
+    
+    @staticmethod
+    @contextmanager
+    def transaccion():
+        """Cursor dentro de una transacción: commit al salir, rollback si hay error"""
+        with medir('db'), pool_gesden.conexion() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Error en transacción (rollback): {e}")
+                raise
+            finally:
+                cursor.close()
+    
     @staticmethod
     def fecha_gesden_a_iso(fecha_int):
         """Convierte fecha Gesden a ISO"""
-        if not fecha_int:
-            return None
-        base_date = datetime(1899, 12, 30)
-        fecha = base_date + timedelta(days=fecha_int)
-        return fecha.strftime('%Y-%m-%d')
+        return gesden_codec.fecha_a_iso(fecha_int)
     
     @staticmethod
     def fecha_iso_a_gesden(fecha_iso):
         """Convierte fecha ISO a Gesden"""
-        fecha = datetime.strptime(fecha_iso, '%Y-%m-%d')
-        base_date = datetime(1899, 12, 30)
-        return (fecha - base_date).days
+        return gesden_codec.iso_a_fecha(fecha_iso)
     
     @staticmethod
     def hora_gesden_a_string(hora_int):
         """Convierte hora Gesden a HH:MM"""
-        if not hora_int:
-            return "00:00"
-        horas = hora_int // 10000
-        minutos = (hora_int % 10000) // 100
-        return f"{horas:02d}:{minutos:02d}"
+        return gesden_codec.hora_a_str(hora_int)
     
     @staticmethod
     def hora_string_a_gesden(hora_str):
         """Convierte HH:MM a formato Gesden"""
-        partes = hora_str.split(':')
-        return (int(partes[0]) * 10000) + (int(partes[1]) * 100)
+        return gesden_codec.str_a_hora(hora_str)
 
 # =====================================================
-# MOTOR IA CON CLAUDE
+# ÍNDICE DE BÚSQUEDA DE PACIENTES (EN MEMORIA)
 # =====================================================
 
-def procesar_con_ia(comando):
-    """Procesa comando con Gemini usando function calling"""
+_RE_TOKEN = re.compile(r'[a-z0-9]+')
+
+
+def normalizar_texto(texto):
+    """Minúsculas y sin tildes: 'JOSÉ Muñoz' -> 'jose munoz'"""
+    if not texto:
+        return ''
+    texto = unicodedata.normalize('NFKD', str(texto))
+    return ''.join(c for c in texto if not unicodedata.combining(c)).lower()
+
+
+def tokenizar(texto):
+    """Divide un texto normalizado en palabras"""
+    return _RE_TOKEN.findall(normalizar_texto(texto))
+
+
+class IndicePacientes:
+    """
+    Índice residente de Pacientes de un centro.
     
-    if not gemini_model:
-        return {"accion": "error", "mensaje": "⚠️ Gemini no configurado"}
+    - Índice de prefijos por palabra de Nombre/Apellidos (sin tildes ni mayúsculas)
+    - Acceso directo por NumPac
+    - Carga completa al arrancar y refresco incremental por _fechaModif
+      (y por IdPac para las altas hechas en Gesden sin _fechaModif)
+    - Repaso periódico de IdPac para quitar bajas y cambios de centro
+    """
     
-    try:
-        # Definir funciones para Gemini
-        def buscar_paciente_db(busqueda: str) -> dict:
-            """Busca pacientes por nombre, apellidos o número"""
-            return ejecutar_buscar_paciente(busqueda)
-        
-        def listar_citas_db(fecha: str) -> dict:
-            """Lista citas de una fecha (formato: 'hoy', 'mañana', o 'YYYY-MM-DD')"""
-            return ejecutar_listar_citas(fecha)
-        
-        def crear_cita_db(id_paciente: int, fecha: str, hora: str, motivo: str = "") -> dict:
-            """Crea una cita (fecha: YYYY-MM-DD, hora: HH:MM)"""
-            return ejecutar_crear_cita(id_paciente, fecha, hora, motivo)
-        
-        # Crear modelo con funciones
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-thinking-exp',
-            tools=[buscar_paciente_db, listar_citas_db, crear_cita_db]
+    COLUMNAS = "IdPac, NumPac, Nombre, Apellidos, TelMovil, Email, FecNacim, _fechaModif"
+    
+    def __init__(self, id_centro, intervalo=5, reconciliar=300):
+        self.id_centro = id_centro
+        self.intervalo = intervalo
+        self.reconciliar_cada = reconciliar
+        self.listo = False
+        
+        self._lock = threading.RLock()
+        self._pacientes = {}          # IdPac -> fila
+        self._por_numpac = {}         # NumPac -> IdPac
+        self._tokens = {}             # palabra -> {IdPac: peso}
+        self._tokens_ordenados = []   # palabras ordenadas (búsqueda por prefijo con bisect)
+        self._tokens_de = {}          # IdPac -> palabras indexadas
+        self._marca = None            # mayor _fechaModif visto
+        self._max_id = 0              # mayor IdPac visto (altas con _fechaModif NULL)
+        self._ultima_reconciliacion = time.monotonic()
+        
+        self._parar = threading.Event()
+        self._hilo = None
+        
+        self.stats = {'busquedas': 0, 'refrescos': 0, 'actualizados': 0, 'cambios': 0,
+                      'reconciliaciones': 0, 'eliminados': 0}
+        self.al_cambiar = []          # funciones a avisar cuando cambian datos de pacientes
+    
+    @staticmethod
+    def _preparar(fila):
+        """Deja la fila lista para devolverla en la API"""
+        fila = dict(fila)
+        fila.pop('_fechaModif', None)
+        if fila.get('FecNacim'):
+            try:
+                fila['FecNacim'] = GesdenDB.fecha_gesden_a_iso(fila['FecNacim'])
+            except:
+                fila['FecNacim'] = None
+        return fila
+    
+    def _quitar(self, id_pac):
+        fila = self._pacientes.pop(id_pac, None)
+        if fila is None:
+            return
+        if self._por_numpac.get(fila.get('NumPac')) == id_pac:
+            del self._por_numpac[fila['NumPac']]
+        for token in self._tokens_de.pop(id_pac, ()):
+            ids = self._tokens.get(token)
+            if ids is None:
+                continue
+            ids.pop(id_pac, None)
+            if not ids:
+                del self._tokens[token]
+                i = bisect.bisect_left(self._tokens_ordenados, token)
+                if i < len(self._tokens_ordenados) and self._tokens_ordenados[i] == token:
+                    del self._tokens_ordenados[i]
+    
+    def _indexar(self, fila, ordenar=True):
+        id_pac = fila['IdPac']
+        self._quitar(id_pac)
+        
+        self._pacientes[id_pac] = self._preparar(fila)
+        if fila.get('NumPac') is not None:
+            self._por_numpac[fila['NumPac']] = id_pac
+        
+        # Las palabras del apellido pesan más: es como busca la recepción
+        pesos = {}
+        for token in tokenizar(fila.get('Nombre')):
+            pesos[token] = max(pesos.get(token, 0), 1)
+        for token in tokenizar(fila.get('Apellidos')):
+            pesos[token] = 2
+        
+        for token, peso in pesos.items():
+            ids = self._tokens.get(token)
+            if ids is None:
+                ids = self._tokens[token] = {}
+                if ordenar:
+                    bisect.insort(self._tokens_ordenados, token)
+            ids[id_pac] = peso
+        self._tokens_de[id_pac] = tuple(pesos)
+    
+    def cargar(self):
+        """Carga completa de Pacientes del centro"""
+        filas = GesdenDB.ejecutar_query(
+            f"SELECT {self.COLUMNAS} FROM Pacientes WHERE IdCentro = ?",
+            (self.id_centro,)
         )
         
-        # Iniciar chat
-        chat = model.start_chat(enable_automatic_function_calling=True)
+        with self._lock:
+            self._pacientes.clear()
+            self._por_numpac.clear()
+            self._tokens.clear()
+            self._tokens_de.clear()
+            self._marca = None
+            self._max_id = 0
+            
+            for fila in filas:
+                self._indexar(fila, ordenar=False)
+                self._avanzar_marca(fila.get('_fechaModif'), fila['IdPac'])
+            self._tokens_ordenados = sorted(self._tokens)
+            self._ultima_reconciliacion = time.monotonic()
+            self.listo = True
         
-        # Enviar mensaje
-        system_msg = f"""Eres Rubito, asistente virtual de Rubio Garcia Dental.
-Fecha actual: {datetime.now().strftime('%d/%m/%Y %A')}
+        logging.info(f"✅ Índice de pacientes cargado: {len(filas)} pacientes")
+    
+    def _avanzar_marca(self, fecha_modif, id_pac=None):
+        if fecha_modif is not None and (self._marca is None or fecha_modif > self._marca):
+            self._marca = fecha_modif
+        if id_pac is not None and id_pac > self._max_id:
+            self._max_id = id_pac
+    
+    def _incorporar(self, filas):
+        """Indexa filas leídas de Pacientes. Devuelve cuántas cambiaron de verdad"""
+        cambios = 0
+        with self._lock:
+            for fila in filas:
+                # Con >= siempre vuelven las filas de la última marca: solo cuenta lo distinto
+                if self._preparar(fila) != self._pacientes.get(fila['IdPac']):
+                    cambios += 1
+                self._indexar(fila)
+                self._avanzar_marca(fila.get('_fechaModif'), fila['IdPac'])
+        return cambios
+    
+    def _avisar(self):
+        for funcion in self.al_cambiar:
+            funcion()
+    
+    def refrescar(self):
+        """Incorpora los pacientes creados/modificados desde la última marca"""
+        if not self.listo:
+            return self.cargar()
+        
+        # >= para no perder filas con la misma marca de tiempo (reindexar es idempotente).
+        # Las altas hechas en Gesden pueden no tener _fechaModif: esas entran por IdPac
+        if self._marca is None:
+            filas = GesdenDB.ejecutar_query(
+                f"SELECT {self.COLUMNAS} FROM Pacientes "
+                f"WHERE IdCentro = ? AND (_fechaModif IS NOT NULL OR IdPac > ?)",
+                (self.id_centro, self._max_id)
+            )
+        else:
+            filas = GesdenDB.ejecutar_query(
+                f"SELECT {self.COLUMNAS} FROM Pacientes "
+                f"WHERE IdCentro = ? AND (_fechaModif >= ? OR (_fechaModif IS NULL AND IdPac > ?))",
+                (self.id_centro, self._marca, self._max_id)
+            )
+        
+        cambios = self._incorporar(filas)
+        with self._lock:
+            self.stats['refrescos'] += 1
+            self.stats['actualizados'] += len(filas)
+            self.stats['cambios'] += cambios
+        
+        if time.monotonic() - self._ultima_reconciliacion >= self.reconciliar_cada:
+            cambios += self.reconciliar()
+        
+        if cambios:
+            self._avisar()
+    
+    def reconciliar(self, lote=500):
+        """
+        Repaso barato solo de claves (IdPac del centro): quita los pacientes
+        borrados o que han cambiado de centro y carga los que faltan (p.ej.
+        llegados de otro centro con _fechaModif NULL). Devuelve cuántos cambió.
+        """
+        ids_actuales = {fila['IdPac'] for fila in GesdenDB.ejecutar_query(
+            "SELECT IdPac FROM Pacientes WHERE IdCentro = ?", (self.id_centro,)
+        )}
+        
+        with self._lock:
+            sobran = [id_pac for id_pac in self._pacientes if id_pac not in ids_actuales]
+            for id_pac in sobran:
+                self._quitar(id_pac)
+            faltan = sorted(ids_actuales.difference(self._pacientes))
+            self._ultima_reconciliacion = time.monotonic()
+            self.stats['reconciliaciones'] += 1
+            self.stats['eliminados'] += len(sobran)
+        
+        cambios = len(sobran)
+        for i in range(0, len(faltan), lote):
+            bloque = faltan[i:i + lote]
+            cambios += self._incorporar(GesdenDB.ejecutar_query(
+                f"SELECT {self.COLUMNAS} FROM Pacientes WHERE IdPac IN ({', '.join('?' * len(bloque))})",
+                tuple(bloque)
+            ))
+        
+        if sobran or faltan:
+            logging.info(f"🔄 Índice de pacientes reconciliado: -{len(sobran)} +{len(faltan)}")
+        return cambios
+    
+    def _bucle_refresco(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                self.refrescar()
+            except Exception as e:
+                logging.error(f"Error refrescando índice de pacientes: {e}")
+    
+    def iniciar_refresco(self):
+        """Arranca el hilo de refresco incremental"""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle_refresco, name='indice-pacientes', daemon=True)
+        self._hilo.start()
+    
+    def detener(self):
+        self._parar.set()
+    
+    def buscar(self, texto, limite=20):
+        """Busca por NumPac o por palabras de nombre/apellidos (prefijos, en cualquier orden)"""
+        texto = (texto or '').strip()
+        
+        with self._lock:
+            self.stats['busquedas'] += 1
+            
+            if texto.isdigit():
+                id_pac = self._por_numpac.get(int(texto))
+                return [dict(self._pacientes[id_pac])] if id_pac is not None else []
+            
+            consulta = tokenizar(texto)
+            if not consulta:
+                return []
+            
+            puntos = None
+            for token in consulta:
+                coincidencias = {}
+                i = bisect.bisect_left(self._tokens_ordenados, token)
+                while i < len(self._tokens_ordenados) and self._tokens_ordenados[i].startswith(token):
+                    palabra = self._tokens_ordenados[i]
+                    exacta = 2 if palabra == token else 1
+                    for id_pac, peso in self._tokens[palabra].items():
+                        valor = peso * exacta
+                        if valor > coincidencias.get(id_pac, 0):
+                            coincidencias[id_pac] = valor
+                    i += 1
+                
+                # Todas las palabras buscadas deben aparecer
+                if puntos is None:
+                    puntos = coincidencias
+                else:
+                    puntos = {id_pac: puntos[id_pac] + valor
+                              for id_pac, valor in coincidencias.items() if id_pac in puntos}
+                if not puntos:
+                    return []
+            
+            ranking = sorted(
+                puntos.items(),
+                key=lambda par: (-par[1],
+                                 self._pacientes[par[0]].get('Apellidos') or '',
+                                 self._pacientes[par[0]].get('Nombre') or '')
+            )
+            return [dict(self._pacientes[id_pac]) for id_pac, _ in ranking[:limite]]
+    
+    def estadisticas(self):
+        with self._lock:
+            return dict(self.stats, pacientes=len(self._pacientes),
+                        palabras=len(self._tokens), listo=self.listo,
+                        marca=self._marca.isoformat() if hasattr(self._marca, 'isoformat') else self._marca)
+
+
+indice_pacientes = IndicePacientes(Config.ID_CENTRO, intervalo=Config.INDICE_REFRESCO_SEG,
+                                   reconciliar=Config.INDICE_RECONCILIAR_SEG)
+
+
+def buscar_pacientes_bd(busqueda, limite=20):
+    """Busca pacientes en el índice residente (o en SQL Server si aún no está cargado)"""
+    if indice_pacientes.listo:
+        return indice_pacientes.buscar(busqueda, limite)
+    
+    if busqueda.isdigit():
+        sql = """
+            SELECT TOP 20 IdPac, NumPac, Nombre, Apellidos, TelMovil, Email, FecNacim
+            FROM Pacientes
+            WHERE NumPac = ? AND IdCentro = ?
+        """
+        params = (int(busqueda), Config.ID_CENTRO)
+    else:
+        sql = """
+            SELECT TOP 20 IdPac, NumPac, Nombre, Apellidos, TelMovil, Email, FecNacim
+            FROM Pacientes
+            WHERE (Nombre LIKE ? OR Apellidos LIKE ?) AND IdCentro = ?
+            ORDER BY Apellidos, Nombre
+        """
+        params = (f'%{busqueda}%', f'%{busqueda}%', Config.ID_CENTRO)
+    
+    pacientes = GesdenDB.ejecutar_query(sql, params)
+    
+    for p in pacientes:
+        if p.get('FecNacim'):
+            try:
+                p['FecNacim'] = GesdenDB.fecha_gesden_a_iso(p['FecNacim'])
+            except:
+                p['FecNacim'] = None  # Si falla, poner null
+    
+    return pacientes
+
+# =====================================================
+# CACHÉ DE AGENDA
+# =====================================================
+
+class CacheLRU:
+    """Caché thread-safe con caducidad (TTL) y desalojo LRU"""
+    
+    def __init__(self, max_entradas=64, ttl=60):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._datos = OrderedDict()   # clave -> (caduca, valor)
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidaciones': 0, 'desalojos': 0}
+        self.al_invalidar = []        # funciones a avisar cuando se invalida (datos cambiados)
+    
+    def get(self, clave):
+        """Devuelve el valor o None si no está o ha caducado"""
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None or entrada[0] < time.monotonic():
+                if entrada is not None:
+                    del self._datos[clave]
+                self.stats['misses'] += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.stats['hits'] += 1
+            return entrada[1]
+    
+    def put(self, clave, valor, ttl=None):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + (self.ttl if ttl is None else ttl), valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+                self.stats['desalojos'] += 1
+    
+    def _avisar(self):
+        # Fuera del lock: los avisados pueden tocar sus propias cachés
+        for funcion in self.al_invalidar:
+            funcion()
+    
+    # Solo se avisa a al_invalidar si de verdad se quitó algo
+    
+    def invalidar(self, clave):
+        with self._lock:
+            quitada = self._datos.pop(clave, None) is not None
+            if quitada:
+                self.stats['invalidaciones'] += 1
+        if quitada:
+            self._avisar()
+    
+    def invalidar_si(self, condicion, avisar_siempre=False):
+        """
+        Invalida todas las entradas cuya clave cumpla `condicion(clave)`.
+        avisar_siempre: el dato cambió aunque no estuviera en caché (avisa igual, una vez)
+        """
+        with self._lock:
+            claves = [c for c in self._datos if condicion(c)]
+            for clave in claves:
+                del self._datos[clave]
+            self.stats['invalidaciones'] += len(claves)
+        if claves or avisar_siempre:
+            self._avisar()
+        return len(claves)
+    
+    def limpiar(self):
+        with self._lock:
+            n = len(self._datos)
+            self.stats['invalidaciones'] += n
+            self._datos.clear()
+        if n:
+            self._avisar()
+    
+    def claves(self):
+        with self._lock:
+            return list(self._datos)
+    
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.stats['hits'] + self.stats['misses']
+            return dict(
+                self.stats,
+                entradas=len(self._datos),
+                max_entradas=self.max_entradas,
+                ttl=self.ttl,
+                ratio_hits=round(self.stats['hits'] / consultas, 3) if consultas else 0.0,
+            )
+
+
+# (IdCentro, fecha Gesden) -> citas del día ya convertidas
+cache_agenda = CacheLRU(max_entradas=Config.AGENDA_CACHE_MAX, ttl=Config.AGENDA_CACHE_TTL)
+
+
+def obtener_citas_dia(fecha_gesden, id_centro=None):
+    """Citas de un día con Fecha ISO y HoraFormato HH:MM (desde la caché si es posible)"""
+    id_centro = Config.ID_CENTRO if id_centro is None else id_centro
+    clave = (id_centro, fecha_gesden)
+    
+    citas = cache_agenda.get(clave)
+    if citas is None:
+        sql = """
+            SELECT c.IdCita, c.Fecha, c.Hora, c.Duracion, c.Texto,
+                   p.NumPac, p.Nombre, p.Apellidos, p.TelMovil
+            FROM DCitas c
+            LEFT JOIN Pacientes p ON c.IdPac = p.IdPac
+            WHERE c.Fecha = ? AND c.IdCentro = ?
+            ORDER BY c.Hora
+        """
+        
+        citas = GesdenDB.ejecutar_lectura(sql, (fecha_gesden, id_centro),
+                                          fechas=(fecha_gesden, fecha_gesden), id_centro=id_centro)
+        gesden_codec.convertir_columnas(citas, fechas=['Fecha'], horas=[('Hora', 'HoraFormato')])
+        
+        cache_agenda.put(clave, citas)
+    
+    # Copias: los llamantes modifican las filas para su formato de respuesta
+    return [dict(cita) for cita in citas]
+
+
+class VigilanteAgenda:
+    """
+    Detecta cambios en DCitas hechos desde Gesden escritorio e invalida la caché.
+    
+    Para los días cacheados calcula una firma (COUNT + CHECKSUM_AGG) en una
+    sola consulta; si la firma de un día cambia, se invalida ese día.
+    """
+    
+    def __init__(self, cache, intervalo=10):
+        self.cache = cache
+        self.intervalo = intervalo
+        self._firmas = {}
+        self._parar = threading.Event()
+        self._hilo = None
+        self.stats = {'comprobaciones': 0, 'cambios_detectados': 0}
+    
+    def comprobar(self):
+        """Compara la firma actual de los días cacheados con la anterior"""
+        por_centro = {}
+        for id_centro, fecha in self.cache.claves():
+            por_centro.setdefault(id_centro, []).append(fecha)
+        
+        vigentes = set()
+        for id_centro, fechas in por_centro.items():
+            marcas = ', '.join('?' * len(fechas))
+            filas = GesdenDB.ejecutar_query(
+                f"""
+                SELECT Fecha, COUNT(*) AS Total,
+                       CHECKSUM_AGG(BINARY_CHECKSUM(IdCita, IdPac, IdUsu, Hora, Duracion, IdSitC)) AS Firma
+                FROM DCitas
+                WHERE IdCentro = ? AND Fecha IN ({marcas})
+                GROUP BY Fecha
+                """,
+                (id_centro, *fechas)
+            )
+            actuales = {fila['Fecha']: (fila['Total'], fila['Firma']) for fila in filas}
+            
+            for fecha in fechas:
+                clave = (id_centro, fecha)
+                firma = actuales.get(fecha, (0, None))
+                anterior = self._firmas.get(clave)
+                if anterior is not None and anterior != firma:
+                    self.cache.invalidar(clave)
+                    self.stats['cambios_detectados'] += 1
+                self._firmas[clave] = firma
+                vigentes.add(clave)
+        
+        # Olvidar firmas de días que ya no están en caché
+        for clave in list(self._firmas):
+            if clave not in vigentes:
+                del self._firmas[clave]
+        self.stats['comprobaciones'] += 1
+    
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                self.comprobar()
+            except Exception as e:
+                logging.error(f"Error vigilando cambios en DCitas: {e}")
+    
+    def iniciar(self):
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle, name='vigilante-agenda', daemon=True)
+        self._hilo.start()
+    
+    def detener(self):
+        self._parar.set()
+
+
+vigilante_agenda = VigilanteAgenda(cache_agenda, intervalo=Config.AGENDA_VIGILANCIA_SEG)
+
+# =====================================================
+# RÉPLICA LOCAL DE LECTURA (SQLITE)
+# =====================================================
+
+# Las lecturas de agenda, huecos y colaboradores usan GesdenDB.ejecutar_lectura /
+# iterar_lectura (DCitas solo dentro de la ventana vigilada); las escrituras
+# siguen yendo a GELITE. Con varios workers solo uno sincroniza el fichero.
+replica_gesden = ReplicaGesden(
+    Config.REPLICA_RUTA,
+    iterar=GesdenDB.iterar_query,
+    consultar=GesdenDB.ejecutar_query,
+    id_centro=Config.ID_CENTRO,
+    intervalo=Config.REPLICA_INTERVALO,
+    max_retraso=Config.REPLICA_MAX_RETRASO,
+    dias_atras=Config.REPLICA_DIAS_ATRAS,
+    dias_adelante=Config.REPLICA_DIAS_ADELANTE,
+    reconciliar=Config.REPLICA_RECONCILIAR,
+) if Config.REPLICA_ACTIVA else None
+
+
+def _invalidar_dias_agenda(fechas):
+    """Días con citas cambiadas: fuera de la caché y un único aviso a las cachés que dependen de la agenda"""
+    claves = {(Config.ID_CENTRO, fecha) for fecha in fechas}
+    if claves:
+        cache_agenda.invalidar_si(lambda clave: clave in claves, avisar_siempre=True)
+
+
+if replica_gesden is not None:
+    replica_gesden.al_cambiar_citas.append(_invalidar_dias_agenda)
+
+
+def citas_modificadas(fechas):
+    """Tras escribir en DCitas: trae las altas a la réplica e invalida esos días en caché"""
+    if replica_gesden is not None:
+        replica_gesden.sincronizar_citas()
+    _invalidar_dias_agenda(fechas)
+
+
+# =====================================================
+# BUSCADOR DE HUECOS LIBRES
+# =====================================================
+
+def _minutos(hora_gesden):
+    """Hora Gesden (HHMMSS) -> minutos desde medianoche"""
+    hora_gesden = hora_gesden or 0
+    return (hora_gesden // 10000) * 60 + (hora_gesden % 10000) // 100
+
+
+def _hhmm(minutos):
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+
+def _parsear_jornada(texto):
+    """'09:00-14:00,16:00-20:00' -> [(540, 840), (960, 1200)]"""
+    tramos = []
+    for tramo in texto.split(','):
+        inicio, fin = tramo.strip().split('-')
+        tramos.append((_minutos(GesdenDB.hora_string_a_gesden(inicio)),
+                       _minutos(GesdenDB.hora_string_a_gesden(fin))))
+    return sorted(tramos)
+
+
+def calcular_huecos(ocupadas, jornada, duracion, desde_minuto=0):
+    """
+    Huecos libres de al menos `duracion` minutos dentro de la jornada.
+    
+    ocupadas: lista de intervalos (inicio, fin) en minutos, en cualquier orden.
+    Ordena y recorre una sola vez: O(n log n).
+    """
+    ocupadas = sorted(ocupadas)
+    huecos = []
+    i = 0
+    for inicio_tramo, fin_tramo in jornada:
+        cursor = max(inicio_tramo, desde_minuto)
+        # Saltar citas que terminan antes de este tramo
+        while i < len(ocupadas) and ocupadas[i][1] <= cursor:
+            i += 1
+        j = i
+        while cursor < fin_tramo:
+            if j < len(ocupadas) and ocupadas[j][0] < fin_tramo:
+                inicio_cita, fin_cita = ocupadas[j]
+                if inicio_cita - cursor >= duracion:
+                    huecos.append((cursor, inicio_cita))
+                cursor = max(cursor, fin_cita)
+                j += 1
+            else:
+                if fin_tramo - cursor >= duracion:
+                    huecos.append((cursor, fin_tramo))
+                break
+    return huecos
+
+
+def buscar_huecos(desde_iso, hasta_iso=None, duracion=30, colaboradores=None, maximo=5):
+    """
+    Primeros `maximo` huecos libres de al menos `duracion` minutos.
+    
+    Carga las citas del rango en una sola consulta. Con colaboradores
+    (DCitas.IdUsu) calcula huecos por colaborador; sin ellos, la agenda
+    del centro se trata como una sola.
+    """
+    fecha_desde = GesdenDB.fecha_iso_a_gesden(desde_iso)
+    fecha_hasta = GesdenDB.fecha_iso_a_gesden(hasta_iso) if hasta_iso else fecha_desde + Config.HUECOS_DIAS
+    
+    sql = """
+        SELECT Fecha, Hora, Duracion, IdUsu
+        FROM DCitas
+        WHERE Fecha BETWEEN ? AND ? AND IdCentro = ?
+    """
+    params = [fecha_desde, fecha_hasta, Config.ID_CENTRO]
+    if colaboradores:
+        sql += f" AND IdUsu IN ({', '.join('?' * len(colaboradores))})"
+        params.extend(colaboradores)
+    
+    ocupadas = {}
+    for cita in GesdenDB.ejecutar_lectura(sql, params, fechas=(fecha_desde, fecha_hasta)):
+        inicio = _minutos(cita['Hora'])
+        clave = (cita['Fecha'], cita['IdUsu'] if colaboradores else None)
+        ocupadas.setdefault(clave, []).append((inicio, inicio + (cita['Duracion'] or 0)))
+    
+    jornada = _parsear_jornada(Config.HUECOS_JORNADA)
+    agendas = colaboradores or [None]
+    ahora = datetime.now()
+    hoy = GesdenDB.fecha_iso_a_gesden(ahora.strftime('%Y-%m-%d'))
+    
+    huecos = []
+    for fecha in range(max(fecha_desde, hoy), fecha_hasta + 1):
+        fecha_iso = GesdenDB.fecha_gesden_a_iso(fecha)
+        if datetime.strptime(fecha_iso, '%Y-%m-%d').weekday() not in Config.HUECOS_DIAS_LABORABLES:
+            continue
+        desde_minuto = ahora.hour * 60 + ahora.minute if fecha == hoy else 0
+        
+        del_dia = []
+        for id_usu in agendas:
+            for inicio, fin in calcular_huecos(ocupadas.get((fecha, id_usu), []), jornada, duracion, desde_minuto):
+                del_dia.append((inicio, id_usu, fin))
+        
+        for inicio, id_usu, fin in sorted(del_dia, key=lambda h: (h[0], h[1] or 0)):
+            hueco = {'fecha': fecha_iso, 'hora': _hhmm(inicio), 'hasta': _hhmm(fin), 'minutos': fin - inicio}
+            if id_usu is not None:
+                hueco['id_colaborador'] = id_usu
+            huecos.append(hueco)
+            if len(huecos) >= maximo:
+                return huecos
+    
+    return huecos
+
+# =====================================================
+# PLANIFICADOR DE LLAMADAS A GEMINI
+# =====================================================
+
+PRIORIDADES_IA = {'interactiva': 0, 'lote': 10}   # menor = antes
+
+
+class ColaIALlenaError(Exception):
+    """No hay sitio en la cola de Gemini, o se agotó el plazo esperando turno"""
+    
+    def __init__(self, mensaje, reintentar_en):
+        super().__init__(mensaje)
+        self.reintentar_en = reintentar_en
+
+
+class PlazoIAExcedidoError(Exception):
+    """El comando superó su plazo mientras hablaba con Gemini"""
+
+
+class _TurnoIA:
+    """Hueco concedido por el planificador; se libera una sola vez"""
+    
+    def __init__(self, planificador, limite):
+        self.planificador = planificador
+        self.limite = limite              # time.monotonic() máximo del comando
+        self.inicio = time.monotonic()
+        self.liberado = False
+    
+    def tiempo_restante(self):
+        """Segundos que quedan de plazo (PlazoIAExcedidoError si ya no queda)"""
+        restante = self.limite - time.monotonic()
+        if restante <= 0:
+            self.planificador._contar('plazos_en_curso')
+            raise PlazoIAExcedidoError("Plazo agotado esperando a Gemini")
+        return restante
+    
+    def liberar(self):
+        self.planificador._liberar(self)
+
+
+class PlanificadorIA:
+    """
+    Limita las conversaciones simultáneas con Gemini.
+    
+    - Como mucho `max_en_vuelo` a la vez; el resto espera por prioridad
+      (recepción antes que lotes) y, a igual prioridad, por orden de llegada
+    - Con `max_cola` esperando, las nuevas se rechazan (503 + Retry-After)
+    - Cada comando tiene un plazo total, cola incluida
+    """
+    
+    def __init__(self, max_en_vuelo=4, max_cola=20, plazo=60):
+        self.max_en_vuelo = max_en_vuelo
+        self.max_cola = max_cola
+        self.plazo = plazo
+        
+        self._cond = threading.Condition()
+        self._cola = []                   # heap de [prioridad, orden]
+        self._orden = itertools.count()
+        self._en_vuelo = 0
+        self._duracion_media = 5.0        # s por comando (media móvil), para Retry-After
+        
+        self.stats = {
+            'admitidas': 0, 'interactivas': 0, 'lote': 0, 'rechazadas': 0,
+            'plazos_en_cola': 0, 'plazos_en_curso': 0, 'espera_total_ms': 0.0, 'espera_max_ms': 0.0,
+        }
+    
+    def _contar(self, clave):
+        with self._cond:
+            self.stats[clave] += 1
+    
+    def _estimar_espera(self):
+        """Segundos aproximados hasta que haya hueco (para Retry-After)"""
+        return max(1, math.ceil(self._duracion_media * (len(self._cola) + 1) / self.max_en_vuelo))
+    
+    def adquirir(self, prioridad='interactiva', plazo=None):
+        """Espera turno y devuelve un _TurnoIA (hay que liberarlo)"""
+        plazo = self.plazo if plazo is None else min(float(plazo), self.plazo)
+        limite = time.monotonic() + plazo
+        t0 = time.monotonic()
+        
+        with self._cond:
+            if self._cola or self._en_vuelo >= self.max_en_vuelo:
+                if len(self._cola) >= self.max_cola:
+                    self.stats['rechazadas'] += 1
+                    raise ColaIALlenaError("Asistente saturado, inténtalo en unos segundos",
+                                           self._estimar_espera())
+                
+                entrada = [PRIORIDADES_IA.get(prioridad, 0), next(self._orden)]
+                heapq.heappush(self._cola, entrada)
+                while self._cola[0] is not entrada or self._en_vuelo >= self.max_en_vuelo:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._cola.remove(entrada)
+                        heapq.heapify(self._cola)
+                        self._cond.notify_all()   # puede haber cambiado la cabeza de la cola
+                        self.stats['plazos_en_cola'] += 1
+                        raise ColaIALlenaError("Plazo agotado esperando turno para el asistente",
+                                               self._estimar_espera())
+                    self._cond.wait(restante)
+                heapq.heappop(self._cola)
+                self._cond.notify_all()           # la nueva cabeza puede entrar si queda hueco
+            
+            self._en_vuelo += 1
+            espera_ms = (time.monotonic() - t0) * 1000
+            self.stats['admitidas'] += 1
+            self.stats['lote' if prioridad == 'lote' else 'interactivas'] += 1
+            self.stats['espera_total_ms'] += espera_ms
+            self.stats['espera_max_ms'] = max(self.stats['espera_max_ms'], espera_ms)
+        
+        return _TurnoIA(self, limite)
+    
+    def _liberar(self, turno):
+        with self._cond:
+            if turno.liberado:
+                return
+            turno.liberado = True
+            self._en_vuelo -= 1
+            duracion = time.monotonic() - turno.inicio
+            self._duracion_media = 0.8 * self._duracion_media + 0.2 * duracion
+            self._cond.notify_all()
+    
+    @contextmanager
+    def turno(self, prioridad='interactiva', plazo=None):
+        turno = self.adquirir(prioridad, plazo)
+        try:
+            yield turno
+        finally:
+            turno.liberar()
+    
+    def estadisticas(self):
+        """Profundidad de cola, esperas y rechazos"""
+        with self._cond:
+            admitidas = self.stats['admitidas']
+            return dict(
+                self.stats,
+                espera_total_ms=round(self.stats['espera_total_ms'], 1),
+                espera_max_ms=round(self.stats['espera_max_ms'], 1),
+                espera_media_ms=round(self.stats['espera_total_ms'] / admitidas, 1) if admitidas else 0.0,
+                duracion_media_ms=round(self._duracion_media * 1000, 1),
+                en_vuelo=self._en_vuelo,
+                en_cola=len(self._cola),
+                max_en_vuelo=self.max_en_vuelo,
+                max_cola=self.max_cola,
+                plazo=self.plazo,
+            )
+
+
+planificador_ia = PlanificadorIA(
+    max_en_vuelo=Config.GEMINI_MAX_EN_VUELO,
+    max_cola=Config.GEMINI_MAX_COLA,
+    plazo=Config.GEMINI_PLAZO,
+)
+
+# =====================================================
+# MOTOR IA CON CLAUDE
+# =====================================================
+
+# Herramientas que Gemini puede invocar (se declaran una sola vez al arrancar)
+def buscar_paciente_db(busqueda: str) -> dict:
+    """Busca pacientes por nombre, apellidos o número"""
+    return ejecutar_buscar_paciente(busqueda)
+
+
+def listar_citas_db(fecha: str) -> dict:
+    """Lista citas de una fecha (formato: 'hoy', 'mañana', o 'YYYY-MM-DD')"""
+    return ejecutar_listar_citas(fecha)
+
+
+def crear_cita_db(id_paciente: int, fecha: str, hora: str, motivo: str = "") -> dict:
+    """Crea una cita (fecha: YYYY-MM-DD, hora: HH:MM)"""
+    return ejecutar_crear_cita(id_paciente, fecha, hora, motivo)
+
+
+def buscar_huecos_db(fecha_desde: str, fecha_hasta: str = "", duracion: int = 30,
+                     id_colaborador: int = 0, max_huecos: int = 5) -> dict:
+    """Busca los primeros huecos libres de al menos `duracion` minutos (fechas: YYYY-MM-DD; id_colaborador 0 = cualquiera)"""
+    try:
+        huecos = buscar_huecos(
+            fecha_desde, fecha_hasta or None, duracion,
+            [id_colaborador] if id_colaborador else None, max_huecos
+        )
+        return {"huecos": huecos, "total": len(huecos)}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+HERRAMIENTAS_GEMINI = [buscar_paciente_db, listar_citas_db, crear_cita_db, buscar_huecos_db]
+HERRAMIENTAS_POR_NOMBRE = {funcion.__name__: funcion for funcion in HERRAMIENTAS_GEMINI}
+
+# Instrucciones fijas: van como system_instruction del modelo, no en cada mensaje.
+# La fecha actual se añade al mensaje solo cuando cambia para esa sesión.
+SYSTEM_PROMPT_GEMINI = """Eres Rubito, asistente virtual de Rubio Garcia Dental.
 
 Cuando el usuario pida crear una cita:
 1. Busca primero al paciente por nombre
 2. Si lo encuentras, crea la cita automáticamente
 3. Calcula las fechas automáticamente ("próximo lunes" = calcula qué fecha es)
-4. Confirma al usuario la cita creada
+4. Si no te dan hora o piden "el primer hueco", usa buscar_huecos_db (no listes el día entero)
+5. Confirma al usuario la cita creada
 
 SÉ PROACTIVO. NO pidas confirmaciones innecesarias."""
+
+DIAS_SEMANA = ['lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo']
+
+
+def contexto_fecha(ahora=None):
+    """Línea con la fecha actual para anteponer al mensaje"""
+    ahora = ahora or datetime.now()
+    return f"Fecha actual: {ahora.strftime('%d/%m/%Y')} {DIAS_SEMANA[ahora.weekday()]}"
+
+
+def crear_modelo_gemini():
+    """Modelo Gemini con herramientas e instrucciones ya vinculadas"""
+    return genai.GenerativeModel(
+        Config.GEMINI_MODELO,
+        tools=HERRAMIENTAS_GEMINI,
+        system_instruction=SYSTEM_PROMPT_GEMINI
+    )
+
+
+if gemini_configurado:
+    try:
+        gemini_model = crear_modelo_gemini()
+        logging.info(f"✅ Modelo Gemini listo con {len(HERRAMIENTAS_GEMINI)} herramientas")
+    except Exception as e:
+        gemini_model = None
+        logging.error(f"❌ Error creando modelo Gemini: {e}")
+else:
+    gemini_model = None
+
+
+class _SesionChat:
+    """Chat de Gemini de un usuario"""
+    
+    __slots__ = ('chat', 'lock', 'ultimo_uso', 'fecha', 'turnos')
+    
+    def __init__(self, chat):
+        self.chat = chat
+        self.lock = threading.Lock()   # un ChatSession no admite mensajes concurrentes
+        self.ultimo_uso = time.monotonic()
+        self.fecha = None              # última fecha enviada como contexto
+        self.turnos = 0
+
+
+class SesionesChat:
+    """
+    Pool acotado de sesiones de chat por usuario.
+    
+    Permite que "¿y mañana?" reutilice el contexto de la pregunta anterior.
+    Las sesiones inactivas más de `max_idle` segundos se descartan y, si se
+    llega a `max_sesiones`, se desaloja la menos usada recientemente.
+    """
+    
+    def __init__(self, max_sesiones=50, max_idle=900, max_turnos=20):
+        self.max_sesiones = max_sesiones
+        self.max_idle = max_idle
+        self.max_turnos = max_turnos
+        self._sesiones = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'creadas': 0, 'reutilizadas': 0, 'expiradas': 0, 'desalojadas': 0}
+    
+    def _nueva(self):
+        self.stats['creadas'] += 1
+        return _SesionChat(gemini_model.start_chat())
+    
+    def _purgar(self, ahora):
+        for usuario in [u for u, s in self._sesiones.items() if ahora - s.ultimo_uso > self.max_idle]:
+            del self._sesiones[usuario]
+            self.stats['expiradas'] += 1
+    
+    def obtener(self, usuario):
+        """Sesión del usuario (nueva si no existe, ha caducado o es muy larga)"""
+        ahora = time.monotonic()
+        with self._lock:
+            self._purgar(ahora)
+            sesion = self._sesiones.get(usuario)
+            if sesion is None or sesion.turnos >= self.max_turnos:
+                sesion = self._sesiones[usuario] = self._nueva()
+                while len(self._sesiones) > self.max_sesiones:
+                    self._sesiones.popitem(last=False)
+                    self.stats['desalojadas'] += 1
+            else:
+                self.stats['reutilizadas'] += 1
+            self._sesiones.move_to_end(usuario)
+            sesion.ultimo_uso = ahora
+            return sesion
+    
+    def descartar(self, usuario):
+        with self._lock:
+            self._sesiones.pop(usuario, None)
+    
+    def anotar_turno(self, usuario, pregunta, respuesta):
+        """Turno resuelto sin Gemini: queda en el chat del usuario como contexto del siguiente"""
+        if not usuario:
+            return
+        sesion = self.obtener(usuario)
+        with sesion.lock:
+            sesion.chat.history = list(sesion.chat.history) + [
+                {'role': 'user', 'parts': [{'text': pregunta}]},
+                {'role': 'model', 'parts': [{'text': respuesta}]},
+            ]
+            sesion.turnos += 1
+    
+    def tiene_contexto(self, usuario):
+        """True si el próximo mensaje del usuario seguiría una conversación ya empezada"""
+        if not usuario:
+            return False
+        ahora = time.monotonic()
+        with self._lock:
+            sesion = self._sesiones.get(usuario)
+            return (sesion is not None and 0 < sesion.turnos < self.max_turnos
+                    and ahora - sesion.ultimo_uso <= self.max_idle)
+    
+    def estadisticas(self):
+        with self._lock:
+            return dict(self.stats, activas=len(self._sesiones), max_sesiones=self.max_sesiones)
+
+
+sesiones_chat = SesionesChat(
+    max_sesiones=Config.GEMINI_MAX_SESIONES,
+    max_idle=Config.GEMINI_SESION_IDLE,
+    max_turnos=Config.GEMINI_MAX_TURNOS,
+)
+
+
+# Herramientas que no modifican datos: sus respuestas se pueden reutilizar
+HERRAMIENTAS_SOLO_LECTURA = {'buscar_paciente_db', 'listar_citas_db', 'buscar_huecos_db'}
+
+
+class CacheRespuestas:
+    """
+    Respuestas de Gemini a preguntas de solo lectura ("qué citas tengo hoy"),
+    compartidas entre usuarios.
+    
+    - Clave: comando normalizado + fecha del día
+    - Solo se guardan respuestas sin contexto previo que no usaron herramientas de escritura
+    - Se vacía cuando cambian datos: invalidación de la caché de agenda (escrituras o
+      cambios en DCitas), pacientes modificados o una herramienta de escritura
+    """
+    
+    def __init__(self, max_entradas=200, ttl=60):
+        self.cache = CacheLRU(max_entradas=max_entradas, ttl=ttl)
+        self._lock = threading.Lock()
+        self._generacion = 0   # sube con cada invalidación: descarta respuestas en vuelo
+        self.stats = {'guardadas': 0, 'no_cacheables': 0, 'obsoletas': 0, 'vaciados': 0}
+    
+    @staticmethod
+    def clave(comando, ahora=None):
+        return ' '.join(tokenizar(comando)), (ahora or datetime.now()).strftime('%Y-%m-%d')
+    
+    def generacion(self):
+        with self._lock:
+            return self._generacion
+    
+    def get(self, comando):
+        """Mensaje cacheado o None"""
+        return self.cache.get(self.clave(comando))
+    
+    def guardar(self, comando, mensaje, herramientas, generacion, con_contexto=False):
+        """Guarda la respuesta si es reutilizable y nada cambió mientras se generaba"""
+        with self._lock:
+            if con_contexto or not HERRAMIENTAS_SOLO_LECTURA.issuperset(herramientas):
+                self.stats['no_cacheables'] += 1
+                return False
+            if generacion != self._generacion:
+                self.stats['obsoletas'] += 1
+                return False
+            self.cache.put(self.clave(comando), mensaje)
+            self.stats['guardadas'] += 1
+            return True
+    
+    def invalidar(self):
+        with self._lock:
+            self._generacion += 1
+            self.cache.limpiar()
+            self.stats['vaciados'] += 1
+    
+    def estadisticas(self):
+        with self._lock:
+            return dict(self.cache.estadisticas(), **self.stats)
+
+
+cache_respuestas = CacheRespuestas(max_entradas=Config.COMANDO_CACHE_MAX, ttl=Config.COMANDO_CACHE_TTL)
+cache_agenda.al_invalidar.append(cache_respuestas.invalidar)
+indice_pacientes.al_cambiar.append(cache_respuestas.invalidar)
+
+
+def _ejecutar_herramienta(llamada):
+    """Ejecuta una function_call de Gemini y devuelve un resultado serializable"""
+    funcion = HERRAMIENTAS_POR_NOMBRE.get(llamada.name)
+    if funcion is None:
+        return {"error": f"Herramienta desconocida: {llamada.name}"}
+    
+    # Gemini envía los números como float: respetar las anotaciones de la función
+    args = dict(llamada.args or {})
+    for nombre, parametro in inspect.signature(funcion).parameters.items():
+        if parametro.annotation is int and isinstance(args.get(nombre), float):
+            args[nombre] = int(args[nombre])
+    
+    resultado = funcion(**args)
+    return json.loads(json.dumps(resultado, default=str))
+
+
+def _partes(respuesta):
+    try:
+        return respuesta.parts
+    except Exception:
+        return []
+
+
+def conversar_con_ia(comando, usuario=None, stream=False, turno=None):
+    """
+    Ejecuta un comando con Gemini resolviendo las llamadas a herramientas.
+    
+    Es un generador de eventos (tipo, datos):
+    - ('herramienta_inicio', {herramienta, args})
+    - ('herramienta_fin', {herramienta, ms, ok})
+    - ('token', {texto})            solo con stream=True
+    - ('final', {mensaje, ms, herramientas, con_contexto})
+    
+    Con `turno` (del planificador) cada llamada a Gemini respeta el plazo restante.
+    """
+    inicio = time.perf_counter()
+    
+    # Sin usuario identificado no se comparte contexto entre peticiones
+    if usuario:
+        sesion = sesiones_chat.obtener(usuario)
+    else:
+        sesion = _SesionChat(gemini_model.start_chat())
+    
+    with sesion.lock:
+        fecha = contexto_fecha()
+        mensaje = comando if sesion.fecha == fecha else f"{fecha}\n\nUsuario: {comando}"
+        con_contexto = sesion.turnos > 0
         
-        response = chat.send_message(f"{system_msg}\n\nUsuario: {comando}")
+        completado = False
+        try:
+            texto = []
+            usadas = []
+            # Una ronda más que el límite para cerrar: si aún quedan resultados de
+            # herramientas por entregar, se envían sin permitir nuevas llamadas
+            for ronda in range(Config.GEMINI_MAX_RONDAS + 1):
+                ultima = ronda == Config.GEMINI_MAX_RONDAS
+                opciones = {}
+                if turno is not None:
+                    opciones['request_options'] = {'timeout': turno.tiempo_restante()}
+                if ultima:
+                    opciones['tool_config'] = {'function_calling_config': {'mode': 'NONE'}}
+                
+                with medir('llm'):
+                    respuesta = sesion.chat.send_message(mensaje, stream=stream, **opciones)
+                
+                llamadas = []
+                fragmentos = iter(respuesta if stream else [respuesta])
+                while True:
+                    # En streaming, esperar cada fragmento también es tiempo de Gemini
+                    with medir('llm', contar=False):
+                        fragmento = next(fragmentos, None)
+                    if fragmento is None:
+                        break
+                    for parte in _partes(fragmento):
+                        llamada = getattr(parte, 'function_call', None)
+                        if llamada is not None and llamada.name:
+                            llamadas.append(llamada)
+                        elif getattr(parte, 'text', ''):
+                            texto.append(parte.text)
+                            if stream:
+                                yield 'token', {'texto': parte.text}
+                
+                if not llamadas:
+                    break
+                if ultima:
+                    # El historial acabaría en llamadas sin respuesta: la sesión se descarta abajo
+                    raise RuntimeError("La IA no terminó de responder tras el máximo de rondas de herramientas")
+                
+                # Devolver a Gemini el resultado de cada herramienta
+                respuestas = []
+                for llamada in llamadas:
+                    yield 'herramienta_inicio', {'herramienta': llamada.name, 'args': dict(llamada.args or {})}
+                    usadas.append(llamada.name)
+                    t0 = time.perf_counter()
+                    try:
+                        resultado = _ejecutar_herramienta(llamada)
+                    except Exception as e:
+                        resultado = {"error": str(e)}
+                    if llamada.name not in HERRAMIENTAS_SOLO_LECTURA:
+                        cache_respuestas.invalidar()
+                    yield 'herramienta_fin', {
+                        'herramienta': llamada.name,
+                        'ms': round((time.perf_counter() - t0) * 1000, 1),
+                        'ok': 'error' not in resultado,
+                    }
+                    respuestas.append(genai.protos.Part(function_response=genai.protos.FunctionResponse(
+                        name=llamada.name, response={'resultado': resultado}
+                    )))
+                mensaje = respuestas
+            
+            completado = True
+        finally:
+            if completado:
+                sesion.fecha = fecha
+                sesion.turnos += 1
+            elif usuario:
+                # Error o cliente desconectado: el historial puede estar incompleto
+                sesiones_chat.descartar(usuario)
+    
+    yield 'final', {
+        'mensaje': ''.join(texto),
+        'ms': round((time.perf_counter() - inicio) * 1000, 1),
+        'herramientas': usadas,
+        'con_contexto': con_contexto,
+    }
+
+
+def procesar_con_ia(comando, usuario=None, turno=None):
+    """Procesa comando con Gemini usando function calling"""
+    
+    if not gemini_model:
+        return {"accion": "error", "mensaje": "⚠️ Gemini no configurado"}
+    
+    try:
+        final = {}
+        for tipo, datos in conversar_con_ia(comando, usuario, turno=turno):
+            if tipo == 'final':
+                final = datos
         
         return {
             "accion": "respuesta_libre",
-            "mensaje": response.text
+            "mensaje": final.get('mensaje', ''),
+            "herramientas": final.get('herramientas', []),
+            "con_contexto": final.get('con_contexto', False)
         }
     
+    except PlazoIAExcedidoError:
+        raise
     except Exception as e:
         logging.error(f"Error Gemini: {e}")
         return {"accion": "error", "mensaje": f"Error: {str(e)}"}
@@ -273,30 +2021,7 @@ def ejecutar_buscar_paciente(busqueda):
         import re
         busqueda = re.sub(r'[;\'"\\]', '', busqueda).strip()
         
-        if busqueda.isdigit():
-            sql = """
-                SELECT TOP 20 IdPac, NumPac, Nombre, Apellidos, TelMovil, Email, FecNacim
-                FROM Pacientes
-                WHERE NumPac = ? AND IdCentro = ?
-            """
-            params = (int(busqueda), Config.ID_CENTRO)
-        else:
-            sql = """
-                SELECT TOP 20 IdPac, NumPac, Nombre, Apellidos, TelMovil, Email, FecNacim
-                FROM Pacientes
-                WHERE (Nombre LIKE ? OR Apellidos LIKE ?) AND IdCentro = ?
-                ORDER BY Apellidos, Nombre
-            """
-            params = (f'%{busqueda}%', f'%{busqueda}%', Config.ID_CENTRO)
-        
-        pacientes = GesdenDB.ejecutar_query(sql, params)
-        
-        for p in pacientes:
-            if p.get('FecNacim'):
-                try:
-                    p['FecNacim'] = GesdenDB.fecha_gesden_a_iso(p['FecNacim'])
-                except:
-                    p['FecNacim'] = None
+        pacientes = buscar_pacientes_bd(busqueda)
         
         return {"pacientes": pacientes, "total": len(pacientes)}
     except Exception as e:
@@ -315,62 +2040,352 @@ def ejecutar_listar_citas(fecha_str):
         
         fecha_gesden = GesdenDB.fecha_iso_a_gesden(fecha.strftime('%Y-%m-%d'))
         
+        citas = obtener_citas_dia(fecha_gesden)
+        
+        return {"citas": citas, "fecha": fecha.strftime('%Y-%m-%d'), "total": len(citas)}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def ejecutar_crear_cita(id_pac, fecha_iso, hora_str, texto=""):
+    """Ejecuta creación de cita"""
+    try:
+        fecha_gesden = GesdenDB.fecha_iso_a_gesden(fecha_iso)
+        hora_gesden = GesdenDB.hora_string_a_gesden(hora_str)
+        
+        sql_orden = "SELECT ISNULL(MAX(IdOrden), 0) + 1 AS siguiente FROM DCitas WHERE Fecha = ?"
+        resultado = GesdenDB.ejecutar_query(sql_orden, (fecha_gesden,))
+        id_orden = resultado[0]['siguiente'] if resultado else 1
+        
         sql = """
-            SELECT c.IdCita, c.Fecha, c.Hora, c.Duracion, c.Texto,
-                   p.NumPac, p.Nombre, p.Apellidos, p.TelMovil
-            FROM DCitas c
-            LEFT JOIN Pacientes p ON c.IdPac = p.IdPac
-            WHERE c.Fecha = ? AND c.IdCentro = ?
-            ORDER BY c.Hora
+            INSERT INTO DCitas (IdPac, Fecha, Hora, Duracion, Texto, IdOrden, IdCentro)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
         """
         
-        citas = GesdenDB.ejecutar_query(sql, (fecha_gesden, Config.ID_CENTRO))
-        
-        for cita in citas:
-            if cita.get('Fecha'):
-                cita['Fecha'] = GesdenDB.fecha_gesden_a_iso(cita['Fecha'])
-            if cita.get('Hora'):
-                cita['HoraFormato'] = GesdenDB.hora_gesden_a_string(cita['Hora'])
+        id_cita = GesdenDB.ejecutar_insert(sql, (
+            id_pac,
+            fecha_gesden,
+            hora_gesden,
+            30,  # 30 minutos por defecto
+            texto,
+            id_orden,
+            Config.ID_CENTRO
+        ))
+        citas_modificadas([fecha_gesden])
         
-        return {"citas": citas, "fecha": fecha.strftime('%Y-%m-%d'), "total": len(citas)}
+        return {
+            "success": True,
+            "id_cita": id_cita,
+            "fecha": fecha_iso,
+            "hora": hora_str,
+            "paciente_id": id_pac
+        }
     except Exception as e:
         return {"error": str(e)}
 
+def ejecutar_crear_citas_lote(citas):
+    """
+    Crea varias citas en una sola transacción.
+    
+    - IdOrden de todas las fechas afectadas en una consulta (con bloqueo)
+    - Carga de filas en una tabla temporal (fast_executemany si el driver lo admite)
+    - INSERT ... SELECT con OUTPUT INSERTED para obtener todos los IdCita
+    Si algo falla no se crea ninguna cita.
+    """
+    filas = []
+    for n, cita in enumerate(citas):
+        try:
+            filas.append([
+                n,
+                int(cita['id_pac']),
+                GesdenDB.fecha_iso_a_gesden(cita['fecha']),
+                GesdenDB.hora_string_a_gesden(cita['hora']),
+                int(cita.get('duracion', 30)),
+                cita.get('texto', '') or '',
+            ])
+        except (KeyError, TypeError, ValueError, IndexError) as e:
+            raise ValueError(f"Cita {n + 1} no válida: {e}")
+    
+    fechas = sorted({fila[2] for fila in filas})
+    marcas = ', '.join('?' * len(fechas))
+    
+    with GesdenDB.transaccion() as cursor:
+        # UPDLOCK/HOLDLOCK: nadie más puede reservar IdOrden en estas fechas hasta el commit
+        cursor.execute(
+            f"""
+            SELECT Fecha, ISNULL(MAX(IdOrden), 0) AS Ultimo
+            FROM DCitas WITH (UPDLOCK, HOLDLOCK)
+            WHERE Fecha IN ({marcas})
+            GROUP BY Fecha
+            """,
+            fechas
+        )
+        ultimo_orden = {fila.Fecha: fila.Ultimo for fila in cursor.fetchall()}
+        
+        for fila in filas:
+            ultimo_orden[fila[2]] = ultimo_orden.get(fila[2], 0) + 1
+            fila.append(ultimo_orden[fila[2]])
+        
+        cursor.execute("""
+            IF OBJECT_ID('tempdb..#lote_citas') IS NOT NULL DROP TABLE #lote_citas;
+            IF OBJECT_ID('tempdb..#lote_ids') IS NOT NULL DROP TABLE #lote_ids;
+            CREATE TABLE #lote_citas (
+                n INT, IdPac INT, Fecha INT, Hora INT, Duracion INT,
+                Texto NVARCHAR(4000), IdOrden INT
+            );
+            CREATE TABLE #lote_ids (IdCita INT, Fecha INT, IdOrden INT);
+        """)
+        
+        # Con el driver antiguo "SQL Server" fast_executemany falla o trunca
+        # textos: executemany normal, en la misma transacción
+        cursor.fast_executemany = Config.admite_fast_executemany()
+        cursor.executemany(
+            "INSERT INTO #lote_citas (n, IdPac, Fecha, Hora, Duracion, Texto, IdOrden) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            filas
+        )
+        cursor.fast_executemany = False
+        
+        # OUTPUT ... INTO: funciona aunque DCitas tenga triggers
+        cursor.execute("""
+            SET NOCOUNT ON;
+            INSERT INTO DCitas (IdPac, Fecha, Hora, Duracion, Texto, IdOrden, IdCentro)
+            OUTPUT INSERTED.IdCita, INSERTED.Fecha, INSERTED.IdOrden INTO #lote_ids
+            SELECT IdPac, Fecha, Hora, Duracion, Texto, IdOrden, ?
+            FROM #lote_citas
+            ORDER BY n;
+            SELECT IdCita, Fecha, IdOrden FROM #lote_ids;
+            DROP TABLE #lote_citas;
+            DROP TABLE #lote_ids;
+        """, (Config.ID_CENTRO,))
+        ids = {(fila.Fecha, fila.IdOrden): int(fila.IdCita) for fila in cursor.fetchall()}
+        
+        if len(ids) != len(filas):
+            raise RuntimeError(f"Se esperaban {len(filas)} citas y se insertaron {len(ids)}")
+    
+    citas_modificadas(fechas)
+    
+    return [
+        {
+            "id_cita": ids[(fila[2], fila[6])],
+            "id_pac": fila[1],
+            "fecha": citas[fila[0]]['fecha'],
+            "hora": citas[fila[0]]['hora'],
+            "id_orden": fila[6],
+        }
+        for fila in filas
+    ]
+
+# =====================================================
+# ENRUTADOR RÁPIDO DE COMANDOS
+# =====================================================
+
+_DIAS_NORMALIZADOS = {normalizar_texto(dia): i for i, dia in enumerate(DIAS_SEMANA)}
+
+_RE_FECHA_COMANDO = (
+    r'(?P<fecha>hoy|manana|pasado manana|ayer'
+    r'|(?:este |el |el proximo |proximo )?(?P<dia>' + '|'.join(_DIAS_NORMALIZADOS) + r')'
+    r'|\d{1,2}/\d{1,2}(?:/\d{2,4})?|\d{4}-\d{2}-\d{2})'
+)
+
+# "citas de hoy", "qué citas hay mañana", "agenda del lunes", "citas 12/05"
+_RE_CMD_CITAS = re.compile(
+    r'^(?:(?:que|cuales|lista|listar|listame|ver|muestra|muestrame|dame|ensename)\s+)?'
+    r'(?:las\s+|la\s+)?(?:citas|agenda)'
+    r'(?:\s+(?:tengo|tenemos|hay))?(?:\s+(?:de|para|del|el))?'
+    r'(?:\s+' + _RE_FECHA_COMANDO + r')?$'
+)
+
+# "busca 4134", "busca García", "buscar al paciente Ana López"
+_RE_CMD_BUSCAR = re.compile(
+    r'^(?:busca|buscar|buscame|encuentra|localiza|ficha)'
+    r'(?:\s+(?:al|a|el|la|paciente|de))*\s+(?P<texto>[a-z0-9 ]+)$'
+)
+
+# Palabras que convierten una búsqueda en otra cosa ("busca hueco para García"): a Gemini
+_PALABRAS_NO_NOMBRE = {
+    'cita', 'citas', 'hueco', 'huecos', 'deuda', 'deudas', 'presupuesto', 'telefono',
+    'para', 'con', 'que', 'y', 'hoy', 'manana', 'libre', 'libres', 'primer', 'proxima',
+}
 
-def ejecutar_crear_cita(id_pac, fecha_iso, hora_str, texto=""):
-    """Ejecuta creación de cita"""
+
+def _resolver_fecha_comando(texto, ahora):
+    """'hoy' / 'lunes' / '12/05' ... -> datetime (None si no es válida)"""
+    hoy = ahora.replace(hour=0, minute=0, second=0, microsecond=0)
+    relativas = {'hoy': 0, 'manana': 1, 'pasado manana': 2, 'ayer': -1}
+    if texto in relativas:
+        return hoy + timedelta(days=relativas[texto])
+    
+    dia = texto.split()[-1]
+    if dia in _DIAS_NORMALIZADOS:
+        dias = (_DIAS_NORMALIZADOS[dia] - hoy.weekday()) % 7
+        if dias == 0 and 'proximo' in texto:
+            dias = 7
+        return hoy + timedelta(days=dias)
+    
     try:
-        fecha_gesden = GesdenDB.fecha_iso_a_gesden(fecha_iso)
-        hora_gesden = GesdenDB.hora_string_a_gesden(hora_str)
+        if '-' in texto:
+            return datetime.strptime(texto, '%Y-%m-%d')
+        partes = [int(p) for p in texto.split('/')]
+        anio = partes[2] if len(partes) == 3 else hoy.year
+        if anio < 100:
+            anio += 2000
+        return datetime(anio, partes[1], partes[0])
+    except ValueError:
+        return None
+
+
+def clasificar_comando(comando, ahora=None):
+    """
+    Reconoce comandos con forma fija. Devuelve (intención, argumento):
+    - ('listar_citas', 'YYYY-MM-DD')
+    - ('buscar_paciente', texto)   texto = NumPac o nombre tal como lo escribió el usuario
+    o None si el comando es ambiguo y debe resolverlo Gemini.
+    """
+    original = re.sub(r'[¿?¡!.,;:]', ' ', comando or '').split()
+    texto = ' '.join(normalizar_texto(' '.join(original)).split())
+    if not texto:
+        return None
+    
+    coincidencia = _RE_CMD_CITAS.match(texto)
+    if coincidencia:
+        fecha = _resolver_fecha_comando(coincidencia.group('fecha') or 'hoy', ahora or datetime.now())
+        return ('listar_citas', fecha.strftime('%Y-%m-%d')) if fecha else None
+    
+    coincidencia = _RE_CMD_BUSCAR.match(texto)
+    if coincidencia:
+        palabras = coincidencia.group('texto').split()
+        if len(palabras) == 1 and palabras[0].isdigit():
+            return 'buscar_paciente', palabras[0]
+        if (len(palabras) <= 4
+                and all(p.isalpha() for p in palabras)
+                and not _PALABRAS_NO_NOMBRE.intersection(palabras)):
+            # Mismas palabras pero con tildes: la búsqueda SQL de respaldo las necesita
+            return 'buscar_paciente', ' '.join(original[-len(palabras):])
+    
+    return None
+
+
+def _mensaje_citas(resultado):
+    if 'error' in resultado:
+        return f"❌ Error listando citas: {resultado['error']}"
+    
+    fecha = datetime.strptime(resultado['fecha'], '%Y-%m-%d')
+    cabecera = f"📅 Citas del {DIAS_SEMANA[fecha.weekday()]} {fecha.strftime('%d/%m/%Y')}"
+    if not resultado['citas']:
+        return f"{cabecera}: no hay citas."
+    
+    lineas = [f"{cabecera}: {resultado['total']}"]
+    for cita in resultado['citas']:
+        paciente = ' '.join(filter(None, [cita.get('Nombre'), cita.get('Apellidos')])) or 'Sin paciente'
+        linea = f"• {cita.get('HoraFormato')} {paciente}"
+        if cita.get('Texto'):
+            linea += f" — {str(cita['Texto']).strip()}"
+        lineas.append(linea)
+    return '\n'.join(lineas)
+
+
+def _mensaje_pacientes(resultado, busqueda):
+    if 'error' in resultado:
+        return f"❌ Error buscando pacientes: {resultado['error']}"
+    if not resultado['pacientes']:
+        return f"🔍 No encontré pacientes para «{busqueda}»."
+    
+    lineas = [f"🔍 {resultado['total']} paciente(s) para «{busqueda}»:"]
+    for p in resultado['pacientes']:
+        linea = f"• Nº {p.get('NumPac')} — {p.get('Nombre', '')} {p.get('Apellidos', '')}".rstrip()
+        if p.get('TelMovil'):
+            linea += f" · {p['TelMovil']}"
+        lineas.append(linea)
+    return '\n'.join(lineas)
+
+
+class EnrutadorComandos:
+    """
+    Atajo delante de Gemini: los comandos con forma fija ("citas de hoy",
+    "busca 4134", "busca García") llaman directamente a las funciones
+    ejecutoras. Lo ambiguo sigue yendo a procesar_con_ia.
+    """
+    
+    def __init__(self, activo=True):
+        self.activo = activo
+        self.lock = threading.Lock()
+        self.stats = {'comandos': 0, 'rapidos': 0, 'gemini': 0, 'listar_citas': 0, 'buscar_paciente': 0}
+    
+    def resolver(self, comando):
+        """Respuesta {accion, mensaje} o None si hay que preguntar a Gemini"""
+        intencion = clasificar_comando(comando) if self.activo else None
         
-        sql_orden = "SELECT ISNULL(MAX(IdOrden), 0) + 1 AS siguiente FROM DCitas WHERE Fecha = ?"
-        resultado = GesdenDB.ejecutar_query(sql_orden, (fecha_gesden,))
-        id_orden = resultado[0]['siguiente'] if resultado else 1
+        with self.lock:
+            self.stats['comandos'] += 1
+            if intencion is None:
+                self.stats['gemini'] += 1
+            else:
+                self.stats['rapidos'] += 1
+                self.stats[intencion[0]] += 1
         
-        sql = """
-            INSERT INTO DCitas (IdPac, Fecha, Hora, Duracion, Texto, IdOrden, IdCentro)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """
+        if intencion is None:
+            return None
         
-        id_cita = GesdenDB.ejecutar_insert(sql, (
-            id_pac,
-            fecha_gesden,
-            hora_gesden,
-            30,  # 30 minutos por defecto
-            texto,
-            id_orden,
-            Config.ID_CENTRO
-        ))
+        accion, argumento = intencion
+        if accion == 'listar_citas':
+            mensaje = _mensaje_citas(ejecutar_listar_citas(argumento))
+        else:
+            mensaje = _mensaje_pacientes(ejecutar_buscar_paciente(argumento), argumento)
         
-        return {
-            "success": True,
-            "id_cita": id_cita,
-            "fecha": fecha_iso,
-            "hora": hora_str,
-            "paciente_id": id_pac
-        }
-    except Exception as e:
-        return {"error": str(e)}
+        logging.info(f"Comando resuelto sin Gemini: {accion}({argumento})")
+        return {"accion": accion, "mensaje": mensaje}
+    
+    def estadisticas(self):
+        """Contadores y proporción de comandos resueltos sin Gemini"""
+        with self.lock:
+            total = self.stats['comandos']
+            return dict(
+                self.stats,
+                activo=self.activo,
+                ratio_rapido=round(self.stats['rapidos'] / total, 3) if total else 0.0,
+            )
+
+
+enrutador_comandos = EnrutadorComandos(activo=Config.ENRUTADOR_RAPIDO)
+
+
+def resolver_sin_ia(comando, usuario=None):
+    """Atajo local y, si no, caché de respuestas. Devuelve (respuesta, vía) o (None, None)"""
+    # A mitad de conversación ("dale cita mañana") la pregunta depende del
+    # contexto y el turno debe quedar en el chat del usuario: siempre a Gemini
+    if sesiones_chat.tiene_contexto(usuario):
+        return None, None
+    
+    respuesta = enrutador_comandos.resolver(comando)
+    if respuesta is not None:
+        # "busca García" resuelto aquí: Gemini debe saber de qué García se habla después
+        sesiones_chat.anotar_turno(usuario, comando, respuesta['mensaje'])
+        return respuesta, 'rapida'
+    
+    mensaje = cache_respuestas.get(comando)
+    if mensaje is not None:
+        return {"accion": "respuesta_libre", "mensaje": mensaje}, 'cache'
+    return None, None
+
+
+def responder_comando(comando, usuario=None, prioridad='interactiva', plazo=None):
+    """
+    Atajo local, luego caché de respuestas y, si no, Gemini con turno del
+    planificador. Devuelve (respuesta, vía).
+    Lanza ColaIALlenaError / PlazoIAExcedidoError si Gemini está saturado.
+    """
+    respuesta, via = resolver_sin_ia(comando, usuario)
+    if respuesta is not None:
+        return respuesta, via
+    
+    generacion = cache_respuestas.generacion()
+    with planificador_ia.turno(prioridad, plazo) as turno:
+        respuesta = procesar_con_ia(comando, usuario, turno)
+    if respuesta.get('accion') == 'respuesta_libre':
+        cache_respuestas.guardar(comando, respuesta['mensaje'], respuesta['herramientas'],
+                                 generacion, respuesta['con_contexto'])
+    return respuesta, 'gemini'
 
 # =====================================================
 # RUTAS WEB - INTERFAZ
@@ -394,24 +2409,59 @@ def health():
 def estado():
     """Estado del sistema - Health check extendido"""
     try:
-        # Verificar conexión BD
-        conn = pyodbc.connect(Config.get_connection_string(), timeout=3)
-        conn.close()
+        # Verificar conexión BD (usando el pool)
+        with pool_gesden.conexion(timeout=3) as conn:
+            conn.cursor().execute("SELECT 1").fetchone()
         bd_status = "conectada"
     except:
         bd_status = "desconectada"
     
-    # Verificar MiniMax
-    minimax_status = "configurada" if minimax_client else "no configurada"
+    # Verificar Gemini
+    gemini_status = "configurada" if gemini_model else "no configurada"
     
     return jsonify({
         'status': 'ok',
         'timestamp': datetime.now().isoformat(),
         'base_datos': bd_status,
-        'minimax_api': minimax_status,
+        'gemini_api': gemini_status,
+        'pool_bd': pool_gesden.estadisticas(),
+        'indice_pacientes': indice_pacientes.estadisticas(),
+        'cache_agenda': cache_agenda.estadisticas(),
+        'cache_paciente360': cache_paciente360.estadisticas(),
+        'replica_local': replica_gesden.estadisticas() if replica_gesden else 'desactivada',
+        'sesiones_ia': sesiones_chat.estadisticas(),
+        'enrutador_comandos': enrutador_comandos.estadisticas(),
+        'cache_respuestas': cache_respuestas.estadisticas(),
+        'planificador_ia': planificador_ia.estadisticas(),
+        'metricas': metricas_rutas.resumen(),
         'version': '5.0-minimax'
     })
 
+@app.route('/metrics')
+def metrics():
+    """Métricas en formato Prometheus (latencias por ruta + pool, índice, caché y sesiones)"""
+    lineas = metricas_rutas.prometheus()
+    
+    fuentes = [
+        ('gesden_pool', pool_gesden.estadisticas()),
+        ('gesden_indice', indice_pacientes.estadisticas()),
+        ('gesden_cache_agenda', cache_agenda.estadisticas()),
+        ('gesden_cache_paciente360', cache_paciente360.estadisticas()),
+        ('gesden_sesiones_ia', sesiones_chat.estadisticas()),
+        ('gesden_enrutador', enrutador_comandos.estadisticas()),
+        ('gesden_cache_respuestas', cache_respuestas.estadisticas()),
+        ('gesden_planificador_ia', planificador_ia.estadisticas()),
+    ]
+    if replica_gesden is not None:
+        fuentes.append(('gesden_replica', replica_gesden.estadisticas()))
+    
+    for prefijo, stats in fuentes:
+        for clave, valor in stats.items():
+            if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+                lineas.append(f"{prefijo}_{clave} {valor}")
+    
+    return Response('\n'.join(lineas) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # =====================================================
 # API - PACIENTES
 # =====================================================
@@ -440,33 +2490,7 @@ def buscar_pacientes():
                 'pacientes': []
             })
         
-        # Si es número, buscar por NumPac
-        if busqueda.isdigit():
-            sql = """
-                SELECT TOP 20 IdPac, NumPac, Nombre, Apellidos, TelMovil, Email, FecNacim
-                FROM Pacientes
-                WHERE NumPac = ? AND IdCentro = ?
-            """
-            params = (int(busqueda), Config.ID_CENTRO)
-        else:
-            # Buscar por nombre/apellidos
-            sql = """
-                SELECT TOP 20 IdPac, NumPac, Nombre, Apellidos, TelMovil, Email, FecNacim
-                FROM Pacientes
-                WHERE (Nombre LIKE ? OR Apellidos LIKE ?) AND IdCentro = ?
-                ORDER BY Apellidos, Nombre
-            """
-            params = (f'%{busqueda}%', f'%{busqueda}%', Config.ID_CENTRO)
-        
-        pacientes = GesdenDB.ejecutar_query(sql, params)
-        
-        # Convertir fechas con manejo de errores
-        for p in pacientes:
-            if p.get('FecNacim'):
-                try:
-                    p['FecNacim'] = GesdenDB.fecha_gesden_a_iso(p['FecNacim'])
-                except:
-                    p['FecNacim'] = None  # Si falla, poner null
+        pacientes = buscar_pacientes_bd(busqueda)
         
         logging.info(f"Búsqueda pacientes: [REDACTED] - {len(pacientes)} resultados")
         
@@ -482,6 +2506,247 @@ def buscar_pacientes():
             'error': str(e)
         }), 500
 
+COLUMNAS_EXPORT_PACIENTES = [
+    'IdPac', 'NumPac', 'Nombre', 'Apellidos', 'FecNacim', 'Sexo', 'TelMovil', 'Tel1',
+    'Email', 'Direccion', 'CP', 'FecAlta', 'AceptaGDPR', 'NoContactable', '_fechaModif',
+]
+
+
+def _pacientes_export(desde_id, lote, limite=None):
+    """
+    Genera bloques de pacientes (IdPac > desde_id, por IdPac) ya convertidos.
+    
+    Paginación por clave: cada página es una consulta TOP (n) ... WHERE IdPac > último,
+    así la conexión vuelve al pool entre páginas y no hay OFFSET que recorrer.
+    """
+    ultimo = desde_id
+    pendientes = limite
+    while pendientes is None or pendientes > 0:
+        pagina = Config.EXPORT_PAGINA if pendientes is None else min(Config.EXPORT_PAGINA, pendientes)
+        sql = f"""
+            SELECT TOP ({pagina}) {', '.join(COLUMNAS_EXPORT_PACIENTES)}
+            FROM Pacientes
+            WHERE IdCentro = ? AND IdPac > ?
+            ORDER BY IdPac
+        """
+        
+        leidas = 0
+        bloque = []
+        for fila in GesdenDB.iterar_query(sql, (Config.ID_CENTRO, ultimo), lote=lote):
+            bloque.append(fila)
+            if len(bloque) >= lote:
+                leidas += len(bloque)
+                ultimo = bloque[-1]['IdPac']
+                yield _convertir_bloque_export(bloque)
+                bloque = []
+        if bloque:
+            leidas += len(bloque)
+            ultimo = bloque[-1]['IdPac']
+            yield _convertir_bloque_export(bloque)
+        
+        if pendientes is not None:
+            pendientes -= leidas
+        if leidas < pagina:
+            break
+
+
+def _convertir_bloque_export(bloque):
+    """Conversión de fechas Gesden por bloque (no fila a fila)"""
+    gesden_codec.convertir_columnas(bloque, fechas=['FecNacim'])
+    for fila in bloque:
+        for columna in ('FecAlta', '_fechaModif'):
+            if hasattr(fila.get(columna), 'isoformat'):
+                fila[columna] = fila[columna].isoformat()
+    return bloque
+
+
+@app.route('/api/pacientes/export', methods=['GET'])
+def exportar_pacientes():
+    """
+    Exportación completa de Pacientes en streaming (CSV o NDJSON).
+    
+    Parámetros: formato=ndjson|csv, desde_id (reanudar tras el último IdPac
+    recibido), lote (filas por fetchmany), limite (opcional).
+    En NDJSON la última línea es {"_fin": true, ...}; en CSV es la fila
+    `#fin,<exportados>,<ultimo_IdPac>` (o `#error,<ultimo_IdPac>,<mensaje>`).
+    Si no llega, la exportación se cortó y se reanuda con desde_id = último
+    IdPac completo.
+    """
+    try:
+        formato = request.args.get('formato', 'ndjson')
+        desde_id = int(request.args.get('desde_id', 0))
+        lote = max(100, min(int(request.args.get('lote', Config.EXPORT_LOTE)), 5000))
+        limite = int(request.args['limite']) if request.args.get('limite') else None
+        if formato not in ('ndjson', 'csv'):
+            raise ValueError("formato debe ser 'ndjson' o 'csv'")
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'error': f'Parámetros no válidos: {e}'
+        }), 400
+    
+    logging.info(f"Exportación de pacientes: {formato} desde IdPac > {desde_id}")
+    
+    def generar_ndjson():
+        total, ultimo = 0, desde_id
+        try:
+            for bloque in _pacientes_export(desde_id, lote, limite):
+                yield ''.join(json.dumps(fila, ensure_ascii=False, default=str) + "\n" for fila in bloque)
+                total += len(bloque)
+                ultimo = bloque[-1]['IdPac']
+        except Exception as e:
+            logging.error(f"Error exportando pacientes: {e}")
+            yield json.dumps({'error': str(e), 'ultimo_IdPac': ultimo}, ensure_ascii=False) + "\n"
+            return
+        yield json.dumps({'_fin': True, 'exportados': total, 'ultimo_IdPac': ultimo}) + "\n"
+    
+    def generar_csv():
+        salida = io.StringIO()
+        escritor = csv.DictWriter(salida, fieldnames=COLUMNAS_EXPORT_PACIENTES, extrasaction='ignore')
+        if desde_id == 0:
+            escritor.writeheader()
+        yield salida.getvalue()
+        salida.seek(0)
+        salida.truncate()
+        
+        total, ultimo = 0, desde_id
+        try:
+            for bloque in _pacientes_export(desde_id, lote, limite):
+                escritor.writerows(bloque)
+                yield salida.getvalue()
+                salida.seek(0)
+                salida.truncate()
+                total += len(bloque)
+                ultimo = bloque[-1]['IdPac']
+        except Exception as e:
+            # Ya se envió la cabecera 200: fila de error y el cliente reanuda desde ultimo_IdPac
+            logging.error(f"Error exportando pacientes: {e}")
+            csv.writer(salida).writerow(['#error', ultimo, str(e)])
+            yield salida.getvalue()
+            return
+        # Fila final: sin ella el CSV está truncado
+        csv.writer(salida).writerow(['#fin', total, ultimo])
+        yield salida.getvalue()
+    
+    if formato == 'csv':
+        generador, tipo, extension = generar_csv(), 'text/csv; charset=utf-8', 'csv'
+    else:
+        generador, tipo, extension = generar_ndjson(), 'application/x-ndjson', 'ndjson'
+    
+    return Response(
+        stream_with_context(generador),
+        content_type=tipo,
+        headers={
+            'Content-Disposition': f'attachment; filename=pacientes_{datetime.now():%Y%m%d}_{desde_id}.{extension}',
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+# Todas las consultas de la ficha en un solo lote: un viaje por el túnel en vez de 6
+SQL_PACIENTE_360 = """
+    SET NOCOUNT ON;
+    DECLARE @IdPac INT = ?, @Hoy INT = ?;
+    
+    SELECT IdPac, NumPac, Nombre, Apellidos, TelMovil, Tel1, Email, FecNacim, Sexo,
+           Direccion, CP, IdCli
+    FROM Pacientes
+    WHERE IdPac = @IdPac;
+    
+    SELECT tm.NumTto, tm.IdTto, t.Descrip AS Tratamiento, tm.FecIni, tm.Notas,
+           tm.Importe, tm.StaTto AS Estado, tm.PiezasNum AS Piezas
+    FROM TtosMed tm
+    LEFT JOIN Tratamientos t ON tm.IdTto = t.IdTratamiento
+    WHERE tm.IdPac = @IdPac
+    ORDER BY tm.FecIni DESC;
+    
+    SELECT p.NumSerie, p.NumPre, p.Titulo, p.FecPresup, p.FecAcepta,
+           co.Nombre + ' ' + co.Apellidos AS Colaborador
+    FROM Presu p
+    LEFT JOIN TColabos co ON p.IdCol = co.IdCol
+    WHERE p.IdPac = @IdPac
+    ORDER BY p.FecPresup DESC;
+    
+    SELECT d.IdDeudaCli, d.FecPlazo, d.Adeudo, d.Pendiente, d.NFactura
+    FROM DeudaCli d
+    JOIN Pacientes p ON d.IdCli = p.IdCli
+    WHERE p.IdPac = @IdPac AND d.Liquidado = 0
+    ORDER BY d.FecPlazo;
+    
+    SELECT TOP ({citas}) c.IdCita, c.Fecha, c.Hora, c.Duracion, c.Texto, c.IdUsu, c.IdSitC
+    FROM DCitas c
+    WHERE c.IdPac = @IdPac AND c.Fecha >= @Hoy
+    ORDER BY c.Fecha, c.Hora;
+"""
+
+# IdPac -> ficha completa (corta duración: la ficha se abre varias veces seguidas)
+cache_paciente360 = CacheLRU(max_entradas=Config.PACIENTE360_MAX, ttl=Config.PACIENTE360_TTL)
+# Cualquier cambio de agenda puede afectar a las próximas citas de la ficha
+cache_agenda.al_invalidar.append(cache_paciente360.limpiar)
+
+
+def _a_float(valor):
+    return float(valor) if valor else 0.0
+
+
+def obtener_paciente_360(id_pac):
+    """Paciente, tratamientos, presupuestos, deuda y próximas citas (None si no existe)"""
+    ficha = cache_paciente360.get(id_pac)
+    if ficha is not None:
+        return dict(ficha, cache=True)
+    
+    hoy = GesdenDB.fecha_iso_a_gesden(datetime.now().strftime('%Y-%m-%d'))
+    pacientes, tratamientos, presupuestos, deudas, citas = GesdenDB.ejecutar_lote(
+        SQL_PACIENTE_360.format(citas=Config.PACIENTE360_CITAS), (id_pac, hoy)
+    )
+    if not pacientes:
+        return None
+    
+    gesden_codec.convertir_columnas(pacientes, fechas=['FecNacim'])
+    gesden_codec.convertir_columnas(tratamientos, fechas=['FecIni'])
+    gesden_codec.convertir_columnas(presupuestos, fechas=['FecPresup', 'FecAcepta'])
+    gesden_codec.convertir_columnas(deudas, fechas=['FecPlazo'])
+    gesden_codec.convertir_columnas(citas, fechas=['Fecha'], horas=['Hora'])
+    
+    for tratamiento in tratamientos:
+        tratamiento['Importe'] = _a_float(tratamiento['Importe'])
+    for deuda in deudas:
+        deuda['Adeudo'] = _a_float(deuda['Adeudo'])
+        deuda['Pendiente'] = _a_float(deuda['Pendiente'])
+    
+    ficha = {
+        'paciente': pacientes[0],
+        'tratamientos': tratamientos,
+        'presupuestos': presupuestos,
+        'deuda': {
+            'total_deuda': sum(d['Pendiente'] for d in deudas),
+            'deudas': deudas,
+        },
+        'proximas_citas': citas,
+    }
+    cache_paciente360.put(id_pac, ficha)
+    return dict(ficha, cache=False)
+
+
+@app.route('/api/pacientes/<int:id_pac>/360', methods=['GET'])
+def paciente_360(id_pac):
+    """Ficha completa del paciente en una sola llamada"""
+    try:
+        ficha = obtener_paciente_360(id_pac)
+        if ficha is None:
+            return jsonify({
+                'success': False,
+                'error': 'Paciente no encontrado'
+            }), 404
+        
+        return jsonify(dict(ficha, success=True))
+    
+    except Exception as e:
+        logging.error(f"Error obteniendo ficha del paciente {id_pac}: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 # =====================================================
 # API - CITAS
 # =====================================================
@@ -503,21 +2768,11 @@ def listar_citas():
         
         fecha_gesden = GesdenDB.fecha_iso_a_gesden(fecha.strftime('%Y-%m-%d'))
         
-        sql = """
-            SELECT c.IdCita, c.Fecha, c.Hora, c.Duracion, c.Texto,
-                   p.NumPac, p.Nombre, p.Apellidos, p.TelMovil
-            FROM DCitas c
-            LEFT JOIN Pacientes p ON c.IdPac = p.IdPac
-            WHERE c.Fecha = ?
-            ORDER BY c.Hora
-        """
-        
-        citas = GesdenDB.ejecutar_query(sql, (fecha_gesden,))
+        citas = obtener_citas_dia(fecha_gesden)
         
         # Convertir formato
         for c in citas:
-            c['Fecha'] = GesdenDB.fecha_gesden_a_iso(c['Fecha'])
-            c['Hora'] = GesdenDB.hora_gesden_a_string(c['Hora'])
+            c['Hora'] = c.pop('HoraFormato')
             c['Paciente'] = f"{c['Nombre']} {c['Apellidos']}" if c.get('Nombre') else "Sin paciente"
         
         logging.info(f"Listar citas: {fecha.strftime('%d/%m/%Y')} - {len(citas)} citas")
@@ -535,6 +2790,127 @@ def listar_citas():
             'error': str(e)
         }), 500
 
+def _citas_rango_por_dia(fecha_desde, fecha_hasta, colaboradores=None):
+    """Genera (fecha ISO, citas del día) leyendo el rango con una sola consulta"""
+    sql = """
+        SELECT c.IdCita, c.Fecha, c.Hora, c.Duracion, c.Texto, c.IdUsu,
+               p.NumPac, p.Nombre, p.Apellidos, p.TelMovil
+        FROM DCitas c
+        LEFT JOIN Pacientes p ON c.IdPac = p.IdPac
+        WHERE c.Fecha BETWEEN ? AND ? AND c.IdCentro = ?
+    """
+    params = [fecha_desde, fecha_hasta, Config.ID_CENTRO]
+    
+    if colaboradores:
+        sql += f" AND c.IdUsu IN ({', '.join('?' * len(colaboradores))})"
+        params.extend(colaboradores)
+    
+    sql += " ORDER BY c.Fecha, c.Hora"
+    
+    def dia_listo(citas):
+        gesden_codec.convertir_columnas(citas, fechas=['Fecha'], horas=['Hora'])
+        for c in citas:
+            c['Paciente'] = f"{c['Nombre']} {c['Apellidos']}" if c.get('Nombre') else "Sin paciente"
+        return citas[0]['Fecha'], citas
+    
+    dia_actual = None
+    citas = []
+    for c in GesdenDB.iterar_lectura(sql, params, lote=Config.RANGO_LOTE, fechas=(fecha_desde, fecha_hasta)):
+        if c['Fecha'] != dia_actual:
+            if citas:
+                yield dia_listo(citas)
+            dia_actual = c['Fecha']
+            citas = []
+        citas.append(c)
+    
+    if citas:
+        yield dia_listo(citas)
+
+
+@app.route('/api/citas/rango', methods=['POST'])
+def listar_citas_rango():
+    """Citas de un rango de fechas (vista semana/mes) en streaming, agrupadas por día"""
+    try:
+        data = request.json or {}
+        desde_iso = data.get('desde')
+        hasta_iso = data.get('hasta')
+        formato = data.get('formato', 'json')
+        colaboradores = [int(c) for c in data.get('colaboradores') or []]
+        
+        fecha_desde = GesdenDB.fecha_iso_a_gesden(desde_iso)
+        fecha_hasta = GesdenDB.fecha_iso_a_gesden(hasta_iso)
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'error': f'Parámetros no válidos (desde/hasta: YYYY-MM-DD): {e}'
+        }), 400
+    
+    if fecha_hasta < fecha_desde or fecha_hasta - fecha_desde > Config.RANGO_MAX_DIAS:
+        return jsonify({
+            'success': False,
+            'error': f'Rango no válido (máx {Config.RANGO_MAX_DIAS} días)'
+        }), 400
+    
+    def generar_ndjson():
+        try:
+            for fecha, citas in _citas_rango_por_dia(fecha_desde, fecha_hasta, colaboradores):
+                yield json.dumps({'fecha': fecha, 'citas': citas}, ensure_ascii=False, default=str) + "\n"
+        except Exception as e:
+            logging.error(f"Error listando rango de citas: {e}")
+            yield json.dumps({'error': str(e)}, ensure_ascii=False) + "\n"
+    
+    def generar_json():
+        yield json.dumps({'success': True, 'desde': desde_iso, 'hasta': hasta_iso})[:-1] + ', "dias": ['
+        try:
+            separador = ""
+            for fecha, citas in _citas_rango_por_dia(fecha_desde, fecha_hasta, colaboradores):
+                yield separador + json.dumps({'fecha': fecha, 'citas': citas}, ensure_ascii=False, default=str)
+                separador = ", "
+            yield "]}"
+        except Exception as e:
+            # Ya se envió la cabecera 200: el JSON queda incompleto y el cliente lo detecta
+            logging.error(f"Error listando rango de citas: {e}")
+    
+    logging.info(f"Rango de citas: {desde_iso} - {hasta_iso} ({formato})")
+    
+    if formato == 'ndjson':
+        return Response(stream_with_context(generar_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generar_json()), mimetype='application/json')
+
+@app.route('/api/citas/huecos', methods=['POST'])
+def listar_huecos():
+    """Primeros huecos libres de una duración mínima"""
+    try:
+        data = request.json or {}
+        desde = data.get('desde') or datetime.now().strftime('%Y-%m-%d')
+        colaboradores = [int(c) for c in data.get('colaboradores') or []]
+        
+        huecos = buscar_huecos(
+            desde,
+            data.get('hasta'),
+            int(data.get('duracion', 30)),
+            colaboradores,
+            min(int(data.get('max', 5)), 50)
+        )
+        
+        return jsonify({
+            'success': True,
+            'huecos': huecos
+        })
+    
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    except Exception as e:
+        logging.error(f"Error buscando huecos: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @app.route('/api/citas/crear', methods=['POST'])
 def crear_cita():
     """Crear nueva cita"""
@@ -571,8 +2947,9 @@ def crear_cita():
             id_orden,
             Config.ID_CENTRO
         ))
+        citas_modificadas([fecha_gesden])
         
-        logging.info(f"Listar citas: {fecha.strftime('%d/%m/%Y')} - {len(citas)} citas")
+        logging.info(f"Cita creada: {fecha_iso} {hora_str} - ID {id_cita}")
         
         return jsonify({
             'success': True,
@@ -587,6 +2964,48 @@ def crear_cita():
             'error': str(e)
         }), 500
 
+@app.route('/api/citas/crear-lote', methods=['POST'])
+def crear_citas_lote():
+    """Crear varias citas (planes de tratamiento) en una sola transacción"""
+    try:
+        data = request.json or {}
+        citas = data.get('citas') or []
+        
+        if not isinstance(citas, list) or not citas:
+            return jsonify({
+                'success': False,
+                'error': 'Se necesita una lista de citas'
+            }), 400
+        
+        if len(citas) > Config.LOTE_CITAS_MAX:
+            return jsonify({
+                'success': False,
+                'error': f'Demasiadas citas (máx {Config.LOTE_CITAS_MAX})'
+            }), 400
+        
+        creadas = ejecutar_crear_citas_lote(citas)
+        
+        logging.info(f"Citas creadas en lote: {len(creadas)}")
+        
+        return jsonify({
+            'success': True,
+            'citas': creadas,
+            'total': len(creadas)
+        })
+    
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    except Exception as e:
+        logging.error(f"Error creando citas en lote: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 # =====================================================
 # API - COLABORADORES
 # =====================================================
@@ -602,7 +3021,7 @@ def listar_colaboradores():
             ORDER BY Apellidos, Nombre
         """
         
-        colaboradores = GesdenDB.ejecutar_query(sql)
+        colaboradores = GesdenDB.ejecutar_lectura(sql)
         
         return jsonify({
             'success': True,
@@ -620,24 +3039,52 @@ def listar_colaboradores():
 # API - COMANDOS IA
 # =====================================================
 
+def _leer_plazo(valor):
+    """Plazo en segundos de la petición (None = el por defecto), recortado a GEMINI_PLAZO"""
+    if valor is None:
+        return None
+    if isinstance(valor, bool):
+        raise ValueError("plazo debe ser un número de segundos")
+    plazo = float(valor)
+    if not math.isfinite(plazo) or plazo <= 0:
+        raise ValueError("plazo debe ser un número de segundos mayor que 0")
+    return min(plazo, Config.GEMINI_PLAZO)
+
+
 @app.route('/api/comando', methods=['POST'])
 def procesar_comando():
     """Procesar comando con IA"""
+    data = request.json or {}
+    try:
+        plazo = _leer_plazo(data.get('plazo'))             # segundos (opcional, hasta GEMINI_PLAZO)
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'error': f'Parámetros no válidos: {e}'
+        }), 400
+    
     try:
-        data = request.json
         comando = data.get('comando', '')
+        usuario = data.get('usuario')  # opcional: mantiene el contexto entre comandos
+        prioridad = data.get('prioridad', 'interactiva')  # 'interactiva' | 'lote'
         
         logging.info(f"Comando recibido: {comando}")
         
-        # Procesar con Claude (con herramientas)
-        respuesta_ia = procesar_con_ia(comando)
+        # Comandos simples y repetidos sin pasar por Gemini; el resto, con Claude (con herramientas)
+        respuesta_ia, via = responder_comando(comando, usuario, prioridad, plazo)
         
         # Devolver respuesta directa de Claude
         return jsonify({
             'success': True,
-            'mensaje': respuesta_ia.get('mensaje', 'Sin respuesta')
+            'mensaje': respuesta_ia.get('mensaje', 'Sin respuesta'),
+            'via': via
         })
     
+    except ColaIALlenaError as e:
+        return _respuesta_ia_saturada(e)
+    except PlazoIAExcedidoError as e:
+        logging.warning(f"Comando fuera de plazo: {comando}")
+        return jsonify({'success': False, 'error': str(e)}), 504
     except Exception as e:
         logging.error(f"Error procesando comando: {e}")
         return jsonify({
@@ -645,11 +3092,165 @@ def procesar_comando():
             'error': str(e)
         }), 500
 
+def _respuesta_ia_saturada(error):
+    """503 con Retry-After cuando el planificador no admite más comandos"""
+    logging.warning(f"Gemini saturado: {error}")
+    respuesta = jsonify({'success': False, 'error': str(error), 'reintentar_en': error.reintentar_en})
+    respuesta.status_code = 503
+    respuesta.headers['Retry-After'] = str(error.reintentar_en)
+    return respuesta
+
+
+def _evento_sse(tipo, datos):
+    """Formatea un evento Server-Sent Events"""
+    return f"event: {tipo}\ndata: {json.dumps(datos, ensure_ascii=False, default=str)}\n\n"
+
+
+@app.route('/api/comando/stream', methods=['POST'])
+def procesar_comando_stream():
+    """Procesar comando con IA emitiendo eventos SSE según ocurren"""
+    data = request.json or {}
+    comando = data.get('comando', '')
+    usuario = data.get('usuario')
+    prioridad = data.get('prioridad', 'interactiva')
+    try:
+        plazo = _leer_plazo(data.get('plazo'))
+    except (TypeError, ValueError) as e:
+        return jsonify({
+            'success': False,
+            'error': f'Parámetros no válidos: {e}'
+        }), 400
+    
+    logging.info(f"Comando (stream) recibido: {comando}")
+    
+    inicio = time.perf_counter()
+    error = None
+    try:
+        respuesta, via = resolver_sin_ia(comando, usuario)
+    except Exception as e:
+        logging.error(f"Error procesando comando (stream): {e}")
+        respuesta, via, error = None, None, str(e)
+    
+    # El turno se pide antes de empezar a emitir: si no hay hueco, 503 normal
+    turno = None
+    if respuesta is None and error is None and gemini_model:
+        try:
+            turno = planificador_ia.adquirir(prioridad, plazo)
+        except ColaIALlenaError as e:
+            return _respuesta_ia_saturada(e)
+    
+    def generar():
+        # Primer byte inmediato: el cliente sabe que la petición está en marcha
+        yield _evento_sse('inicio', {'comando': comando})
+        
+        if error is not None:
+            yield _evento_sse('error', {'error': error})
+            return
+        if respuesta is not None:
+            yield _evento_sse('final', {
+                'mensaje': respuesta['mensaje'],
+                'ms': round((time.perf_counter() - inicio) * 1000, 1),
+                'via': via,
+            })
+            return
+        
+        if not gemini_model:
+            yield _evento_sse('error', {'error': '⚠️ Gemini no configurado'})
+            return
+        
+        generacion = cache_respuestas.generacion()
+        try:
+            for tipo, datos in conversar_con_ia(comando, usuario, stream=True, turno=turno):
+                if tipo == 'final':
+                    cache_respuestas.guardar(comando, datos['mensaje'], datos['herramientas'],
+                                             generacion, datos['con_contexto'])
+                    datos = dict(datos, via='gemini')
+                yield _evento_sse(tipo, datos)
+        except Exception as e:
+            logging.error(f"Error procesando comando (stream): {e}")
+            yield _evento_sse('error', {'error': str(e)})
+        finally:
+            if turno is not None:
+                turno.liberar()
+    
+    salida = Response(
+        stream_with_context(generar()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # evitar buffering en proxies
+        }
+    )
+    if turno is not None:
+        # Por si el cliente se va antes de que empiece el generador
+        salida.call_on_close(turno.liberar)
+    return salida
+
 # =====================================================
 # INICIAR SERVIDOR
 # =====================================================
 
+def iniciar_servicios():
+    """Precalienta pool BD e índices en memoria antes de aceptar peticiones"""
+    try:
+        pool_gesden.calentar()
+        logging.info(f"✅ Pool BD listo: {pool_gesden.estadisticas()['abiertas']} conexiones")
+    except Exception as e:
+        logging.error(f"⚠️ No se pudo precalentar el pool BD: {e}")
+    
+    try:
+        indice_pacientes.cargar()
+    except Exception as e:
+        logging.error(f"⚠️ Índice de pacientes no disponible, se usará SQL: {e}")
+    indice_pacientes.iniciar_refresco()
+    vigilante_agenda.iniciar()
+    
+    if replica_gesden is not None:
+        # Copia inicial en segundo plano: hasta que esté al día se lee de SQL Server
+        replica_gesden.iniciar()
+
+
+def detener_servicios():
+    """Detiene hilos de fondo y cierra el pool BD"""
+    indice_pacientes.detener()
+    vigilante_agenda.detener()
+    if replica_gesden is not None:
+        replica_gesden.detener()
+    pool_gesden.cerrar()
+
+
+def servir_produccion():
+    """
+    Servidor WSGI multihilo (waitress) para la clínica (Windows).
+
+    En Linux se recomienda gunicorn con gunicorn.conf.py, que arranca
+    un pool BD propio por cada worker.
+    """
+    from waitress import serve
+    import signal
+    
+    if Config.POOL_MAX < Config.API_HILOS:
+        logging.warning(f"⚠️ GESDEN_POOL_MAX ({Config.POOL_MAX}) < API_HILOS ({Config.API_HILOS}): "
+                        f"habrá peticiones esperando conexión BD")
+    
+    # SIGTERM (servicio/contenedor) -> misma salida ordenada que Ctrl+C
+    def _terminar(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, _terminar)
+    
+    serve(
+        app,
+        host=Config.API_HOST,
+        port=Config.API_PORT,
+        threads=Config.API_HILOS,
+        channel_timeout=120,  # las respuestas de Gemini pueden tardar
+        ident='gesden-api'
+    )
+
+
 if __name__ == '__main__':
+    servidor = 'waitress' if '--produccion' in sys.argv else Config.API_SERVIDOR
+    
     print("=" * 60)
     print("🚀 AGENTE GESDEN IA - API SERVER")
     print("=" * 60)
@@ -658,16 +3259,28 @@ if __name__ == '__main__':
     print("🌐 Acceso remoto: Vía Ngrok")
     print("🤖 IA: Google Gemini 2.0 Flash (GRATIS)")
     print()
-    print("📍 Servidor: http://localhost:5000")
+    print(f"📍 Servidor: http://{Config.API_HOST}:{Config.API_PORT} ({servidor})")
     print()
     print("=" * 60)
     print()
     
+    iniciar_servicios()
+    
     # Detectar si estamos en desarrollo o producción
     is_dev = os.getenv('FLASK_ENV') == 'development'
     
-    app.run(
-        host='127.0.0.1',
-        port=5000,
-        debug=is_dev  # Solo debug en desarrollo
-    )
+    try:
+        if servidor == 'waitress':
+            servir_produccion()
+        else:
+            app.run(
+                host=Config.API_HOST,
+                port=Config.API_PORT,
+                debug=is_dev,  # Solo debug en desarrollo
+                threaded=True
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info("🛑 Deteniendo servidor...")
+        detener_servicios()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+=====================================================
+AGENTE GESDEN IA - PRUEBA DE CARGA
+=====================================================
+
+Lanza N usuarios concurrentes contra api_server y mide la latencia
+de las rutas de búsqueda, agenda y comando IA (p50/p95/p99).
+
+Reproducible: cada usuario usa un generador aleatorio con semilla fija,
+así dos ejecuciones con los mismos parámetros hacen las mismas peticiones.
+
+Uso:
+    python benchmark_api.py --url http://localhost:5000 --usuarios 10 --duracion 30
+    python benchmark_api.py --sin-comando --json resultados.json
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+BUSQUEDAS = ['garcia', 'lopez', 'mar', 'fer', 'jose', 'rodriguez', 'ana', 'sanchez', '4134', '100']
+COMANDOS = ['citas de hoy', 'citas mañana', 'busca García', 'qué huecos hay el lunes']
+
+
+def peticion_buscar(rng):
+    return '/api/pacientes/buscar', {'busqueda': rng.choice(BUSQUEDAS)}
+
+
+def peticion_agenda(rng):
+    fecha = datetime.now() + timedelta(days=rng.randint(0, 13))
+    return '/api/citas/listar', {'fecha': fecha.strftime('%Y-%m-%d')}
+
+
+def peticion_comando(rng):
+    return '/api/comando', {'comando': rng.choice(COMANDOS)}
+
+
+RUTAS = {
+    'buscar': peticion_buscar,
+    'agenda': peticion_agenda,
+    'comando': peticion_comando,
+}
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano sobre una lista ordenada"""
+    if not valores:
+        return 0.0
+    indice = max(0, min(len(valores) - 1, int(round(p / 100 * len(valores) + 0.5)) - 1))
+    return valores[indice]
+
+
+def usuario_virtual(num, args, pesos, resultados, lock, fin):
+    rng = random.Random(args.semilla + num)
+    nombres = list(pesos)
+    while time.monotonic() < fin:
+        ruta = rng.choices(nombres, weights=[pesos[n] for n in nombres])[0]
+        path, cuerpo = RUTAS[ruta](rng)
+        datos = json.dumps(cuerpo).encode('utf-8')
+        req = urllib.request.Request(
+            args.url.rstrip('/') + path, data=datos,
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+
+        inicio = time.perf_counter()
+        ok = True
+        try:
+            with urllib.request.urlopen(req, timeout=args.timeout) as resp:
+                resp.read()
+                ok = resp.status < 400
+        except (urllib.error.URLError, OSError):
+            ok = False
+        ms = (time.perf_counter() - inicio) * 1000
+
+        with lock:
+            r = resultados.setdefault(ruta, {'latencias': [], 'errores': 0})
+            r['latencias'].append(ms)
+            if not ok:
+                r['errores'] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga de api_server')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--usuarios', type=int, default=10, help='usuarios concurrentes')
+    parser.add_argument('--duracion', type=float, default=30, help='segundos de prueba')
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--peso-buscar', type=int, default=60)
+    parser.add_argument('--peso-agenda', type=int, default=30)
+    parser.add_argument('--peso-comando', type=int, default=10)
+    parser.add_argument('--sin-comando', action='store_true', help='no llamar a Gemini')
+    parser.add_argument('--json', help='guardar resultados en este fichero')
+    args = parser.parse_args()
+
+    pesos = {'buscar': args.peso_buscar, 'agenda': args.peso_agenda, 'comando': args.peso_comando}
+    if args.sin_comando:
+        pesos.pop('comando')
+    pesos = {ruta: peso for ruta, peso in pesos.items() if peso > 0}
+
+    print(f"🔥 {args.usuarios} usuarios durante {args.duracion:.0f}s contra {args.url}")
+
+    resultados = {}
+    lock = threading.Lock()
+    fin = time.monotonic() + args.duracion
+    hilos = [
+        threading.Thread(target=usuario_virtual, args=(n, args, pesos, resultados, lock, fin))
+        for n in range(args.usuarios)
+    ]
+    inicio = time.monotonic()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    total_seg = time.monotonic() - inicio
+
+    resumen = {}
+    print()
+    print(f"{'ruta':<10}{'n':>7}{'err':>6}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (ms)")
+    for ruta in sorted(resultados):
+        latencias = sorted(resultados[ruta]['latencias'])
+        fila = {
+            'n': len(latencias),
+            'errores': resultados[ruta]['errores'],
+            'rps': round(len(latencias) / total_seg, 2),
+            'p50': round(percentil(latencias, 50), 1),
+            'p95': round(percentil(latencias, 95), 1),
+            'p99': round(percentil(latencias, 99), 1),
+            'max': round(latencias[-1], 1) if latencias else 0.0,
+        }
+        resumen[ruta] = fila
+        print(f"{ruta:<10}{fila['n']:>7}{fila['errores']:>6}{fila['rps']:>8}"
+              f"{fila['p50']:>9}{fila['p95']:>9}{fila['p99']:>9}{fila['max']:>9}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'url': args.url,
+                'usuarios': args.usuarios,
+                'duracion': args.duracion,
+                'semilla': args.semilla,
+                'fecha': datetime.now().isoformat(),
+                'rutas': resumen,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Resultados guardados en {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+=====================================================
+CODEC DE FECHAS Y HORAS GESDEN
+=====================================================
+
+Gesden guarda:
+- Fechas como número de días desde 30/12/1899 (fecha OLE)
+- Horas como entero HHMMSS (103000 = 10:30)
+
+Convertir fila a fila con datetime + timedelta + strftime domina la CPU
+en listados grandes. Aquí se precalculan tablas:
+- Fecha -> 'YYYY-MM-DD' para el rango realista de la clínica (1900-2060)
+- HHMM -> 'HH:MM' para todas las horas del día
+
+Con NumPy instalado, `convertir_columnas` convierte columnas completas
+de un resultado de una vez (indexando las tablas con arrays).
+Lo usan api_server.py y agente_gesden_v4_0.py.
+"""
+
+from datetime import date, datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:  # NumPy es opcional: sin él se usan las mismas tablas fila a fila
+    np = None
+
+BASE = datetime(1899, 12, 30)
+_BASE_ORDINAL = BASE.toordinal()
+
+# Rango precalculado (fuera de él se calcula con datetime)
+FECHA_MIN = date(1900, 1, 1).toordinal() - _BASE_ORDINAL
+FECHA_MAX = date(2060, 12, 31).toordinal() - _BASE_ORDINAL
+
+_FECHAS_ISO = [
+    date.fromordinal(_BASE_ORDINAL + n).isoformat()
+    for n in range(FECHA_MIN, FECHA_MAX + 1)
+]
+
+# Índice HHMM (0..2359) -> 'HH:MM'; los HHMM imposibles (10:75) se calculan igual que antes
+_HORAS_STR = [f"{hhmm // 100:02d}:{hhmm % 100:02d}" for hhmm in range(2400)]
+
+if np is not None:
+    _FECHAS_ISO_NP = np.array(_FECHAS_ISO, dtype=object)
+    _HORAS_STR_NP = np.array(_HORAS_STR, dtype=object)
+
+
+# =====================================================
+# FECHAS
+# =====================================================
+
+def fecha_a_iso(fecha_int):
+    """Fecha Gesden (int) -> 'YYYY-MM-DD' (None si viene vacía)"""
+    if not fecha_int:
+        return None
+    if isinstance(fecha_int, (datetime, date)):
+        return fecha_int.strftime('%Y-%m-%d')
+    n = int(fecha_int)
+    if FECHA_MIN <= n <= FECHA_MAX:
+        return _FECHAS_ISO[n - FECHA_MIN]
+    return (BASE + timedelta(days=n)).strftime('%Y-%m-%d')
+
+
+def fecha_a_datetime(fecha_int):
+    """Fecha Gesden (int) -> datetime a medianoche"""
+    return datetime.fromordinal(_BASE_ORDINAL + int(fecha_int))
+
+
+def iso_a_fecha(fecha_iso):
+    """'YYYY-MM-DD' -> fecha Gesden (int)"""
+    return datetime.strptime(fecha_iso, '%Y-%m-%d').toordinal() - _BASE_ORDINAL
+
+
+def datetime_a_fecha(fecha):
+    """datetime/date -> fecha Gesden (int)"""
+    return fecha.toordinal() - _BASE_ORDINAL
+
+
+# =====================================================
+# HORAS
+# =====================================================
+
+def hora_a_str(hora_int):
+    """Hora Gesden (HHMMSS) -> 'HH:MM' ('00:00' si viene vacía)"""
+    if not hora_int:
+        return "00:00"
+    hhmm = int(hora_int) // 100
+    if 0 <= hhmm < 2400:
+        return _HORAS_STR[hhmm]
+    return f"{hora_int // 10000:02d}:{(hora_int % 10000) // 100:02d}"
+
+
+def str_a_hora(hora_str):
+    """'HH:MM' (o 'HH') -> hora Gesden (HHMMSS)"""
+    partes = hora_str.split(':')
+    horas = int(partes[0])
+    minutos = int(partes[1]) if len(partes) > 1 else 0
+    return (horas * 10000) + (minutos * 100)
+
+
+# =====================================================
+# CONVERSIÓN POR COLUMNAS
+# =====================================================
+
+def fechas_a_iso(valores):
+    """Lista de fechas Gesden -> lista de 'YYYY-MM-DD' (None para vacías)"""
+    if np is None or not valores:
+        return [fecha_a_iso(v) for v in valores]
+
+    try:
+        arr = np.array([v if v else 0 for v in valores], dtype=np.int64)
+    except (TypeError, ValueError):
+        # Columnas mezcladas (p.ej. datetime): fila a fila
+        return [fecha_a_iso(v) for v in valores]
+
+    en_rango = (arr >= FECHA_MIN) & (arr <= FECHA_MAX)
+    resultado = np.full(len(arr), None, dtype=object)
+    resultado[en_rango] = _FECHAS_ISO_NP[arr[en_rango] - FECHA_MIN]
+
+    # Valores fuera de tabla (poco habituales) por la vía lenta
+    for i in np.flatnonzero(~en_rango & (arr != 0)):
+        resultado[i] = fecha_a_iso(int(arr[i]))
+    return resultado.tolist()
+
+
+def horas_a_str(valores):
+    """Lista de horas Gesden -> lista de 'HH:MM'"""
+    if np is None or not valores:
+        return [hora_a_str(v) for v in valores]
+
+    try:
+        hhmm = np.array([v or 0 for v in valores], dtype=np.int64) // 100
+    except (TypeError, ValueError):
+        return [hora_a_str(v) for v in valores]
+
+    en_rango = (hhmm >= 0) & (hhmm < 2400)
+    resultado = np.full(len(hhmm), "00:00", dtype=object)
+    resultado[en_rango] = _HORAS_STR_NP[hhmm[en_rango]]
+    for i in np.flatnonzero(~en_rango):
+        resultado[i] = hora_a_str(int(valores[i]))
+    return resultado.tolist()
+
+
+def convertir_columnas(filas, fechas=(), horas=()):
+    """
+    Convierte en bloque columnas de una lista de dicts.
+
+    fechas / horas: nombres de columna, o pares (origen, destino) para
+    dejar el valor convertido en otra columna. Modifica `filas` in situ.
+    """
+    if not filas:
+        return filas
+
+    for columnas, conversor in ((fechas, fechas_a_iso), (horas, horas_a_str)):
+        for columna in columnas:
+            origen, destino = columna if isinstance(columna, tuple) else (columna, columna)
+            convertidos = conversor([fila.get(origen) for fila in filas])
+            for fila, valor in zip(filas, convertidos):
+                fila[destino] = valor
+    return filas
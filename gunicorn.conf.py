@@ -0,0 +1,32 @@
+"""
+Configuración de gunicorn para api_server (Linux)
+
+    gunicorn -c gunicorn.conf.py api_server:app
+
+Cada worker es un proceso con su propio pool BD, índice de pacientes y
+caché de agenda; se inicializan al arrancar el worker y se cierran al
+terminar (SIGTERM = parada ordenada). La réplica SQLite (GESDEN_REPLICA_RUTA)
+es un solo fichero: la sincroniza el worker que tiene su cerrojo y los
+demás solo la leen.
+"""
+
+import os
+
+bind = f"{os.getenv('API_HOST', '127.0.0.1')}:{os.getenv('API_PORT', '5000')}"
+workers = int(os.getenv('API_WORKERS', '2'))
+threads = int(os.getenv('API_HILOS', '8'))
+worker_class = 'gthread'
+
+# Las llamadas a Gemini pueden tardar varios segundos
+timeout = int(os.getenv('API_TIMEOUT', '120'))
+graceful_timeout = 30
+
+
+def post_worker_init(worker):
+    import api_server
+    api_server.iniciar_servicios()
+
+
+def worker_exit(server, worker):
+    import api_server
+    api_server.detener_servicios()
@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+"""
+=====================================================
+RÉPLICA LOCAL (SQLite) DE PACIENTES, DCITAS Y TCOLABOS
+=====================================================
+
+Las lecturas de la web cruzan el túnel hasta el SQL Server de la clínica
+y cargan la misma máquina que usa Gesden escritorio. Esta réplica guarda
+en un SQLite local las columnas que lee api_server.py:
+
+- Copia inicial completa (bloques con fetchmany + executemany)
+- Pacientes: incremental por _fechaModif (y altas con _fechaModif NULL por
+  IdPac); cada cierto tiempo se repasan las claves para quitar los borrados
+- DCitas: altas por IdCita y, en la ventana de días activa, firma por día
+  (COUNT + CHECKSUM_AGG) que detecta modificaciones y borrados. Fuera de
+  esa ventana la réplica no está vigilada: `cubre()` dice a api_server
+  cuándo debe leer de SQL Server
+- TColabos: se recarga entera cuando cambia su firma
+
+Las escrituras siguen yendo a GELITE; tras escribir, api_server pide
+una sincronización inmediata de las altas de DCitas.
+
+Con varios procesos (workers de gunicorn) sobre el mismo fichero solo
+sincroniza el que tiene el cerrojo `<ruta>.lock`; el resto lee la réplica
+y sigue por la tabla _cambios los días de DCitas que hay que invalidar.
+Si el que sincroniza termina, otro toma el cerrojo.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+import gesden_codec
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
+
+TABLAS = {
+    'Pacientes': {
+        'clave': 'IdPac',
+        'columnas': ['IdPac', 'IdCentro', 'NumPac', 'Nombre', 'Apellidos', 'TelMovil',
+                     'Email', 'FecNacim', '_fechaModif'],
+        'indices': ['IdCentro, NumPac'],
+    },
+    'DCitas': {
+        'clave': 'IdCita',
+        'columnas': ['IdCita', 'IdCentro', 'IdPac', 'IdUsu', 'IdOrden', 'Fecha', 'Hora',
+                     'Duracion', 'Texto', 'IdSitC'],
+        'indices': ['IdCentro, Fecha, Hora', 'IdCentro, IdUsu, Fecha'],
+    },
+    'TColabos': {
+        'clave': 'IdCol',
+        'columnas': ['IdCol', 'Codigo', 'Nombre', 'Apellidos', 'Activo'],
+        'indices': [],
+    },
+}
+
+
+def _valor(valor):
+    """Valor de pyodbc -> tipo que SQLite acepta"""
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return int(valor) if valor == valor.to_integral_value() else float(valor)
+    return valor
+
+
+def _fila_dict(cursor, fila):
+    return {col[0]: valor for col, valor in zip(cursor.description, fila)}
+
+
+def _tomar_cerrojo(fichero):
+    """Cerrojo exclusivo sin esperar sobre un fichero abierto. True si se consigue"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(fichero.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fichero.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+class ReplicaGesden:
+    """
+    Réplica SQLite de las tablas de lectura de un centro.
+    
+    `iterar(sql, params, lote)` y `consultar(sql, params)` leen del SQL Server
+    de origen (GesdenDB.iterar_query / GesdenDB.ejecutar_query).
+    """
+    
+    def __init__(self, ruta, iterar, consultar, id_centro, intervalo=5, max_retraso=30,
+                 dias_atras=7, dias_adelante=90, lote=1000, reconciliar=300):
+        self.ruta = str(ruta)
+        self.origen_iterar = iterar
+        self.origen_consultar = consultar
+        self.id_centro = id_centro
+        self.intervalo = intervalo
+        self.max_retraso = max_retraso
+        self.dias_atras = dias_atras
+        self.dias_adelante = dias_adelante
+        self.lote = lote
+        self.reconciliar = reconciliar  # cada cuánto se repasan las claves de Pacientes (s, 0 = nunca)
+        
+        self.listo = False
+        self.sincroniza = False         # este proceso tiene el cerrojo y escribe la réplica
+        self.al_cambiar_citas = []      # funciones(fechas) a avisar cuando cambian días de DCitas
+        
+        self._lock = threading.Lock()   # una sincronización a la vez (una sola conexión de escritura)
+        self._local = threading.local()  # conexión de lectura por hilo
+        self._escritura = None
+        self._cerrojo = None            # fichero <ruta>.lock abierto
+        self._ultima_ok = None          # time.monotonic() de la última sincronización completa
+        self._sincronizado_en = None    # time.time() del inicio de la última sincronización completa
+        self._exigir_desde = None       # time.time() de una escritura que la réplica aún no ha visto
+        self._ventana_ok = None         # (desde, hasta) vigilada en la última sincronización
+        self._marca_pacientes = None    # mayor _fechaModif copiado
+        self._max_pac = 0               # mayor IdPac copiado (altas con _fechaModif NULL)
+        self._ultima_reconciliacion = None
+        self._marca_cita = 0            # mayor IdCita copiado
+        self._seq_cambios = None        # último _cambios.seq leído (procesos que no sincronizan)
+        self._firmas_dia = None         # Fecha -> (Total, Firma) en la ventana activa
+        self._firma_colabos = None
+        
+        self._parar = threading.Event()
+        self._hilo = None
+        
+        self.stats = {
+            'sincronizaciones': 0, 'errores': 0, 'copias_completas': 0,
+            'pacientes': 0, 'pacientes_borrados': 0, 'reconciliaciones': 0,
+            'citas_nuevas': 0, 'dias_recargados': 0, 'recargas_colabos': 0,
+            'lecturas': 0, 'ultima_ms': 0.0,
+        }
+    
+    # Conexiones y esquema
+    def _conectar_escritura(self):
+        if self._escritura is None:
+            conn = sqlite3.connect(self.ruta, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")   # lectores no bloquean al sincronizar
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._crear_esquema(conn)
+            self._escritura = conn
+        return self._escritura
+    
+    def _conexion_lectura(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.ruta, check_same_thread=False)
+            conn.execute("PRAGMA query_only=1")
+            conn.row_factory = _fila_dict
+            self._local.conn = conn
+        return conn
+    
+    @staticmethod
+    def _crear_esquema(conn):
+        with conn:
+            for nombre, tabla in TABLAS.items():
+                columnas = ', '.join(
+                    f"{c} INTEGER PRIMARY KEY" if c == tabla['clave'] else c
+                    for c in tabla['columnas']
+                )
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {nombre} ({columnas})")
+                for i, indice in enumerate(tabla['indices']):
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{nombre}_{i} ON {nombre} ({indice})")
+            conn.execute("CREATE TABLE IF NOT EXISTS _meta (clave TEXT PRIMARY KEY, valor TEXT)")
+            # Días de DCitas cambiados, para que los demás procesos invaliden su caché
+            conn.execute("CREATE TABLE IF NOT EXISTS _cambios (seq INTEGER PRIMARY KEY AUTOINCREMENT, fecha INTEGER)")
+    
+    def _meta(self, conn, clave):
+        fila = conn.execute("SELECT valor FROM _meta WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] if fila else None
+    
+    def _guardar_meta(self, conn, **valores):
+        conn.executemany(
+            "INSERT OR REPLACE INTO _meta (clave, valor) VALUES (?, ?)",
+            [(clave, None if valor is None else str(valor)) for clave, valor in valores.items()]
+        )
+    
+    # Copia desde SQL Server
+    def _volcar(self, conn, nombre, where='', params=()):
+        """Copia filas de origen (INSERT OR REPLACE). Devuelve (filas, fechas de cita, max _fechaModif)"""
+        columnas = TABLAS[nombre]['columnas']
+        insertar = (f"INSERT OR REPLACE INTO {nombre} ({', '.join(columnas)}) "
+                    f"VALUES ({', '.join('?' * len(columnas))})")
+        sql = f"SELECT {', '.join(columnas)} FROM {nombre} {where}"
+        
+        total, fechas, marca = 0, set(), None
+        bloque = []
+        for fila in self.origen_iterar(sql, params, self.lote):
+            modif = fila.get('_fechaModif')
+            if modif is not None and (marca is None or modif > marca):
+                marca = modif
+            if nombre == 'DCitas':
+                fechas.add(fila['Fecha'])
+            bloque.append(tuple(_valor(fila[c]) for c in columnas))
+            if len(bloque) >= self.lote:
+                conn.executemany(insertar, bloque)
+                total += len(bloque)
+                bloque = []
+        if bloque:
+            conn.executemany(insertar, bloque)
+            total += len(bloque)
+        return total, fechas, marca
+    
+    def _ventana(self):
+        hoy = gesden_codec.datetime_a_fecha(datetime.now())
+        return hoy - self.dias_atras, hoy + self.dias_adelante
+    
+    def _leer_firmas_dia(self):
+        desde, hasta = self._ventana()
+        filas = self.origen_consultar(
+            """
+            SELECT Fecha, COUNT(*) AS Total,
+                   CHECKSUM_AGG(BINARY_CHECKSUM(IdCita, IdPac, IdUsu, Fecha, Hora, Duracion, Texto, IdSitC)) AS Firma
+            FROM DCitas
+            WHERE IdCentro = ? AND Fecha BETWEEN ? AND ?
+            GROUP BY Fecha
+            """,
+            (self.id_centro, desde, hasta)
+        )
+        return {fila['Fecha']: (fila['Total'], fila['Firma']) for fila in filas}
+    
+    def _leer_firma_colabos(self):
+        fila = self.origen_consultar(
+            "SELECT COUNT(*) AS Total, "
+            "CHECKSUM_AGG(BINARY_CHECKSUM(IdCol, Codigo, Nombre, Apellidos, Activo)) AS Firma "
+            "FROM TColabos"
+        )[0]
+        return fila['Total'], fila['Firma']
+    
+    def _copia_completa(self, conn):
+        # Firmas antes de copiar: un cambio durante la copia se volverá a detectar
+        firmas = self._leer_firmas_dia()
+        firma_colabos = self._leer_firma_colabos()
+        
+        with conn:
+            for nombre in TABLAS:
+                conn.execute(f"DELETE FROM {nombre}")
+            _, _, marca = self._volcar(conn, 'Pacientes', "WHERE IdCentro = ?", (self.id_centro,))
+            self._volcar(conn, 'DCitas', "WHERE IdCentro = ?", (self.id_centro,))
+            self._volcar(conn, 'TColabos')
+            
+            self._marca_pacientes = marca
+            self._leer_maximos(conn)
+            self._guardar_meta(conn, copia_completa=datetime.now().isoformat(),
+                               marca_pacientes=marca.isoformat() if marca else None,
+                               marca_cita=self._marca_cita)
+        
+        self._firmas_dia = firmas
+        self._firma_colabos = firma_colabos
+        self._ventana_ok = self._ventana()
+        self._ultima_reconciliacion = time.monotonic()
+        self.stats['copias_completas'] += 1
+    
+    def _leer_maximos(self, conn):
+        self._max_pac = conn.execute("SELECT COALESCE(MAX(IdPac), 0) FROM Pacientes").fetchone()[0]
+        self._marca_cita = conn.execute("SELECT COALESCE(MAX(IdCita), 0) FROM DCitas").fetchone()[0]
+    
+    def _publicar(self, conn, inicio, fechas=()):
+        """Deja en _meta/_cambios lo que necesitan los procesos que solo leen"""
+        with conn:
+            if fechas:
+                conn.executemany("INSERT INTO _cambios (fecha) VALUES (?)", [(f,) for f in sorted(fechas)])
+                conn.execute("DELETE FROM _cambios WHERE seq <= (SELECT MAX(seq) FROM _cambios) - 10000")
+            if inicio is not None:
+                desde, hasta = self._ventana_ok
+                self._guardar_meta(conn, sincronizado_en=inicio, ventana_desde=desde, ventana_hasta=hasta)
+                self._sincronizado_en = inicio
+    
+    def cargar(self):
+        """Copia completa la primera vez; si ya hay réplica en disco, solo lo que falta"""
+        with self._lock:
+            inicio = time.perf_counter()
+            inicio_reloj = time.time()
+            conn = self._conectar_escritura()
+            
+            if self._meta(conn, 'copia_completa') is None:
+                self._copia_completa(conn)
+                fechas = set()
+                logging.info(f"✅ Réplica local creada en {time.perf_counter() - inicio:.1f}s: {self.ruta}")
+            else:
+                marca = self._meta(conn, 'marca_pacientes')
+                self._marca_pacientes = datetime.fromisoformat(marca) if marca else None
+                self._leer_maximos(conn)
+                # Sin firmas previas: la primera pasada recarga la ventana entera, y los
+                # Pacientes borrados mientras el proceso estuvo parado se repasan ya
+                self._firmas_dia = None
+                self._firma_colabos = None
+                self._ultima_reconciliacion = None
+                fechas = self._sincronizar(conn)
+                logging.info(f"✅ Réplica local puesta al día en {time.perf_counter() - inicio:.1f}s")
+            
+            self._publicar(conn, inicio_reloj, fechas)
+            self._ultima_ok = time.monotonic()
+            self.listo = True
+    
+    # Sincronización incremental
+    def _sincronizar_pacientes(self, conn):
+        # Las altas sin _fechaModif se reconocen por IdPac mayor que el último copiado
+        if self._marca_pacientes is None:
+            where = "WHERE IdCentro = ? AND (_fechaModif IS NOT NULL OR IdPac > ?)"
+            params = (self.id_centro, self._max_pac)
+        else:
+            # >= para no perder filas con la misma marca (reescribirlas es idempotente)
+            where = "WHERE IdCentro = ? AND (_fechaModif >= ? OR (_fechaModif IS NULL AND IdPac > ?))"
+            params = (self.id_centro, self._marca_pacientes, self._max_pac)
+        with conn:
+            total, _, marca = self._volcar(conn, 'Pacientes', where, params)
+            if marca is not None and (self._marca_pacientes is None or marca > self._marca_pacientes):
+                self._marca_pacientes = marca
+                self._guardar_meta(conn, marca_pacientes=marca.isoformat())
+            if total:
+                self._max_pac = conn.execute("SELECT COALESCE(MAX(IdPac), 0) FROM Pacientes").fetchone()[0]
+        self.stats['pacientes'] += total
+    
+    def _reconciliar_pacientes(self, conn):
+        """Repasa las claves de Pacientes: quita los borrados en origen y trae los que falten"""
+        origen = {fila['IdPac'] for fila in self.origen_iterar(
+            "SELECT IdPac FROM Pacientes WHERE IdCentro = ?", (self.id_centro,), self.lote
+        )}
+        locales = {fila[0] for fila in conn.execute(
+            "SELECT IdPac FROM Pacientes WHERE IdCentro = ?", (self.id_centro,)
+        )}
+        borrados = locales - origen
+        faltan = sorted(origen - locales)
+        
+        with conn:
+            conn.executemany("DELETE FROM Pacientes WHERE IdPac = ?", [(id_pac,) for id_pac in borrados])
+            for i in range(0, len(faltan), 500):
+                bloque = faltan[i:i + 500]
+                self._volcar(conn, 'Pacientes', f"WHERE IdPac IN ({', '.join('?' * len(bloque))})", bloque)
+        
+        self._ultima_reconciliacion = time.monotonic()
+        self.stats['reconciliaciones'] += 1
+        self.stats['pacientes_borrados'] += len(borrados)
+        if borrados or faltan:
+            logging.info(f"Réplica local: {len(borrados)} pacientes borrados, {len(faltan)} recuperados")
+    
+    def _sincronizar_citas_nuevas(self, conn):
+        with conn:
+            total, fechas, _ = self._volcar(
+                conn, 'DCitas', "WHERE IdCentro = ? AND IdCita > ? ORDER BY IdCita",
+                (self.id_centro, self._marca_cita)
+            )
+            if total:
+                self._marca_cita = conn.execute("SELECT COALESCE(MAX(IdCita), 0) FROM DCitas").fetchone()[0]
+                self._guardar_meta(conn, marca_cita=self._marca_cita)
+        self.stats['citas_nuevas'] += total
+        return fechas
+    
+    def _sincronizar_ventana(self, conn):
+        """Recarga los días de la ventana cuya firma en origen ha cambiado"""
+        firmas = self._leer_firmas_dia()
+        desde, hasta = self._ventana()
+        
+        with conn:
+            if self._firmas_dia is None:
+                conn.execute("DELETE FROM DCitas WHERE IdCentro = ? AND Fecha BETWEEN ? AND ?",
+                             (self.id_centro, desde, hasta))
+                self._volcar(conn, 'DCitas', "WHERE IdCentro = ? AND Fecha BETWEEN ? AND ?",
+                             (self.id_centro, desde, hasta))
+                cambiadas = set(firmas)
+            else:
+                cambiadas = {
+                    fecha for fecha in set(firmas) | set(self._firmas_dia)
+                    if desde <= fecha <= hasta and firmas.get(fecha) != self._firmas_dia.get(fecha)
+                }
+                if cambiadas:
+                    marcas = ', '.join('?' * len(cambiadas))
+                    params = (self.id_centro, *sorted(cambiadas))
+                    conn.execute(f"DELETE FROM DCitas WHERE IdCentro = ? AND Fecha IN ({marcas})", params)
+                    self._volcar(conn, 'DCitas', f"WHERE IdCentro = ? AND Fecha IN ({marcas})", params)
+        
+        self._firmas_dia = firmas
+        self._ventana_ok = (desde, hasta)
+        self.stats['dias_recargados'] += len(cambiadas)
+        return cambiadas
+    
+    def _sincronizar_colabos(self, conn):
+        firma = self._leer_firma_colabos()
+        if firma == self._firma_colabos:
+            return
+        with conn:
+            conn.execute("DELETE FROM TColabos")
+            self._volcar(conn, 'TColabos')
+        self._firma_colabos = firma
+        self.stats['recargas_colabos'] += 1
+    
+    def _avisar(self, fechas):
+        if not fechas:
+            return
+        for funcion in self.al_cambiar_citas:
+            try:
+                funcion(fechas)
+            except Exception as e:
+                logging.error(f"Error avisando cambios de la réplica: {e}")
+    
+    def _sincronizar(self, conn):
+        self._sincronizar_pacientes(conn)
+        if self.reconciliar and (self._ultima_reconciliacion is None
+                                 or time.monotonic() - self._ultima_reconciliacion >= self.reconciliar):
+            self._reconciliar_pacientes(conn)
+        fechas = self._sincronizar_citas_nuevas(conn)
+        fechas |= self._sincronizar_ventana(conn)
+        self._sincronizar_colabos(conn)
+        return fechas
+    
+    def sincronizar(self):
+        """Una pasada completa de sincronización incremental"""
+        with self._lock:
+            inicio = time.perf_counter()
+            inicio_reloj = time.time()
+            conn = self._conectar_escritura()
+            fechas = self._sincronizar(conn)
+            self._publicar(conn, inicio_reloj, fechas)
+            self._ultima_ok = time.monotonic()
+            self.stats['sincronizaciones'] += 1
+            self.stats['ultima_ms'] = round((time.perf_counter() - inicio) * 1000, 1)
+        self._avisar(fechas)
+    
+    def sincronizar_citas(self):
+        """Trae ya las altas de DCitas (tras escribir en GELITE desde la API)"""
+        if not self.listo:
+            return
+        if not self.sincroniza:
+            # Otro proceso escribe la réplica: hasta su próxima pasada se lee de SQL Server
+            self._exigir_desde = time.time()
+            return
+        try:
+            with self._lock:
+                conn = self._conectar_escritura()
+                fechas = self._sincronizar_citas_nuevas(conn)
+                self._publicar(conn, None, fechas)
+        except Exception as e:
+            self.stats['errores'] += 1
+            logging.error(f"Error sincronizando altas de citas en la réplica: {e}")
+            return
+        self._avisar(fechas)
+    
+    def _intentar_cerrojo(self):
+        """True si este proceso es (o pasa a ser) el que sincroniza la réplica"""
+        if self.sincroniza:
+            return True
+        if self._cerrojo is None:
+            self._cerrojo = open(self.ruta + '.lock', 'a+')
+        if _tomar_cerrojo(self._cerrojo):
+            self.sincroniza = True
+            self.listo = False      # se carga desde disco como sincronizador
+            logging.info(f"Réplica local: este proceso ({os.getpid()}) la sincroniza")
+        return self.sincroniza
+    
+    def _seguir(self):
+        """Proceso que solo lee: estado y días cambiados según el que sincroniza"""
+        conn = self._conexion_lectura()
+        try:
+            meta = {fila['clave']: fila['valor'] for fila in conn.execute("SELECT clave, valor FROM _meta")}
+            cambios = conn.execute(
+                "SELECT seq, fecha FROM _cambios WHERE seq > ? ORDER BY seq", (self._seq_cambios or 0,)
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return      # esquema aún sin crear
+        
+        if meta.get('sincronizado_en') is None:
+            return
+        self._sincronizado_en = float(meta['sincronizado_en'])
+        self._ventana_ok = (int(meta['ventana_desde']), int(meta['ventana_hasta']))
+        self._ultima_ok = time.monotonic() - max(0.0, time.time() - self._sincronizado_en)
+        self.listo = True
+        
+        if cambios:
+            # La primera vez solo se toma la posición: la caché de este proceso aún está vacía
+            if self._seq_cambios is not None:
+                self._avisar({fila['fecha'] for fila in cambios})
+            self._seq_cambios = cambios[-1]['seq']
+        elif self._seq_cambios is None:
+            self._seq_cambios = 0
+    
+    def _paso(self):
+        if not self._intentar_cerrojo():
+            self._seguir()
+        elif self.listo:
+            self.sincronizar()
+        else:
+            self.cargar()
+    
+    def _bucle(self):
+        try:
+            self._paso()
+        except Exception as e:
+            self.stats['errores'] += 1
+            logging.error(f"⚠️ Réplica local no disponible, se leerá de SQL Server: {e}")
+        
+        while not self._parar.wait(self.intervalo):
+            try:
+                self._paso()
+            except Exception as e:
+                self.stats['errores'] += 1
+                logging.error(f"Error sincronizando réplica local: {e}")
+    
+    def iniciar(self):
+        """Copia inicial y sincronización periódica en un hilo de fondo"""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle, name='replica-local', daemon=True)
+        self._hilo.start()
+    
+    def detener(self):
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout=self.intervalo + 5)
+        if self._cerrojo is not None:
+            self._cerrojo.close()   # libera el cerrojo para otro proceso
+            self._cerrojo = None
+            self.sincroniza = False
+    
+    # Lectura
+    def retraso(self):
+        """Segundos desde la última sincronización completa (None si nunca)"""
+        return None if self._ultima_ok is None else time.monotonic() - self._ultima_ok
+    
+    def al_dia(self):
+        """True si se puede leer de la réplica sin pasar del retraso máximo"""
+        retraso = self.retraso()
+        if self._exigir_desde is not None:
+            if self._sincronizado_en is None or self._sincronizado_en < self._exigir_desde:
+                return False
+            self._exigir_desde = None
+        return self.listo and retraso is not None and retraso <= self.max_retraso
+    
+    def cubre(self, desde, hasta, id_centro=None):
+        """True si las DCitas de [desde, hasta] (fechas Gesden) están vigiladas en la réplica"""
+        if id_centro is not None and id_centro != self.id_centro:
+            return False
+        ventana = self._ventana_ok
+        return ventana is not None and ventana[0] <= desde and hasta <= ventana[1]
+    
+    def consultar(self, sql, params=None):
+        """SELECT sobre la réplica -> lista de dicts"""
+        cursor = self._conexion_lectura().execute(sql, params or ())
+        try:
+            self.stats['lecturas'] += 1
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+    
+    def iterar(self, sql, params=None, lote=500):
+        """Generador de filas (dict) de la réplica leídas por bloques"""
+        cursor = self._conexion_lectura().execute(sql, params or ())
+        try:
+            self.stats['lecturas'] += 1
+            while True:
+                filas = cursor.fetchmany(lote)
+                if not filas:
+                    break
+                yield from filas
+        finally:
+            cursor.close()
+    
+    def estadisticas(self):
+        retraso = self.retraso()
+        return dict(
+            self.stats,
+            listo=self.listo,
+            al_dia=self.al_dia(),
+            retraso_seg=round(retraso, 1) if retraso is not None else None,
+            max_retraso=self.max_retraso,
+            sincroniza=self.sincroniza,
+            ventana=list(self._ventana_ok) if self._ventana_ok else None,
+            marca_cita=self._marca_cita,
+            marca_pacientes=self._marca_pacientes.isoformat() if self._marca_pacientes else None,
+        )
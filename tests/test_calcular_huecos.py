@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Huecos libres de la agenda (calcular_huecos de api_server).
+
+    python -m unittest discover -s tests
+
+Necesita las dependencias de requirements.txt (flask, pyodbc,
+google-generativeai); sin ellas se salta. Se compara con un cálculo
+minuto a minuto sobre agendas aleatorias.
+"""
+
+import random
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+try:
+    import api_server
+except ImportError:
+    api_server = None
+
+JORNADA = [(9 * 60, 14 * 60), (16 * 60, 20 * 60)]
+
+
+def huecos_minuto_a_minuto(ocupadas, jornada, duracion, desde_minuto=0):
+    """Tramos máximos de minutos libres de al menos `duracion`"""
+    ocupado = set()
+    for inicio, fin in ocupadas:
+        ocupado.update(range(inicio, fin))
+    huecos = []
+    for inicio_tramo, fin_tramo in jornada:
+        inicio = None
+        for minuto in range(max(inicio_tramo, desde_minuto), fin_tramo + 1):
+            libre = minuto < fin_tramo and minuto not in ocupado
+            if libre and inicio is None:
+                inicio = minuto
+            elif not libre and inicio is not None:
+                if minuto - inicio >= duracion:
+                    huecos.append((inicio, minuto))
+                inicio = None
+    return huecos
+
+
+@unittest.skipIf(api_server is None, "faltan dependencias (flask/pyodbc/google-generativeai)")
+class TestCalcularHuecos(unittest.TestCase):
+    
+    def test_agenda_concreta(self):
+        ocupadas = [(600, 630), (540, 570), (610, 660), (700, 720), (950, 990)]
+        self.assertEqual(
+            api_server.calcular_huecos(ocupadas, JORNADA, 30),
+            [(570, 600), (660, 700), (720, 840), (990, 1200)]
+        )
+        # Desde las 10:50 y con huecos de 45 min
+        self.assertEqual(api_server.calcular_huecos(ocupadas, JORNADA, 45, desde_minuto=650),
+                         [(720, 840), (990, 1200)])
+    
+    def test_sin_citas_y_agenda_llena(self):
+        self.assertEqual(api_server.calcular_huecos([], JORNADA, 30), JORNADA)
+        self.assertEqual(api_server.calcular_huecos([(500, 1300)], JORNADA, 5), [])
+    
+    def test_huecos_sin_solapes_frente_a_minuto_a_minuto(self):
+        aleatorio = random.Random(8)
+        for _ in range(300):
+            ocupadas = []
+            for _ in range(aleatorio.randint(0, 25)):
+                inicio = aleatorio.randrange(8 * 60, 21 * 60, 5)
+                ocupadas.append((inicio, inicio + aleatorio.choice((10, 15, 30, 45, 60, 90))))
+            duracion = aleatorio.choice((5, 15, 30, 60))
+            desde = aleatorio.choice((0, 0, aleatorio.randrange(9 * 60, 20 * 60)))
+            
+            huecos = api_server.calcular_huecos(list(ocupadas), JORNADA, duracion, desde)
+            self.assertEqual(huecos, huecos_minuto_a_minuto(ocupadas, JORNADA, duracion, desde))
+            
+            for (_, fin), (inicio_siguiente, _) in zip(huecos, huecos[1:]):
+                self.assertLessEqual(fin, inicio_siguiente)
+            for inicio, fin in huecos:
+                self.assertGreaterEqual(fin - inicio, duracion)
+                for inicio_cita, fin_cita in ocupadas:
+                    self.assertTrue(fin <= inicio_cita or inicio >= fin_cita)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Cartera de deuda por antigüedad a través de la acción 'cartera_deuda' del agente.
+
+    python -m unittest discover -s tests
+
+Necesita las dependencias de requirements.txt (pyodbc, numpy); sin ellas
+se salta. No abre conexión con SQL Server: la BD es un doble en memoria.
+"""
+
+import sys
+import unittest
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+try:
+    import agente_gesden_v4_0 as agente
+except ImportError:
+    agente = None
+
+HOY = None if agente is None else agente.ConversorFechas.datetime_a_fecha_gesden(datetime.now())
+
+
+class BDCartera:
+    """Responde a las dos consultas de GestorDeuda.cartera"""
+    
+    def __init__(self):
+        # Cliente 10 = familia (pacientes 1 y 2); cliente 20 = paciente 3
+        self.recibos = [
+            SimpleNamespace(IdCli=10, IdDeudaCli=100, FecPlazo=HOY - 100, Pendiente=50.0, NFactura='F-100'),
+            SimpleNamespace(IdCli=10, IdDeudaCli=101, FecPlazo=HOY - 10, Pendiente=30.0, NFactura=None),
+            SimpleNamespace(IdCli=20, IdDeudaCli=102, FecPlazo=HOY - 40, Pendiente=200.0, NFactura='F-102'),
+        ]
+        self.pacientes = [
+            SimpleNamespace(IdCli=10, IdPac=1, NumPac=11, Nombre='ANA', Apellidos='GARCIA', TelMovil='600111111'),
+            SimpleNamespace(IdCli=10, IdPac=2, NumPac=12, Nombre='LUIS', Apellidos='GARCIA', TelMovil=None),
+            SimpleNamespace(IdCli=20, IdPac=3, NumPac=13, Nombre='EVA', Apellidos='PEREZ', TelMovil='600333333'),
+        ]
+    
+    def iterar_query(self, sql, params=None, lote=1000):
+        return iter(self.recibos if sql == agente.GestorDeuda.SQL_CARTERA else self.pacientes)
+
+
+class PacientesFijos:
+    def __init__(self, pacientes):
+        self.pacientes = pacientes
+    
+    def buscar_por_nombre(self, texto):
+        return [p for p in self.pacientes if texto.upper() in f"{p['Nombre']} {p['Apellidos']}"]
+
+
+class IAFija:
+    """Motor IA que siempre devuelve la misma acción"""
+    
+    def __init__(self, parametros):
+        self.parametros = parametros
+    
+    def procesar(self, texto, usuario=None):
+        return {'accion': 'cartera_deuda', 'parametros': self.parametros, 'mensaje': ''}
+    
+    def anotar_paciente(self, usuario, paciente):
+        pass
+
+
+@unittest.skipIf(agente is None or agente.np is None, "faltan dependencias (pyodbc/numpy)")
+class TestCarteraDeuda(unittest.TestCase):
+    
+    def crear_agente(self, parametros):
+        bd = BDCartera()
+        ag = agente.AgenteGesdenIA.__new__(agente.AgenteGesdenIA)
+        ag.deuda = agente.GestorDeuda(bd)
+        ag.pacientes = PacientesFijos([
+            {'IdPac': p.IdPac, 'NumPac': p.NumPac, 'Nombre': p.Nombre, 'Apellidos': p.Apellidos}
+            for p in bd.pacientes
+        ])
+        ag.ia = IAFija(parametros)
+        ag.usuario = None
+        return ag
+    
+    def test_resumen_cuenta_cada_recibo_una_vez(self):
+        ag = self.crear_agente({})
+        respuesta = ag.procesar_comando("cartera de deuda")
+        
+        # 50 + 30 + 200: el cliente compartido por dos pacientes no se duplica
+        self.assertIn("280.00€ en 3 recibos de 2 clientes", respuesta)
+        resumen = ag.deuda.cartera().resumen()
+        self.assertEqual(resumen['tramos'], {'0-30': 30.0, '31-60': 200.0, '61-90': 0.0, '90+': 50.0})
+        self.assertEqual(resumen['pacientes'], 3)
+    
+    def test_ranking_por_cliente(self):
+        ag = self.crear_agente({'limite': 5})
+        respuesta = ag.procesar_comando("quién debe más")
+        
+        lineas = [l for l in respuesta.splitlines() if l.strip()[:2] in ('1.', '2.')]
+        self.assertIn("PEREZ EVA - 200.00€ (40 días)", lineas[0])
+        self.assertIn("GARCIA ANA, GARCIA LUIS - 80.00€ (100 días)", lineas[1])
+    
+    def test_dias_minimos(self):
+        ag = self.crear_agente({'dias_minimos': 91})
+        respuesta = ag.procesar_comando("morosos de más de 90 días")
+        
+        self.assertIn("GARCIA ANA, GARCIA LUIS - 80.00€", respuesta)
+        self.assertNotIn("PEREZ EVA", respuesta)
+    
+    def test_antiguedad_de_un_paciente(self):
+        ag = self.crear_agente({'nombre_paciente': 'Luis'})
+        respuesta = ag.procesar_comando("antigüedad de la deuda de Luis")
+        
+        self.assertIn("TOTAL PENDIENTE: 80.00€ (100 días el más antiguo)", respuesta)
+        self.assertIn("Cliente compartido con: GARCIA ANA", respuesta)
+        self.assertIn("50.00€ - 100 días (90+)", respuesta)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Catálogo de tratamientos en memoria (CatalogoTratamientos.buscar y recarga).
+
+    python -m unittest discover -s tests
+
+Necesita las dependencias de requirements.txt (pyodbc); sin ellas se salta.
+No abre conexión con SQL Server: la tabla Tratamientos es un doble en memoria.
+"""
+
+import sys
+import unittest
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+try:
+    import agente_gesden_v4_0 as agente
+except ImportError:
+    agente = None
+
+
+def tratamiento(id_tto, codigo, descripcion, precio):
+    return SimpleNamespace(IdTratamiento=id_tto, Codigo=codigo, Descrip=descripcion, Precio=precio)
+
+
+class BDTratamientos:
+    """Responde a SQL_CATALOGO y SQL_VERSION"""
+    
+    def __init__(self, filas):
+        self.filas = list(filas)
+        self.marca = datetime(2026, 1, 1)
+        self.consultas = []
+    
+    def ejecutar_query(self, sql, params=None):
+        self.consultas.append(sql)
+        if sql == agente.CatalogoTratamientos.SQL_VERSION:
+            return [SimpleNamespace(Filas=len(self.filas), Marca=self.marca)]
+        return list(self.filas)
+
+
+@unittest.skipIf(agente is None, "faltan dependencias (pyodbc)")
+class TestCatalogoTratamientos(unittest.TestCase):
+    
+    def setUp(self):
+        self.bd = BDTratamientos([
+            tratamiento(1, "EX", "Extracción simple", 40),
+            tratamiento(2, "EXQ", "Extracción quirúrgica cordal", 120),
+            tratamiento(3, "EN1", "Endodoncia unirradicular", 150),
+            tratamiento(4, "EN3", "Endodoncia multirradicular", 220),
+            tratamiento(5, "LIMP", "Limpieza bucal (tartrectomía)", 50),
+            tratamiento(6, None, "Revisión", None),
+        ])
+        self.catalogo = agente.CatalogoTratamientos(self.bd, intervalo=0)
+        self.catalogo.cargar()
+    
+    def ids(self, texto, limite=20):
+        return [t['IdTto'] for t in self.catalogo.buscar(texto, limite)]
+    
+    def test_codigo_exacto_primero(self):
+        # EX exacto delante; EXQ por prefijo de código; por descripción, "EXtracción"
+        self.assertEqual(self.ids("ex"), [1, 2])
+        self.assertEqual(self.ids("EXQ"), [2])
+    
+    def test_prefijo_de_codigo(self):
+        self.assertEqual(self.ids("EN"), [4, 3])
+    
+    def test_todas_las_palabras_por_prefijo_sin_tildes(self):
+        self.assertEqual(self.ids("endo multi"), [4])
+        self.assertEqual(self.ids("EXTRACCION"), [2, 1])
+        self.assertEqual(self.ids("extrac cordal"), [2])
+        self.assertEqual(self.ids("tartrectomia"), [5])
+        self.assertEqual(self.ids("endodoncia cordal"), [])
+    
+    def test_orden_por_descripcion_y_limite(self):
+        self.assertEqual(self.ids("endodoncia"), [4, 3])
+        self.assertEqual(self.ids("endodoncia", limite=1), [4])
+        self.assertEqual(self.ids("   "), [])
+    
+    def test_devuelve_copias(self):
+        self.catalogo.buscar("revision")[0]['Importe'] = 999
+        self.assertEqual(self.catalogo.buscar("revision"),
+                         [{'IdTto': 6, 'Codigo': None, 'Descripcion': 'Revisión', 'Importe': 0.0}])
+        self.assertEqual(self.catalogo.precio(4), 220.0)
+    
+    def test_no_consulta_sql_al_buscar(self):
+        consultas = len(self.bd.consultas)
+        self.ids("endo")
+        self.ids("EX")
+        self.assertEqual(len(self.bd.consultas), consultas)
+    
+    def test_recarga_si_cambia_la_version(self):
+        self.assertFalse(self.catalogo.comprobar())
+        self.bd.filas.append(tratamiento(7, "IMP", "Implante", 900))
+        self.assertTrue(self.catalogo.comprobar())
+        self.assertEqual(self.ids("implante"), [7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+gesden_codec frente a las conversiones originales con datetime + timedelta.
+
+    python -m unittest discover -s tests
+
+Sin dependencias: con NumPy instalado se comprueba además la conversión
+por columnas vectorizada.
+"""
+
+import sys
+import unittest
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import gesden_codec
+
+BASE = datetime(1899, 12, 30)
+
+# Fechas en días desde 1899-12-30: bordes de la tabla, años bisiestos y fuera de rango
+FECHAS = sorted({
+    1, 59, 60, 61, 366,
+    gesden_codec.FECHA_MIN - 1, gesden_codec.FECHA_MIN, gesden_codec.FECHA_MIN + 1,
+    gesden_codec.FECHA_MAX - 1, gesden_codec.FECHA_MAX, gesden_codec.FECHA_MAX + 1,
+    80000,
+    *range(36500, 36500 + 800),       # 1999-2002, con el 29/02/2000
+    *range(45000, 48000, 7),
+})
+
+# HHMMSS: todas las horas en punto y cada 5 min, con segundos, y valores imposibles
+HORAS = [None, 0, 1, 59, 100, 235959, 240000, 107500, 999999, 1000000] + [
+    h * 10000 + m * 100 + s for h in range(24) for m in range(0, 60, 5) for s in (0, 30)
+]
+
+
+# Conversiones tal como estaban en ConversorFechas / GesdenDB antes del codec
+
+def fecha_gesden_a_datetime(fecha_int):
+    return BASE + timedelta(days=fecha_int)
+
+
+def datetime_a_fecha_gesden(fecha):
+    return (fecha - BASE).days
+
+
+def fecha_gesden_a_iso(fecha_int):
+    if not fecha_int:
+        return None
+    return (BASE + timedelta(days=fecha_int)).strftime('%Y-%m-%d')
+
+
+def hora_gesden_a_str(hora_int):
+    if hora_int is None:
+        return "00:00"
+    return f"{hora_int // 10000:02d}:{(hora_int % 10000) // 100:02d}"
+
+
+def str_a_hora_gesden(hora_str):
+    partes = hora_str.split(':')
+    minutos = int(partes[1]) if len(partes) > 1 else 0
+    return int(partes[0]) * 10000 + minutos * 100
+
+
+class TestFechas(unittest.TestCase):
+    
+    def test_fecha_a_iso(self):
+        for n in FECHAS:
+            self.assertEqual(gesden_codec.fecha_a_iso(n), fecha_gesden_a_iso(n), n)
+        self.assertIsNone(gesden_codec.fecha_a_iso(None))
+        self.assertIsNone(gesden_codec.fecha_a_iso(0))
+    
+    def test_fecha_a_datetime_ida_y_vuelta(self):
+        for n in FECHAS:
+            fecha = gesden_codec.fecha_a_datetime(n)
+            self.assertEqual(fecha, fecha_gesden_a_datetime(n), n)
+            self.assertEqual(gesden_codec.datetime_a_fecha(fecha), datetime_a_fecha_gesden(fecha), n)
+            self.assertEqual(gesden_codec.datetime_a_fecha(fecha), n)
+    
+    def test_iso_a_fecha(self):
+        for n in FECHAS:
+            iso = fecha_gesden_a_iso(n)
+            self.assertEqual(gesden_codec.iso_a_fecha(iso), n, iso)
+    
+    def test_datetime_con_hora_y_date(self):
+        # La hora del día no cambia la fecha Gesden (delta.days trunca)
+        momento = datetime(2026, 3, 15, 18, 45)
+        self.assertEqual(gesden_codec.datetime_a_fecha(momento), datetime_a_fecha_gesden(momento))
+        self.assertEqual(gesden_codec.datetime_a_fecha(date(2026, 3, 15)), datetime_a_fecha_gesden(momento))
+        self.assertEqual(gesden_codec.fecha_a_iso(momento), '2026-03-15')
+
+
+class TestHoras(unittest.TestCase):
+    
+    def test_hora_a_str(self):
+        for hora in HORAS:
+            self.assertEqual(gesden_codec.hora_a_str(hora), hora_gesden_a_str(hora), hora)
+    
+    def test_str_a_hora(self):
+        for texto in ("00:00", "9:05", "10:30", "23:55", "10", "08"):
+            self.assertEqual(gesden_codec.str_a_hora(texto), str_a_hora_gesden(texto), texto)
+
+
+class TestColumnas(unittest.TestCase):
+    """Con o sin NumPy el resultado es el mismo que fila a fila"""
+    
+    def test_fechas_a_iso(self):
+        valores = [None, 0] + FECHAS
+        self.assertEqual(gesden_codec.fechas_a_iso(valores), [fecha_gesden_a_iso(v) for v in valores])
+    
+    def test_fechas_mezcladas(self):
+        valores = [45000, datetime(2026, 3, 15), None]
+        self.assertEqual(gesden_codec.fechas_a_iso(valores), [fecha_gesden_a_iso(45000), '2026-03-15', None])
+    
+    def test_horas_a_str(self):
+        self.assertEqual(gesden_codec.horas_a_str(HORAS), [hora_gesden_a_str(h) for h in HORAS])
+    
+    def test_convertir_columnas(self):
+        filas = [
+            {'Fecha': 45000, 'Hora': 103000},
+            {'Fecha': None, 'Hora': None},
+        ]
+        gesden_codec.convertir_columnas(filas, fechas=['Fecha'], horas=[('Hora', 'HoraStr')])
+        self.assertEqual(filas, [
+            {'Fecha': fecha_gesden_a_iso(45000), 'Hora': 103000, 'HoraStr': '10:30'},
+            {'Fecha': None, 'Hora': None, 'HoraStr': '00:00'},
+        ])
+        self.assertEqual(gesden_codec.convertir_columnas([], fechas=['Fecha']), [])
+
+
+class TestColumnasSinNumPy(TestColumnas):
+    """Misma batería por la vía fila a fila"""
+    
+    def setUp(self):
+        parche = mock.patch.object(gesden_codec, 'np', None)
+        parche.start()
+        self.addCleanup(parche.stop)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Motor IA en modo herramientas (tool_use) y ejecución de varias acciones por turno.
+
+    python -m unittest discover -s tests
+
+Necesita las dependencias de requirements.txt (pyodbc); sin ellas se salta.
+La API de Claude se sustituye por un cliente con respuestas fijas.
+"""
+
+import io
+import sys
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+try:
+    import agente_gesden_v4_0 as agente
+except ImportError:
+    agente = None
+
+
+def texto(contenido):
+    return SimpleNamespace(type='text', text=contenido)
+
+
+def herramienta(nombre, entrada):
+    return SimpleNamespace(type='tool_use', id=f'toolu_{nombre}', name=nombre, input=entrada)
+
+
+class ClienteClaude:
+    """messages.create devuelve los bloques indicados y guarda los argumentos"""
+    
+    def __init__(self, *bloques, error=None):
+        self.bloques = list(bloques)
+        self.error = error
+        self.llamadas = []
+        self.messages = self
+    
+    def create(self, **kwargs):
+        self.llamadas.append(kwargs)
+        if self.error:
+            raise self.error
+        return SimpleNamespace(
+            content=self.bloques,
+            usage=SimpleNamespace(input_tokens=40, cache_read_input_tokens=1500,
+                                  cache_creation_input_tokens=0, output_tokens=60)
+        )
+
+
+@unittest.skipIf(agente is None, "faltan dependencias (pyodbc)")
+class TestHerramientasIA(unittest.TestCase):
+    
+    def setUp(self):
+        for atributo, valor in (('IA_HERRAMIENTAS', True), ('ANTHROPIC_API_KEY', '')):
+            parche = mock.patch.object(agente.ConfigGesden, atributo, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
+        
+        with redirect_stdout(io.StringIO()):
+            self.motor = agente.MotorIA()
+        self.motor.disponible = True
+        
+        self.agente = agente.AgenteGesdenIA.__new__(agente.AgenteGesdenIA)
+        self.agente.ia = self.motor
+        self.agente.usuario = None
+    
+    def usar_cliente(self, *bloques, error=None):
+        self.motor.client = ClienteClaude(*bloques, error=error)
+        return self.motor.client
+    
+    def test_una_accion_por_bloque_tool_use(self):
+        cliente = self.usar_cliente(
+            texto("Busco a Ana y te enseño las citas de mañana."),
+            herramienta('buscar_paciente', {'busqueda': 'Ana García'}),
+            herramienta('listar_citas', {'fecha': 'mañana'}),
+        )
+        resultado = self.motor.procesar("busca a Ana García y dime las citas de mañana", 'recepcion')
+        
+        self.assertEqual(resultado['acciones'], [
+            {'accion': 'buscar_paciente', 'parametros': {'busqueda': 'Ana García'}},
+            {'accion': 'listar_citas', 'parametros': {'fecha': 'mañana'}},
+        ])
+        self.assertEqual(resultado['mensaje'], "Busco a Ana y te enseño las citas de mañana.")
+        
+        llamada = cliente.llamadas[0]
+        self.assertIs(llamada['tools'], agente.MotorIA.HERRAMIENTAS)
+        self.assertEqual(llamada['system'][0]['text'], agente.MotorIA.PROMPT_HERRAMIENTAS)
+        self.assertEqual([b for b in llamada['system'] if 'cache_control' in b], [llamada['system'][0]])
+        self.assertEqual(self.motor.uso['cache_leida'], 1500)
+    
+    def test_memoria_guarda_el_turno_como_texto(self):
+        self.usar_cliente(herramienta('consultar_deuda', {'nombre_paciente': 'Luis'}))
+        self.motor.procesar("cuánto debe Luis", 'recepcion')
+        
+        turno = self.motor.memoria('recepcion').turnos[-1]
+        self.assertEqual(turno['usuario'], "cuánto debe Luis")
+        self.assertEqual(turno['asistente'], '[acciones: consultar_deuda({"nombre_paciente": "Luis"})]')
+        
+        # El turno siguiente reenvía ese texto, nunca un tool_use sin tool_result
+        mensajes = self.motor.memoria('recepcion').mensajes("y Ana?")
+        self.assertTrue(all(isinstance(m['content'], str) for m in mensajes))
+    
+    def test_error_de_la_api_usa_el_fallback(self):
+        self.usar_cliente(error=RuntimeError("sin conexión"))
+        resultado = self.motor.procesar("lista las citas de mañana")
+        self.assertEqual(resultado['accion'], 'listar_citas')
+        self.assertEqual(resultado['parametros'], {'fecha': 'mañana'})
+    
+    def procesar_comando(self, comando):
+        with redirect_stdout(io.StringIO()):
+            return self.agente.procesar_comando(comando, usuario='recepcion')
+    
+    def test_procesar_comando_ejecuta_todas_las_acciones(self):
+        self.usar_cliente(
+            herramienta('buscar_paciente', {'busqueda': 'Ana'}),
+            herramienta('listar_citas', {'fecha': 'mañana'}),
+            herramienta('consultar_deuda', {'nombre_paciente': 'Ana'}),
+        )
+        llamadas = []
+        
+        def comando(nombre, salida=None, error=None):
+            def ejecutar(params):
+                llamadas.append((nombre, params))
+                if error:
+                    raise error
+                return salida
+            return ejecutar
+        
+        self.agente._cmd_buscar_paciente_ia = comando('buscar', "🔍 ANA GARCIA")
+        self.agente._cmd_listar_citas_ia = comando('citas', error=RuntimeError("BD caída"))
+        self.agente._cmd_consultar_deuda_ia = comando('deuda', "💰 0.00€")
+        
+        respuesta = self.procesar_comando("busca a Ana, sus citas de mañana y lo que debe")
+        
+        # En orden, y el error de una acción no impide las demás
+        self.assertEqual(llamadas, [
+            ('buscar', {'busqueda': 'Ana'}),
+            ('citas', {'fecha': 'mañana'}),
+            ('deuda', {'nombre_paciente': 'Ana'}),
+        ])
+        self.assertEqual(respuesta.splitlines(), ["🔍 ANA GARCIA", "❌ Error: BD caída", "💰 0.00€"])
+    
+    def test_procesar_comando_sin_acciones_devuelve_la_aclaracion(self):
+        self.usar_cliente(texto("¿Para qué paciente es la cita?"))
+        self.assertEqual(self.procesar_comando("pon una cita el lunes"), "¿Para qué paciente es la cita?")
+
+
+if __name__ == '__main__':
+    unittest.main()
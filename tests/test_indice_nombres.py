@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Búsqueda fonética de pacientes en memoria (clave_fonetica e IndiceNombres).
+
+    python -m unittest discover -s tests
+
+Necesita las dependencias de requirements.txt (pyodbc); sin ellas se salta.
+No abre conexión con SQL Server: la tabla Pacientes es un doble en memoria.
+"""
+
+import sys
+import unittest
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+try:
+    import agente_gesden_v4_0 as agente
+except ImportError:
+    agente = None
+
+
+def paciente(id_pac, nombre, apellidos, fecha_modif=None):
+    return SimpleNamespace(
+        IdPac=id_pac, NumPac=100 + id_pac, Nombre=nombre, Apellidos=apellidos,
+        TelMovil=None, Email=None, FecNacim=None, Sexo=None, _fechaModif=fecha_modif
+    )
+
+
+class BDPacientes:
+    """ejecutar_query de la carga completa y de los refrescos de IndiceNombres"""
+    
+    def __init__(self, filas):
+        self.filas = list(filas)
+    
+    def ejecutar_query(self, sql, params=None):
+        if 'WHERE' not in sql:
+            return list(self.filas)
+        if len(params) == 1:
+            (max_id,) = params
+            return [f for f in self.filas if f._fechaModif is not None or f.IdPac > max_id]
+        marca, max_id = params
+        return [
+            f for f in self.filas
+            if (f._fechaModif is not None and f._fechaModif >= marca)
+            or (f._fechaModif is None and f.IdPac > max_id)
+        ]
+
+
+@unittest.skipIf(agente is None, "faltan dependencias (pyodbc)")
+class TestClaveFonetica(unittest.TestCase):
+    
+    def test_grafias_que_suenan_igual(self):
+        for a, b in (
+            ("XIMENEZ", "JIMENEZ"),
+            ("LLORENTE", "YORENTE"),
+            ("HERNANDEZ", "ERNANDEZ"),
+            ("CECILIA", "SESILIA"),
+            ("GEMA", "JEMA"),
+            ("GUERRA", "GUERA"),
+            ("VALDES", "BALDES"),
+            ("GARZIA", "GARCIA"),
+            ("CARRASCO", "CARASCO"),
+            ("QUINTANA", "KINTANA"),
+            ("RUY", "RUI"),
+        ):
+            self.assertEqual(agente.clave_fonetica(a), agente.clave_fonetica(b), (a, b))
+    
+    def test_grafias_distintas(self):
+        for a, b in (("GARCIA", "GARRIDO"), ("CHAVES", "SAVES"), ("MARTIN", "MARTINEZ")):
+            self.assertNotEqual(agente.clave_fonetica(a), agente.clave_fonetica(b), (a, b))
+    
+    def test_palabras_nombre(self):
+        self.assertEqual(agente.palabras_nombre("María de la Cruz Gómez-Ruiz"), ["MARIA", "CRUZ", "GOMEZ", "RUIZ"])
+
+
+@unittest.skipIf(agente is None, "faltan dependencias (pyodbc)")
+class TestIndiceNombres(unittest.TestCase):
+    
+    def setUp(self):
+        self.bd = BDPacientes([
+            paciente(1, "José", "García López", datetime(2026, 1, 1)),
+            paciente(2, "Josefa", "García Martín", datetime(2026, 1, 1)),
+            paciente(3, "Ana", "Jiménez Ruiz", datetime(2026, 1, 2)),
+            paciente(4, "María", "de la Cruz Hernández", None),
+            paciente(5, "Luis", "Garrido", datetime(2026, 1, 3)),
+        ])
+        self.indice = agente.IndiceNombres(self.bd, intervalo=0)
+        self.indice.cargar()
+    
+    def ids(self, texto):
+        return [p['IdPac'] for _, p in self.indice.buscar(texto)]
+    
+    def test_orden_de_palabras_y_tildes(self):
+        self.assertEqual(self.ids("jose garcia")[0], 1)
+        self.assertEqual(self.ids("García José")[0], 1)
+    
+    def test_busqueda_fonetica(self):
+        self.assertEqual(self.ids("Garzía Jose")[0], 1)
+        self.assertEqual(self.ids("ana ximenez"), [3])
+        self.assertEqual(self.ids("maria ernandez"), [4])
+    
+    def test_prefijo_y_orden_por_puntuacion(self):
+        # "jose" es exacto para el 1 y prefijo de "JOSEFA" para el 2
+        puntuados = self.indice.buscar("jose garcia")
+        self.assertEqual([p['IdPac'] for _, p in puntuados], [1, 2])
+        self.assertGreater(puntuados[0][0], puntuados[1][0])
+        self.assertEqual(self.ids("garr")[0], 5)
+    
+    def test_todas_las_palabras_deben_aparecer(self):
+        self.assertEqual(self.ids("jose garrido"), [])
+        self.assertEqual(self.ids("de la"), [])
+    
+    def test_refrescar_cambios_y_altas_sin_fecha(self):
+        self.bd.filas[2] = paciente(3, "Ana", "Giménez Ruiz", datetime(2026, 2, 1))
+        self.bd.filas.append(paciente(6, "Pedro", "Ximénez", None))
+        self.indice.refrescar(forzar=True)
+        
+        self.assertEqual(self.ids("ana gimenez"), [3])
+        self.assertEqual(self.ids("pedro jimenez"), [6])
+        self.assertEqual(self.indice.marca, datetime(2026, 2, 1))
+        self.assertEqual(self.indice.max_id, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Memoria de conversación por operador: cada usuario del agente tiene su historial.
+
+    python -m unittest discover -s tests
+
+Necesita las dependencias de requirements.txt (pyodbc); sin ellas se salta.
+La API de Claude se sustituye por un cliente que anota cada llamada.
+"""
+
+import io
+import sys
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+try:
+    import agente_gesden_v4_0 as agente
+except ImportError:
+    agente = None
+
+
+class ClienteClaude:
+    """messages.create anota los mensajes enviados y pide aclaración"""
+    
+    # Texto sin tool_use; en modo JSON, la respuesta JSON equivalente
+    ACLARACION = '{"accion": "necesita_aclaracion", "parametros": {}, "mensaje": "¿Para qué día?"}'
+    
+    def __init__(self):
+        self.llamadas = []
+        self.messages = self
+    
+    def create(self, **kwargs):
+        self.llamadas.append([dict(m) for m in kwargs['messages']])
+        return SimpleNamespace(
+            content=[SimpleNamespace(type='text', text=self.ACLARACION)],
+            usage=None
+        )
+
+
+@unittest.skipIf(agente is None, "faltan dependencias (pyodbc)")
+class TestMemoriaPorUsuario(unittest.TestCase):
+    
+    def setUp(self):
+        # Sin clave: MotorIA no crea el cliente real de la API
+        parche = mock.patch.object(agente.ConfigGesden, 'ANTHROPIC_API_KEY', '')
+        parche.start()
+        self.addCleanup(parche.stop)
+        
+        with redirect_stdout(io.StringIO()):
+            motor = agente.MotorIA()
+        self.cliente = ClienteClaude()
+        motor.client = self.cliente
+        motor.disponible = True
+        
+        self.agente = agente.AgenteGesdenIA.__new__(agente.AgenteGesdenIA)
+        self.agente.ia = motor
+        self.agente.usuario = None
+    
+    def procesar(self, texto, usuario):
+        with redirect_stdout(io.StringIO()):
+            return self.agente.procesar_comando(texto, usuario=usuario)
+    
+    @staticmethod
+    def textos(mensajes):
+        return [m['content'] for m in mensajes if m['role'] == 'user']
+    
+    def test_historiales_separados(self):
+        self.procesar("cita para Juan García", 'recepcion')
+        self.procesar("qué citas tengo", 'doctora')
+        self.procesar("el lunes a las 10", 'recepcion')
+        
+        recepcion_1, doctora, recepcion_2 = self.cliente.llamadas
+        self.assertEqual(self.textos(recepcion_1), ["cita para Juan García"])
+        # La doctora no ve lo que pidió recepción
+        self.assertEqual(self.textos(doctora), ["qué citas tengo"])
+        # Recepción sigue con su conversación
+        self.assertEqual(self.textos(recepcion_2), ["cita para Juan García", "el lunes a las 10"])
+        
+        self.assertEqual(set(self.agente.ia.sesiones), {'recepcion', 'doctora'})
+    
+    def test_main_pasa_el_operador(self):
+        llamadas = []
+        
+        class AgenteFalso:
+            def procesar_comando(self, comando, usuario=None):
+                llamadas.append((comando, usuario))
+                return ""
+            
+            def cerrar(self):
+                pass
+        
+        entradas = iter(["hola", "operador doctora", "hola", "salir"])
+        with mock.patch.object(agente, 'AgenteGesdenIA', AgenteFalso), \
+                mock.patch.object(agente.ConfigGesden, 'OPERADOR', 'recepcion'), \
+                mock.patch('builtins.input', lambda _: next(entradas)), \
+                redirect_stdout(io.StringIO()):
+            agente.main()
+        
+        self.assertEqual(llamadas, [("hola", 'recepcion'), ("hola", 'doctora')])
+
+
+
+def cita(nombre, fecha, hora='10:00'):
+    """Resultado de crear_cita tal como lo devuelve MotorIA.procesar"""
+    return {
+        'accion': 'crear_cita',
+        'parametros': {'nombre_paciente': nombre, 'fecha': fecha, 'hora': hora},
+        'mensaje': ''
+    }
+
+
+@unittest.skipIf(agente is None, "faltan dependencias (pyodbc)")
+class TestMemoriaConversacion(unittest.TestCase):
+    
+    def test_pliega_al_pasar_de_turnos(self):
+        memoria = agente.MemoriaConversacion(turnos=3, presupuesto=10000)
+        for n in range(5):
+            memoria.registrar(f"cita para Paciente{n}", "Creando cita...", cita(f"Paciente{n}", "2026-11-02"))
+        
+        self.assertEqual([t['usuario'] for t in memoria.turnos],
+                         ["cita para Paciente2", "cita para Paciente3", "cita para Paciente4"])
+        self.assertEqual(memoria.plegados, 2)
+        self.assertEqual(memoria.pacientes, ["Paciente0", "Paciente1"])
+    
+    def test_pliega_al_pasar_de_tokens(self):
+        memoria = agente.MemoriaConversacion(turnos=10, presupuesto=100)
+        respuesta = "Creando cita " + "x" * 200           # ~53 tokens por turno
+        for n in range(3):
+            memoria.registrar(f"cita para Paciente{n}", respuesta, cita(f"Paciente{n}", "2026-11-02"))
+        
+        # Dos turnos ya no caben en 100 tokens: solo queda el último literal
+        self.assertEqual(len(memoria.turnos), 1)
+        self.assertEqual(memoria.plegados, 2)
+        self.assertIn("Paciente0; Paciente1", memoria.resumen())
+    
+    def test_resumen_conserva_pacientes_fechas_y_accion(self):
+        memoria = agente.MemoriaConversacion(turnos=1, presupuesto=10000)
+        memoria.registrar("cita para Ana", "Creando...", cita("Ana García", "2026-11-02", "10:30"))
+        memoria.registrar("busca a Luis", "Buscando...", {
+            'accion': 'buscar_paciente', 'parametros': {'busqueda': 'Luis Pérez'}, 'mensaje': ''
+        })
+        memoria.registrar("qué citas hay mañana", "Listando...", {
+            'accion': 'listar_citas', 'parametros': {'fecha': 'mañana'}, 'mensaje': ''
+        })
+        
+        resumen = memoria.resumen()
+        self.assertIn("Pacientes mencionados: Ana García; Luis Pérez", resumen)
+        self.assertIn("Fechas elegidas: 2026-11-02 10:30", resumen)
+        self.assertIn("Última acción: buscar_paciente", resumen)
+    
+    def test_tokens_acotados_en_sesion_larga(self):
+        memoria = agente.MemoriaConversacion(
+            agente.ConfigGesden.MEMORIA_TURNOS, agente.ConfigGesden.MEMORIA_TOKENS
+        )
+        tokens = []
+        for n in range(30):
+            fecha = f"2026-11-{n % 28 + 1:02d}"
+            memoria.registrar(
+                f"pon una cita a Paciente{n} el día {n % 28 + 1} de noviembre a las 10",
+                f"Creando cita para Paciente{n} el {fecha} a las 10:00...",
+                cita(f"Paciente{n}", fecha)
+            )
+            tokens.append(memoria.tokens())
+        
+        # Tras llenarse, la memoria no crece con la sesión
+        self.assertLessEqual(max(tokens), agente.ConfigGesden.MEMORIA_TOKENS)
+        self.assertLessEqual(max(tokens[10:]), tokens[9] + 10)
+        self.assertEqual(len(memoria.pacientes), agente.MemoriaConversacion.MAX_PACIENTES)
+        self.assertEqual(len(memoria.fechas), agente.MemoriaConversacion.MAX_FECHAS)
+    
+    def test_nombre_prefijo_de_otro_no_se_descarta(self):
+        memoria = agente.MemoriaConversacion(turnos=1, presupuesto=10000)
+        memoria.anotar_paciente({'Nombre': 'ANA', 'Apellidos': 'GARCIA', 'NumPac': 11})
+        for nombre in ("Paciente22", "Paciente2", "Garcia Ana", "paciente22"):
+            memoria.registrar(f"cita para {nombre}", "Creando...", cita(nombre, "2026-11-02"))
+        memoria.registrar("gracias", "De nada", {'accion': 'desconocida', 'parametros': {}})
+        
+        # "Paciente2" no es "Paciente22"; los repetidos (con o sin NumPac) no se duplican
+        self.assertEqual(memoria.pacientes, ["GARCIA ANA (NumPac 11)", "Paciente22", "Paciente2"])
+
+
+if __name__ == '__main__':
+    unittest.main()